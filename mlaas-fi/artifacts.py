@@ -0,0 +1,204 @@
+import hashlib
+import io
+import os
+import tempfile
+import threading
+
+from utils import create_dir, recreate_dir
+
+
+# Artifact store types: faulty images written to the temp dir, or kept in memory (spilling to the
+# temp dir above a memory limit)
+DISK_STORE = 'disk'
+MEMORY_STORE = 'memory'
+
+# Default memory limit of the in-memory artifact store
+DEFAULT_MEMORY_LIMIT_MB = 1024
+
+# Default location and disk size cap of the persistent faulty artifacts store
+FAULTY_STORE_DIR = 'faulty/'
+DEFAULT_FAULTY_STORE_MB = 4096
+
+
+# Stores the faulty images (encoded) of an experiment as files in a directory. Artifacts are
+# identified by their faulty image paths (see experiments.gen_faulty_image_path)
+class DiskArtifactStore:
+    def __init__(self, dir_path):
+        self.dir_path = dir_path
+        recreate_dir(dir_path)
+
+    def put(self, key, data):
+        with open(key, 'wb') as artifact_file:
+            artifact_file.write(data)
+
+    # The artifact as accepted by services.get_predictions (a path here)
+    def source(self, key):
+        return key
+
+    def open(self, key):
+        return open(key, 'rb')
+
+    def delete(self, key):
+        if os.path.exists(key):
+            os.remove(key)
+
+    def keys(self):
+        return [os.path.join(self.dir_path, name) for name in sorted(os.listdir(self.dir_path))]
+
+    def __contains__(self, key):
+        return os.path.exists(key)
+
+
+# Stores the faulty images (encoded) of an experiment in memory. Once the stored bytes exceed the
+# memory limit, new artifacts are spilled to files in a directory instead
+class MemoryArtifactStore(DiskArtifactStore):
+    def __init__(self, dir_path, memory_limit_mb=DEFAULT_MEMORY_LIMIT_MB):
+        super().__init__(dir_path)
+        self.memory_limit = memory_limit_mb * 1024 * 1024
+        self.memory_size = 0
+        self.artifacts = {}
+        self.spilled = set()
+        self.lock = threading.Lock()
+
+    def put(self, key, data):
+        with self.lock:
+            previous = self.artifacts.pop(key, None)
+            if previous is not None:
+                self.memory_size -= len(previous)
+            spill = self.memory_size + len(data) > self.memory_limit
+            if not spill:
+                self.artifacts[key] = data
+                self.memory_size += len(data)
+            was_spilled = key in self.spilled
+            self.spilled.discard(key)
+            if spill:
+                self.spilled.add(key)
+
+        if spill:
+            super().put(key, data)  # Spill to disk
+        elif was_spilled:
+            super().delete(key)  # Drop the outdated spilled copy
+
+    # The artifact as accepted by services.get_predictions (its bytes or its spilled path)
+    def source(self, key):
+        with self.lock:
+            return self.artifacts.get(key, key)
+
+    def open(self, key):
+        with self.lock:
+            if key in self.artifacts:
+                return io.BytesIO(self.artifacts[key])
+        return super().open(key)
+
+    def delete(self, key):
+        with self.lock:
+            data = self.artifacts.pop(key, None)
+            self.spilled.discard(key)
+            if data is not None:
+                self.memory_size -= len(data)
+                return
+        super().delete(key)
+
+    def keys(self):
+        with self.lock:
+            memory_keys = list(self.artifacts)
+        return sorted(memory_keys + super().keys())
+
+    def __contains__(self, key):
+        with self.lock:
+            if key in self.artifacts:
+                return True
+        return super().__contains__(key)
+
+
+# Persistent, content-indexed store of faulty images shared by runs and experiments. Artifacts are
+# keyed by the hash of the source image, the fault variant, the extension, the fault kernels
+# version (see faults.get_faults_version) and the seed, and stored as files (written atomically, so
+# that concurrent injection processes may share the store). Reads refresh the file modification
+# times, which order the least recently used artifacts evicted above the disk size cap
+class FaultyArtifactStore:
+    def __init__(self, dir_path, max_size_mb=DEFAULT_FAULTY_STORE_MB, version=''):
+        self.dir_path = dir_path
+        self.max_size = max_size_mb * 1024 * 1024 if max_size_mb is not None else None
+        self.version = version
+        create_dir(dir_path)
+
+    # Generates the key of a faulty image from the hash of its source image (see hash_source)
+    def gen_key(self, source_hash, fault_key, extension, seed=None):
+        key = '/'.join([source_hash, fault_key, extension, self.version, str(seed)])
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    @staticmethod
+    def hash_source(data):
+        return hashlib.sha256(data).hexdigest()
+
+    def __path(self, key):
+        return os.path.join(self.dir_path, key[:2], key)
+
+    # Retrieves the bytes of an artifact, or None if not stored
+    def get(self, key):
+        path = self.__path(key)
+        try:
+            with open(path, 'rb') as artifact_file:
+                data = artifact_file.read()
+            os.utime(path)
+        except FileNotFoundError:  # Not stored or evicted meanwhile
+            return None
+        return data
+
+    def put(self, key, data):
+        dir_path = os.path.dirname(self.__path(key))
+        create_dir(dir_path)
+        fd, tmp_path = tempfile.mkstemp(dir=dir_path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as artifact_file:
+            artifact_file.write(data)
+        os.replace(tmp_path, self.__path(key))
+
+    # Removes the least recently used artifacts above the disk size cap
+    def evict(self):
+        if self.max_size is None:
+            return
+
+        entries = []
+        for sub_dir in os.scandir(self.dir_path):
+            if sub_dir.is_dir():
+                for entry in os.scandir(sub_dir.path):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+# Creates the persistent faulty artifacts store of an experiment from its 'faulty_store' config,
+# e.g., {"max_size_mb": 4096} (stored in cache_dir, unless a 'path' is set), or returns None if the
+# experiment has no such config
+def create_faulty_store(exp_config, cache_dir, version):
+    if 'faulty_store' not in exp_config:
+        return None
+
+    store_config = exp_config['faulty_store']
+    return FaultyArtifactStore(
+        store_config.get('path', os.path.join(cache_dir, FAULTY_STORE_DIR)),
+        store_config.get('max_size_mb', DEFAULT_FAULTY_STORE_MB), version
+    )
+
+
+# Creates the artifact store of an experiment according to its 'artifact_store' config, e.g.
+# {"type": "memory", "memory_limit_mb": 1024}. Defaults to a disk store in dir_path
+def create_artifact_store(exp_config, dir_path):
+    store_config = exp_config.get('artifact_store', {})
+    if store_config.get('type', DISK_STORE) == MEMORY_STORE:
+        memory_limit_mb = store_config.get('memory_limit_mb', DEFAULT_MEMORY_LIMIT_MB)
+        return MemoryArtifactStore(dir_path, memory_limit_mb)
+    return DiskArtifactStore(dir_path)
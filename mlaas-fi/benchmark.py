@@ -0,0 +1,314 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+from PIL import Image
+
+from experiments import launch_experiments
+from faults import get_faults_version, inject_fault
+from faults.faults import FAULT_KERNELS
+from inject_fault import INJECT_COMMAND, PREDICT_COMMAND, RUN_COMMAND, VALIDATE_COMMAND
+from mitigations import apply_mitigation
+from mitigations.mitigations import MITIGATION_KERNELS
+from utils import create_dir, dump_json, parse_json
+
+
+# Representative image sizes (width, height) of the studied datasets: CelebA crops, COCO images
+# and large KAIST scene photos
+IMAGE_SIZES = {
+    'celeba': (178, 218),
+    'coco': (640, 480),
+    'kaist': (1280, 1024)
+}
+
+# Parameter values benchmarked per fault (severities 1 to 5 by default)
+DEFAULT_FAULT_LEVELS = [1, 2, 3, 4, 5]
+FAULT_LEVELS = {'chromatic_aberration': [1, 2]}
+
+# Default number of timed calls per benchmark and relative slowdown reported as a regression
+DEFAULT_REPEATS = 5
+DEFAULT_THRESHOLD = 0.1
+
+# Default output file and settings of the end-to-end benchmark (images per size and faults)
+DEFAULT_OUTPUT_FILE = 'benchmark.json'
+PIPELINE_IMAGES_PER_SIZE = 4
+PIPELINE_FAULTS = [
+    {'name': 'gaussian_noise', 'parameter': {'name': 'severity', 'values': [1, 3, 5]}},
+    {'name': 'fog', 'parameter': {'name': 'severity', 'values': [2]}},
+    {'name': 'grayscale'}
+]
+
+# Modules imported by each command of inject_fault.py, timed in a fresh interpreter by the startup
+# benchmark, and heavy dependencies that should only be imported by the commands that use them
+STARTUP_MODULES = {
+    RUN_COMMAND: ['experiments'],
+    INJECT_COMMAND: ['experiments', 'faults'],
+    PREDICT_COMMAND: ['datasets', 'services'],
+    VALIDATE_COMMAND: ['config']
+}
+HEAVY_MODULES = [
+    'boto3', 'google.cloud.vision', 'requests', 'imagecorruptions', 'scipy', 'skimage'
+]
+
+
+# Generates a synthetic photo-like image (smooth gradients, shapes and sensor noise), so that its
+# encoding and processing costs resemble those of real photos of the same size
+def gen_benchmark_image(width, height, seed=0):
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width] / max(width, height)
+    img = np.stack([
+        np.sin(2 * np.pi * (x * rng.uniform(1, 3) + y * rng.uniform(1, 3)) + phase)
+        for phase in rng.uniform(0, 2 * np.pi, 3)
+    ], axis=-1) * 60 + 128
+
+    for _ in range(8):  # Flat shapes with sharp edges
+        cx, cy, r = rng.uniform(0, 1), rng.uniform(0, 1), rng.uniform(0.05, 0.2)
+        img[(x - cx) ** 2 + (y - cy) ** 2 < r ** 2] = rng.uniform(0, 255, 3)
+
+    img += rng.normal(0, 6, img.shape)
+    return np.uint8(np.clip(img, 0, 255))
+
+
+# Writes a synthetic JPEG image per benchmarked size to a directory, returning their paths
+def gen_benchmark_images(dir_path, sizes):
+    paths = {}
+    for size_name in sizes:
+        paths[size_name] = os.path.join(dir_path, size_name + '.jpg')
+        Image.fromarray(gen_benchmark_image(*IMAGE_SIZES[size_name])).save(paths[size_name])
+    return paths
+
+
+# Times repeated calls of func (after one warm-up call), running setup before each call outside
+# the timing. Returns the throughput (calls per second), the p50 and p99 latencies (in ms) and the
+# peak memory allocated during a call (in MB, as traced by tracemalloc in an extra, untimed call),
+# or the error raised by the warm-up call, so that a failing benchmark does not stop the others
+def time_calls(func, repeats, setup=None):
+    if setup is not None:
+        setup()
+    try:
+        func()
+    except Exception as err:
+        print('    failed: {}: {}'.format(type(err).__name__, err))
+        return {'error': '{}: {}'.format(type(err).__name__, err)}
+
+    latencies = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+
+    # Memory is traced in a call of its own, as tracing slows down the allocations of the timed ones
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    func()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies = np.array(latencies) * 1000
+    return {
+        'runs': repeats,
+        'throughput': round(1000 / latencies.mean(), 3),
+        'p50_ms': round(float(np.percentile(latencies, 50)), 3),
+        'p99_ms': round(float(np.percentile(latencies, 99)), 3),
+        'peak_memory_mb': round(peak_memory / (1024 * 1024), 3)
+    }
+
+
+# Benchmarks every fault (at every parameter level) on the images of each size, through the
+# path-based API (decoding, fault kernel and encoding)
+def bench_faults(image_paths, work_dir, repeats, faults=None):
+    results = {}
+    for fault, (_, parameterized) in FAULT_KERNELS.items():
+        if faults and fault not in faults:
+            continue
+
+        levels = FAULT_LEVELS.get(fault, DEFAULT_FAULT_LEVELS) if parameterized else [None]
+        for level in levels:
+            for size_name, image_path in image_paths.items():
+                fault_key = fault if level is None else fault + '-' + str(level)
+                new_path = os.path.join(work_dir, 'fault-' + os.path.basename(image_path))
+                print('  fault {} ({})'.format(fault_key, size_name))
+                results['fault/{}/{}'.format(fault_key, size_name)] = time_calls(
+                    lambda: inject_fault(image_path, new_path, fault, level), repeats
+                )
+    return results
+
+
+# Benchmarks every mitigation on the images of each size, through the path-based API (each call
+# mitigates a fresh copy of the image in place)
+def bench_mitigations(image_paths, work_dir, repeats, mitigations=None):
+    results = {}
+    for mitigation in MITIGATION_KERNELS:
+        if mitigations and mitigation not in mitigations:
+            continue
+
+        for size_name, image_path in image_paths.items():
+            copy_path = os.path.join(work_dir, 'mitigation-' + os.path.basename(image_path))
+            print('  mitigation {} ({})'.format(mitigation, size_name))
+            results['mitigation/{}/{}'.format(mitigation, size_name)] = time_calls(
+                lambda: apply_mitigation(copy_path, mitigation), repeats,
+                setup=lambda: shutil.copyfile(image_path, copy_path)
+            )
+    return results
+
+
+# Benchmarks launch_experiments end to end on a synthetic dataset against a fake AWS provider (see
+# services.fake) with an exponential latency of mean fake_latency_ms (run in work_dir, as
+# experiments use relative dataset and temp dirs). Reports the duration, the image throughput and
+# the peak resident memory of the run and its workers
+def bench_pipeline(work_dir, sizes, fake_latency_ms=0):
+    dataset_dir = os.path.join(work_dir, 'datasets', 'benchmark')
+    create_dir(dataset_dir)
+    n_images = 0
+    for size_name in sizes:
+        for idx in range(PIPELINE_IMAGES_PER_SIZE):
+            img = gen_benchmark_image(*IMAGE_SIZES[size_name], seed=idx)
+            Image.fromarray(img).save(os.path.join(dataset_dir, '{}-{}.jpg'.format(size_name, idx)))
+            n_images += 1
+
+    exp_config = {'experiments': {'benchmark': {
+        'provider': 'AWS',
+        'service': 'LABEL_DETECTION',
+        'dataset': 'benchmark',
+        'output_dir': 'results',
+        'seed': 0,
+        'mitigations': ['jpeg_compression'],
+        'pipeline': {'inject_workers': 2, 'mitigate_workers': 2},
+        'data_faults': PIPELINE_FAULTS
+    }}}
+    providers_config = {'providers': {'AWS': {
+        'fake': {'latency': {'distribution': 'exponential', 'mean_ms': fake_latency_ms}},
+        'concurrency': 8
+    }}}
+
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        print('  pipeline ({} images)'.format(n_images))
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            launch_experiments(exp_config, providers_config)
+        duration = time.perf_counter() - start
+    finally:
+        os.chdir(cwd)
+
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return {'pipeline/end_to_end': {
+        'runs': 1,
+        'images': n_images,
+        'duration_s': round(duration, 3),
+        'throughput': round(n_images / duration, 3),
+        'peak_memory_mb': round(peak_rss / 1024, 3)  # ru_maxrss is in KB on Linux
+    }}
+
+
+# Benchmarks the startup time of each command of inject_fault.py: a fresh interpreter importing the
+# modules of the command (from the directory of this script). Also reports the heavy modules loaded
+# by the imports, which only the commands using them should load
+def bench_startup(repeats):
+    code = 'import sys; import {}; print(" ".join(name for name in {!r} if name in sys.modules))'
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for command, modules in STARTUP_MODULES.items():
+        args = [sys.executable, '-c', code.format(', '.join(modules), HEAVY_MODULES)]
+        print('  startup {}'.format(command))
+        result = time_calls(
+            lambda: subprocess.run(args, cwd=cwd, check=True, capture_output=True), repeats
+        )
+        if 'error' not in result:
+            result.pop('peak_memory_mb')  # Traced in this process, not in the timed interpreters
+            output = subprocess.run(args, cwd=cwd, check=True, capture_output=True, text=True)
+            result['heavy_modules'] = output.stdout.split()
+        results['startup/{}'.format(command)] = result
+    return results
+
+
+# Compares benchmark results with a baseline, returning the regressed benchmarks: those whose
+# throughput dropped by more than the threshold (relative to the baseline)
+def compare_results(results, baseline, threshold=DEFAULT_THRESHOLD):
+    regressions = []
+    for name, metrics in results.items():
+        if 'error' in metrics or name not in baseline or 'error' in baseline[name]:
+            continue
+        baseline_throughput = baseline[name]['throughput']
+        change = metrics['throughput'] / baseline_throughput - 1
+        print('  {:<50} {:>10.3f} -> {:>10.3f} ({:+.1%})'.format(
+            name, baseline_throughput, metrics['throughput'], change))
+        if change < -threshold:
+            regressions.append(name)
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmarks mlaas-fi faults, mitigations, the '
+                                                 'end-to-end pipeline and the startup time')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT_FILE, help='results JSON file')
+    parser.add_argument('--baseline', help='baseline results JSON file to compare against')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='relative throughput drop reported as a regression')
+    parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS)
+    parser.add_argument('--sizes', nargs='+', choices=list(IMAGE_SIZES), default=list(IMAGE_SIZES))
+    parser.add_argument('--faults', nargs='+', help='faults to benchmark (default: all)')
+    parser.add_argument('--mitigations', nargs='+', help='mitigations to benchmark (default: all)')
+    parser.add_argument('--fake-latency-ms', type=float, default=0,
+                        help='mean latency of the fake provider in the pipeline benchmark')
+    parser.add_argument('--skip', nargs='+', default=[],
+                        choices=['faults', 'mitigations', 'pipeline', 'startup'])
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    work_dir = tempfile.mkdtemp(prefix='mlaas-fi-benchmark-')
+    results = {}
+
+    try:
+        image_paths = gen_benchmark_images(work_dir, args.sizes)
+        if 'faults' not in args.skip:
+            results.update(bench_faults(image_paths, work_dir, args.repeats, args.faults))
+        if 'mitigations' not in args.skip:
+            results.update(
+                bench_mitigations(image_paths, work_dir, args.repeats, args.mitigations)
+            )
+        if 'pipeline' not in args.skip:
+            results.update(bench_pipeline(work_dir, args.sizes, args.fake_latency_ms))
+        if 'startup' not in args.skip:
+            results.update(bench_startup(args.repeats))
+    finally:
+        shutil.rmtree(work_dir)
+
+    dump_json(args.output, {
+        'created': int(time.time()),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'faults_version': get_faults_version(),
+        'results': results
+    })
+    print('Results saved to {}'.format(args.output))
+
+    if args.baseline:
+        print('Comparison with {}:'.format(args.baseline))
+        regressions = compare_results(
+            results, parse_json(args.baseline)['results'], args.threshold
+        )
+        if regressions:
+            print('{} regressions above {:.0%}: {}'.format(
+                len(regressions), args.threshold, ', '.join(regressions)))
+            sys.exit(1)
+        print('No regressions above {:.0%}'.format(args.threshold))
@@ -0,0 +1,132 @@
+import json
+import os
+
+
+# Experiment config keys that must match for a checkpoint to be resumed
+CHECKPOINT_CONFIG_KEYS = [
+    'provider', 'service', 'dataset', 'sample', 'seed', 'mitigations', 'mitigation_mode',
+    'sweep_mode', 'early_stopping'
+]
+
+# Version of the checkpoint records (2: predictions recorded per service)
+CHECKPOINT_VERSION = 2
+
+
+# Append-only JSONL checkpoint of the predictions of an experiment. The first line identifies the
+# experiment and every following line records the predictions completed for an image (the base
+# predictions and/or some of its faulty predictions, each as a dict of predictions per service).
+# Lines of the same image are merged when the checkpoint is read, so a resumed run only appends the
+# missing base and faulty predictions. The outcomes of the breaking value searches of an image (see
+# sweep) are recorded along its faulty predictions, in a 'searches' entry. Only the offsets of the
+# lines and the recorded fault keys and searches are kept in memory
+class Checkpoint:
+    def __init__(self, path, experiment_name, exp_config, resume=False):
+        self.path = path
+        self.header = {
+            'version': CHECKPOINT_VERSION,
+            'experiment': experiment_name,
+            'config': {key: exp_config.get(key) for key in CHECKPOINT_CONFIG_KEYS}
+        }
+        self.offsets = {}  # Image key -> offsets of its lines
+        self.has_base = set()
+        self.fault_keys = {}  # Image key -> recorded fault keys
+        self.searches = {}  # Image key -> faults with recorded searches
+
+        if not (resume and os.path.exists(path) and self.__load()):
+            with open(path, 'w') as checkpoint_file:
+                checkpoint_file.write(json.dumps(self.header) + '\n')
+            self.offsets, self.has_base, self.fault_keys, self.searches = {}, set(), {}, {}
+
+        self.file = open(path, 'a')
+
+    # Indexes an existing checkpoint, dropping a trailing partial line (e.g., from a crash). Returns
+    # False if the checkpoint belongs to another experiment configuration
+    def __load(self):
+        with open(self.path, 'rb') as checkpoint_file:
+            try:
+                if json.loads(checkpoint_file.readline()) != self.header:
+                    print('  Checkpoint {} does not match the experiment, restarting'.format(
+                        self.path))
+                    return False
+            except ValueError:
+                return False
+
+            valid_end = checkpoint_file.tell()
+            for line in iter(checkpoint_file.readline, b''):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                self.__index(record, valid_end)
+                valid_end = checkpoint_file.tell()
+
+        with open(self.path, 'r+b') as checkpoint_file:
+            checkpoint_file.truncate(valid_end)
+        return True
+
+    def __index(self, record, offset):
+        key = record['key']
+        self.offsets.setdefault(key, []).append(offset)
+        self.fault_keys.setdefault(key, set()).update(record['faults'])
+        if 'base' in record:
+            self.has_base.add(key)
+        if 'searches' in record:
+            self.searches.setdefault(key, set()).update(record['searches'])
+
+    # Checks whether the base predictions of an image were recorded
+    def has_base_predictions(self, key):
+        return key in self.has_base
+
+    # Checks whether the predictions of an image for a fault key were recorded
+    def has_fault_predictions(self, key, fault_key):
+        return fault_key in self.fault_keys.get(key, ())
+
+    # Checks whether the breaking value search of an image for a fault was recorded
+    def has_search(self, key, fault_name):
+        return fault_name in self.searches.get(key, ())
+
+    # Appends the predictions completed for an image (a partial prediction object without the
+    # 'base' entry if the base predictions were already recorded)
+    def append(self, record):
+        self.file.seek(0, os.SEEK_END)
+        offset = self.file.tell()
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.__index(record, offset)
+
+    # Reads the merged prediction object of an image, keeping only the given fault keys. The
+    # mitigations applied to the faulty images and the searches, if recorded, are read into
+    # 'mitigations' and 'searches' entries
+    def read(self, key, fault_keys):
+        pred_object = {'key': key, 'base': [], 'faults': {}}
+        mitigations, searches = {}, {}
+        with open(self.path, 'r') as checkpoint_file:
+            for offset in self.offsets.get(key, []):
+                checkpoint_file.seek(offset)
+                record = json.loads(checkpoint_file.readline())
+                if 'base' in record:
+                    pred_object['base'] = record['base']
+                pred_object['faults'].update(record['faults'])
+                mitigations.update(record.get('mitigations', {}))
+                searches.update(record.get('searches', {}))
+
+        pred_object['faults'] = {
+            fault_key: pred_object['faults'][fault_key]
+            for fault_key in fault_keys if fault_key in pred_object['faults']
+        }
+        if mitigations:
+            pred_object['mitigations'] = {
+                fault_key: mitigations[fault_key]
+                for fault_key in pred_object['faults'] if fault_key in mitigations
+            }
+        if searches:
+            pred_object['searches'] = searches
+        return pred_object
+
+    # Checks whether an image has any recorded predictions
+    def __contains__(self, key):
+        return key in self.offsets
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,104 @@
+import os
+
+from datasets import EXTRACT_MODE, STREAM_MODE
+from experiments import ALL_MITIGATIONS, RANDOM_MITIGATION, get_stage_workers
+from faults import FAULT_KERNELS
+from mitigations import MITIGATION_KERNELS
+from results import COLUMNAR_FORMAT, JSON_FORMAT
+from services import get_services, is_supported
+from sweep import ADAPTIVE_SWEEPS, EXHAUSTIVE_SWEEP
+
+
+# Keys required in every experiment config
+REQUIRED_EXPERIMENT_KEYS = ['provider', 'service', 'dataset', 'output_dir', 'data_faults']
+
+# Accepted values of the experiment settings with a fixed set of choices
+EXPERIMENT_CHOICES = {
+    'dataset_mode': [EXTRACT_MODE, STREAM_MODE],
+    'mitigation_mode': [RANDOM_MITIGATION, ALL_MITIGATIONS],
+    'results_format': [JSON_FORMAT, COLUMNAR_FORMAT],
+    'sweep_mode': [EXHAUSTIVE_SWEEP, *ADAPTIVE_SWEEPS]
+}
+
+
+# Validates the data faults of an experiment: known faults, with a parameter (a name and a list
+# of values) if and only if their kernels take one
+def validate_data_faults(data_faults):
+    errors = []
+    for fault in data_faults:
+        name = fault.get('name')
+        if name not in FAULT_KERNELS:
+            errors.append('unknown fault {}'.format(name))
+            continue
+
+        parameterized = FAULT_KERNELS[name][1]
+        parameter = fault.get('parameter')
+        if parameterized and parameter is None:
+            errors.append('fault {} requires a parameter'.format(name))
+        elif not parameterized and parameter is not None:
+            errors.append('fault {} takes no parameter'.format(name))
+        elif parameter is not None and (
+            'name' not in parameter or not isinstance(parameter.get('values'), list)
+        ):
+            errors.append('fault {} parameter requires a name and a list of values'.format(name))
+    return errors
+
+
+# Validates an experiment config (without importing the providers' SDKs nor the imaging libraries,
+# and without running anything). Returns a list of errors
+def validate_experiment(exp_config, providers_config, dataset_dir):
+    missing_keys = [key for key in REQUIRED_EXPERIMENT_KEYS if key not in exp_config]
+    if missing_keys:
+        return ['missing {}'.format(', '.join(missing_keys))]
+
+    errors = []
+    provider = exp_config['provider']
+    services = get_services(exp_config)
+    if not services:
+        errors.append('no service configured')
+    elif not is_supported(provider, services):
+        errors.append('unsupported combination of provider ({}) and service ({})'.format(
+            provider, ', '.join(services)))
+    elif provider not in providers_config.get('providers', {}):
+        errors.append('provider {} is not configured in the providers config'.format(provider))
+
+    dataset_path = os.path.join(dataset_dir, exp_config['dataset'])
+    if not os.path.exists(dataset_path + '.tar.gz') and not os.path.isdir(dataset_path):
+        errors.append('dataset {} not found in {}'.format(exp_config['dataset'], dataset_dir))
+
+    errors += validate_data_faults(exp_config['data_faults'])
+    errors += [
+        'unknown mitigation {}'.format(mitigation)
+        for mitigation in exp_config.get('mitigations', []) if mitigation not in MITIGATION_KERNELS
+    ]
+    for key, choices in EXPERIMENT_CHOICES.items():
+        if key in exp_config and exp_config[key] not in choices:
+            errors.append('{} must be one of {}'.format(key, ', '.join(choices)))
+
+    for stage in ['inject', 'mitigate', 'predict']:
+        workers = get_stage_workers(exp_config, stage)
+        if not isinstance(workers, int) or workers < 1:
+            errors.append('{}_workers must be a positive integer'.format(stage))
+    if 'sample' in exp_config and not isinstance(exp_config['sample'].get('size'), int):
+        errors.append('sample requires an integer size')
+    if 'early_stopping' in exp_config and 'ci_width' not in exp_config['early_stopping']:
+        errors.append('early_stopping requires a ci_width')
+    shuffle_buffer = exp_config.get('early_stopping', {}).get('shuffle_buffer', 1)
+    if not isinstance(shuffle_buffer, int) or shuffle_buffer < 1:
+        errors.append('early_stopping shuffle_buffer must be a positive integer')
+    return errors
+
+
+# Validates the experiments and providers configs, returning a list of (experiment, error) tuples
+# (with a None experiment for the errors of the configs themselves)
+def validate_config(exp_config, providers_config, dataset_dir):
+    if not isinstance(providers_config.get('providers'), dict):
+        return [(None, 'the providers config requires a "providers" entry')]
+    if not isinstance(exp_config.get('experiments'), dict) or not exp_config['experiments']:
+        return [(None, 'the experiments config requires a non-empty "experiments" entry')]
+
+    return [
+        (experiment_name, error)
+        for experiment_name, experiment in exp_config['experiments'].items()
+        for error in validate_experiment(experiment, providers_config, dataset_dir)
+    ]
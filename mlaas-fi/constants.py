@@ -2,6 +2,7 @@
 DEFAULT_DATASET_DIR = 'datasets/'
 DEFAULT_OUTPUT_DIR = 'results/'
 DEFAULT_TEMP_DIR = 'tmp/'
+DEFAULT_CACHE_DIR = 'cache/'
 
 # Default config files
 EXP_CONFIG_FILE = 'exp.config.json'
@@ -0,0 +1,184 @@
+import io
+import os
+import random
+import tarfile
+
+from utils import dump_json, extract_tarfile, parse_json
+
+
+# Supported image file extensions (matched case-insensitively)
+IMAGE_EXTENSIONS = ('.bmp', '.gif', '.jpeg', '.jpg', '.png', '.tif', '.tiff', '.webp')
+
+# Dataset loading modes: extract the tarball once and reuse the extraction, or stream the images
+# straight out of the tarball without writing them to disk
+EXTRACT_MODE = 'extract'
+STREAM_MODE = 'stream'
+
+# Suffix of the stamp file that validates a previous extraction of a dataset tarball
+EXTRACTION_STAMP_SUFFIX = '.extracted.json'
+
+# Default number of images held by the shuffle buffer of a streamed dataset, and the fraction of
+# the dataset below which the buffer is reported as too small: images only move within about a
+# buffer's length of their position, so the order of a dataset sorted by class stays nearly sorted
+DEFAULT_SHUFFLE_BUFFER = 256
+MIN_SHUFFLE_BUFFER_FRACTION = 0.25
+
+
+# An image of a dataset, either extracted to a path or held in memory as its encoded bytes. Its
+# group is the subdirectory of the image in the dataset (e.g., a class), used to stratify samples
+class DatasetImage:
+    def __init__(self, key, path=None, data=None, group=''):
+        self.key = key
+        self.path = path
+        self.data = data
+        self.group = group
+
+    # The image source accepted by the faults and services modules (a path or the image bytes)
+    @property
+    def source(self):
+        return self.path if self.data is None else self.data
+
+    # Opens the image as a binary file-like object
+    def open(self):
+        return open(self.path, 'rb') if self.data is None else io.BytesIO(self.data)
+
+
+# Checks whether a file name has a supported image extension
+def is_image_file(name):
+    return os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+
+
+# Generates the stamp (mtime and size) of a tarball, used to validate its extraction
+def gen_extraction_stamp(tar_path):
+    tar_stat = os.stat(tar_path)
+    return {'mtime': tar_stat.st_mtime, 'size': tar_stat.st_size}
+
+
+# Extracts a dataset tarball to output_dir unless it was already extracted from the same tarball,
+# as recorded by a stamp file next to it
+def extract_dataset(tar_path, dataset_dir, output_dir):
+    if not os.path.exists(tar_path) and os.path.isdir(dataset_dir):
+        return  # Already extracted dataset whose tarball was removed
+
+    stamp_path = dataset_dir + EXTRACTION_STAMP_SUFFIX
+    stamp = gen_extraction_stamp(tar_path)
+    if os.path.isdir(dataset_dir) and os.path.exists(stamp_path) and \
+            parse_json(stamp_path) == stamp:
+        return
+
+    extract_tarfile(tar_path, output_dir)
+    dump_json(stamp_path, stamp)
+
+
+# Lists the images of an extracted dataset directory (recursively, in a deterministic order)
+def list_dataset_images(dataset_dir):
+    images = []
+    for dir_path, dir_names, file_names in os.walk(dataset_dir):
+        dir_names.sort()
+        group = os.path.relpath(dir_path, dataset_dir)
+        for file_name in sorted(file_names):
+            if is_image_file(file_name):
+                images.append(DatasetImage(
+                    file_name, path=os.path.join(dir_path, file_name), group=group
+                ))
+
+    return images
+
+
+# Lists the names of the image members of a dataset tarball (without reading the images)
+def list_tar_images(tar_path):
+    with tarfile.open(tar_path, mode='r|*') as tar_file:
+        return [member.name for member in tar_file
+                if member.isfile() and is_image_file(member.name)]
+
+
+# Streams the images of a dataset tarball, reading its members sequentially. If member_names is
+# given, only the images of these members are read
+def iter_tar_images(tar_path, member_names=None):
+    with tarfile.open(tar_path, mode='r|*') as tar_file:
+        for member in tar_file:
+            if member.isfile() and is_image_file(member.name) and \
+                    (member_names is None or member.name in member_names):
+                data = tar_file.extractfile(member).read()
+                yield DatasetImage(os.path.basename(member.name), data=data,
+                                   group=os.path.dirname(member.name))
+
+
+# Samples size images of a dataset, given the groups of its images, and returns their indexes in
+# dataset order. The images are drawn uniformly or, when stratified, from each group in proportion
+# to its size (the images left by the rounding going to the largest remainders)
+def sample_indexes(groups, size, seed=None, stratify=False):
+    rng = random.Random(seed)
+    if size >= len(groups):
+        return list(range(len(groups)))
+    if not stratify:
+        return sorted(rng.sample(range(len(groups)), size))
+
+    strata = {}  # Group -> indexes of its images
+    for idx, group in enumerate(groups):
+        strata.setdefault(group, []).append(idx)
+    quotas = {group: size * len(idxs) / len(groups) for group, idxs in strata.items()}
+    counts = {group: int(quota) for group, quota in quotas.items()}
+    remainders = sorted(strata, key=lambda group: quotas[group] - counts[group], reverse=True)
+    for group in remainders[:size - sum(counts.values())]:
+        counts[group] += 1
+
+    return sorted(idx for group, idxs in strata.items() for idx in rng.sample(idxs, counts[group]))
+
+
+# Shuffles the images of a dataset: a list is permuted, while a stream is shuffled within a buffer
+# of buffer_size images (so that only the buffered images are held in memory). A warning is printed
+# if the buffer holds less than MIN_SHUFFLE_BUFFER_FRACTION of a stream of size images
+def shuffle_images(images, seed=None, buffer_size=DEFAULT_SHUFFLE_BUFFER, size=None):
+    rng = random.Random(seed)
+    if isinstance(images, list):
+        images = list(images)
+        rng.shuffle(images)
+        return images
+
+    if size is not None and buffer_size < size * MIN_SHUFFLE_BUFFER_FRACTION:
+        print('Warning: the shuffle buffer ({} images) is much smaller than the streamed dataset '
+              '({} images), whose order is only partially shuffled. Increase shuffle_buffer or '
+              'use the {} dataset_mode'.format(buffer_size, size, EXTRACT_MODE))
+
+    def iter_shuffled():
+        buffer = []
+        for image in images:
+            buffer.append(image)
+            if len(buffer) >= buffer_size:
+                idx = rng.randrange(len(buffer))
+                buffer[idx], buffer[-1] = buffer[-1], buffer[idx]
+                yield buffer.pop()
+        rng.shuffle(buffer)
+        yield from buffer
+
+    return iter_shuffled()
+
+
+# Counts the images of a dataset tarball (<dataset_base_dir>/<dataset>.tar.gz), reading it once
+def count_tar_images(dataset_base_dir, dataset):
+    return len(list_tar_images(dataset_base_dir + dataset + '.tar.gz'))
+
+
+# Loads the images of a dataset (<dataset_base_dir>/<dataset>.tar.gz) in the given mode. If
+# sample_size is given, only a sample of the images is loaded (see sample_indexes); streamed
+# datasets are then read twice, once to list their images and once to read the sampled ones
+def load_dataset(dataset_base_dir, dataset, mode=EXTRACT_MODE, sample_size=None, stratify=False,
+                 seed=None):
+    dataset_dir = dataset_base_dir + dataset
+    tar_path = dataset_dir + '.tar.gz'
+
+    if mode == STREAM_MODE:
+        if sample_size is None:
+            return iter_tar_images(tar_path)
+        member_names = list_tar_images(tar_path)
+        idxs = sample_indexes([os.path.dirname(name) for name in member_names], sample_size,
+                              seed, stratify)
+        return iter_tar_images(tar_path, set(member_names[idx] for idx in idxs))
+
+    extract_dataset(tar_path, dataset_dir, dataset_base_dir)
+    images = list_dataset_images(dataset_dir)
+    if sample_size is None:
+        return images
+    idxs = sample_indexes([image.group for image in images], sample_size, seed, stratify)
+    return [images[idx] for idx in idxs]
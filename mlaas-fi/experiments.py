@@ -1,22 +1,54 @@
-import glob
+import functools
+import io
+import itertools
 import os
 import random
 import sys
 import time
 import warnings
-
-from constants import DEFAULT_DATASET_DIR, DEFAULT_TEMP_DIR
-from faults import inject_fault
-from mitigations import apply_mitigation
-from services import get_client, get_predictions
-from utils import create_dir, dump_json, extract_tarfile, has_key, recreate_dir
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from artifacts import MemoryArtifactStore, create_artifact_store, create_faulty_store
+from checkpoint import Checkpoint
+from constants import DEFAULT_CACHE_DIR, DEFAULT_DATASET_DIR, DEFAULT_TEMP_DIR
+from datasets import DEFAULT_SHUFFLE_BUFFER, EXTRACT_MODE, STREAM_MODE, count_tar_images
+from datasets import load_dataset, shuffle_images
+from faults import ASSET_SEEDED_FAULTS, apply_fault, apply_fault_batch, configure_asset_cache
+from faults import encode_image
+from faults import get_faults_version, is_batch_fault, is_reproducible_fault, load_image
+from faults import preload_fault_modules, preload_weather_masks
+from metrics import ExperimentMetrics, MetricsExporter, MetricsRegistry
+from metrics import DEFAULT_EXPORT_INTERVAL
+from mitigations import mitigate_image, preload_mitigation_modules
+from pipeline import DEFAULT_QUEUE_SIZE, Pipeline, Stage
+from results import COLUMNAR_EXTENSION, COLUMNAR_FORMAT, JSON_FORMAT, write_columnar_results
+from services import get_cache, get_client, get_dispatcher, get_services, reset_providers
+from stopping import EarlyStopping
+from sweep import ADAPTIVE_SWEEPS, EXHAUSTIVE_SWEEP, SeveritySearch, get_flipped_services
+from utils import create_dir, create_workspace, delete_dir, dump_json_stream, gen_seed, has_key
 
 
 # Experiment steps
-INJECT_FAULTS = '  Injecting {} on {} images'
-APPLY_MITIGATIONS = '  Applying mitigations to faulty images{}'
-GET_PREDICTIONS = '  Performing predictions{}'
+PROCESS_IMAGES = '  Injecting faults, applying mitigations and performing predictions ({}/{})'
 SAVE_RESULTS = '  Saving experiment output'
+CACHE_STATS = '  Prediction cache: {} hits, {} misses, {} collapsed duplicates'
+
+# Default number of workers of a pipeline stage
+DEFAULT_STAGE_WORKERS = 1
+
+# Default memory cap of the fault assets cache, and faults that blend a weather mask
+DEFAULT_ASSET_CACHE_MB = 256
+WEATHER_MASK_FAULTS = ['condensation', 'frost']
+
+# Mitigation modes: a mitigation chosen per faulty image, or all mitigations applied to each
+# faulty image (fan-out)
+RANDOM_MITIGATION = 'random'
+ALL_MITIGATIONS = 'all'
+
+# Number of injected batches between two evictions of the faulty store
+FAULTY_STORE_EVICTION_INTERVAL = 100
 
 
 # Prints a step (i.e., a message followed by a check mark)
@@ -33,10 +65,11 @@ def print_step(message, parameters=[], complete=False, multistep=False, extra_en
     print((message).format(*parameters), end=end)
 
 
-def gen_faulty_image_path(image_path, fault, fault_param=None, fault_param_value=None):
+# Generates the path of a faulty image in an experiment's workspace (temp_dir)
+def gen_faulty_image_path(temp_dir, image_path, fault, fault_param=None, fault_param_value=None):
     basename = os.path.basename(image_path)
     image_name, extension = os.path.splitext(basename)
-    base_path = DEFAULT_TEMP_DIR + image_name + '-' + fault
+    base_path = os.path.join(temp_dir, image_name + '-' + fault)
 
     if fault_param is None or fault_param_value is None:
         return base_path + extension
@@ -44,158 +77,879 @@ def gen_faulty_image_path(image_path, fault, fault_param=None, fault_param_value
         return base_path + '-' + fault_param + '_' + str(fault_param_value) + extension
 
 
-# Retrieves the data for an experiment and returns a sample of it according to the experiment's
-# configuration
-def get_experiment_data(dataset_base_dir, exp_config):
-    dataset = dataset_base_dir + exp_config['dataset']
+# Generates the path of a faulty image with a mitigation applied (fan-out mode)
+def gen_mitigated_image_path(faulty_image_path, mitigation):
+    root, extension = os.path.splitext(faulty_image_path)
+    return root + '+' + mitigation + extension
 
-    # Extract the dataset content - works recursively
-    extract_tarfile(dataset + '.tar.gz', dataset_base_dir)
-    dataset_images = glob.glob(dataset + '/**/*.jpg', recursive=True)
-    dataset_images += glob.glob(dataset + '/**/*.JPG', recursive=True)
 
-    return dataset_images
+# Retrieves the data for an experiment and returns a sample of it according to the experiment's
+# configuration. The dataset is either extracted once (and the extraction reused) or streamed out
+# of its tarball (as an iterator), according to the experiment's dataset_mode. The optional
+# 'sample' config (e.g., {"size": 500, "stratify": true, "seed": 1}) draws a sample of the images,
+# stratified by subdirectory if set, and with 'early_stopping' the images are read in a random
+# order, so that the change rates observed as the experiment goes are unbiased. Extracted datasets
+# are fully shuffled, while streamed ones are shuffled within a buffer of the early_stopping's
+# shuffle_buffer images (and counted first, to warn about a buffer too small for them). The sample
+# and the order are seeded by the sample seed or, by default, the experiment's seed
+def get_experiment_data(dataset_base_dir, exp_config):
+    mode = exp_config.get('dataset_mode', EXTRACT_MODE)
+    sample_config = exp_config.get('sample', {})
+    seed = sample_config.get('seed', exp_config.get('seed'))
+    exp_data = load_dataset(
+        dataset_base_dir, exp_config['dataset'], mode, sample_config.get('size'),
+        sample_config.get('stratify', False), None if seed is None else gen_seed(seed, 'sample')
+    )
+    if 'early_stopping' in exp_config:
+        buffer_size = exp_config['early_stopping'].get('shuffle_buffer', DEFAULT_SHUFFLE_BUFFER)
+        size = None
+        if mode == STREAM_MODE:
+            size = sample_config.get('size') or count_tar_images(dataset_base_dir,
+                                                                 exp_config['dataset'])
+        exp_data = shuffle_images(
+            exp_data, None if seed is None else gen_seed(seed, 'order'), buffer_size, size
+        )
+    return exp_data
+
+
+# Retrieves the path of the predictions checkpoint of an experiment
+def gen_checkpoint_path(exp_config, experiment_name):
+    return exp_config['output_dir'] + '/' + experiment_name + '.checkpoint.jsonl'
+
+
+# Projects the prediction object of an image (with predictions per service) to a single service
+def select_service_predictions(pred_object, service):
+    service_pred_object = {
+        'key': pred_object['key'],
+        'base': pred_object['base'][service] if pred_object['base'] else [],
+        'faults': {
+            fault_key: fault_preds[service]
+            for fault_key, fault_preds in pred_object['faults'].items()
+        }
+    }
+    if 'mitigations' in pred_object:
+        service_pred_object['mitigations'] = pred_object['mitigations']
+    if 'searches' in pred_object:
+        service_pred_object['searches'] = {
+            fault_name: {'evaluated': search['evaluated'], 'breaking': search['breaking'][service]}
+            for fault_name, search in pred_object['searches'].items()
+        }
+    return service_pred_object
 
 
-# Saves the results of an experiment to a given results directory
-def save_results(exp_config, experiment_name, predictions):
+# Saves the results of an experiment to a given results directory. The predictions are assembled
+# from the experiment checkpoint, in dataset order (image_keys), and streamed to the output file,
+# along with the summary of the experiment's metrics and the change rates of its early_stopping, if
+# given. With "results_format": "columnar", the predictions are written in the columnar format
+# instead (see results). Experiments with several services have their results split into an
+# output file per service
+def save_results(exp_config, experiment_name, image_keys, checkpoint, metrics_summary=None,
+                 early_stopping=None):
     output_dir = exp_config['output_dir'] + '/'
     create_dir(output_dir)
 
-    output_obj = {'experiment': experiment_name, 'config': exp_config, 'predictions': predictions}
-    output_path = output_dir + experiment_name + '-' + str(int(time.time())) + '.json'
-    dump_json(output_path, output_obj)
-
-
-# Injects the experiment faults into the experiment data, saving the faulty to the
-# DEFAULT_TEMP_DIR directory
-def inject_faults(exp_data, exp_data_faults):
-    dataset_len = len(exp_data)
-    faults_len = len(exp_data_faults)
-
-    for idx, fault in enumerate(exp_data_faults):
-        fault_name = fault['name']
-        step_str = fault_name + ' (' + str(idx + 1) + '/' + str(faults_len) + ')'
-        print_step(INJECT_FAULTS, [step_str, dataset_len], multistep=True)
+    variants = gen_fault_variants(exp_config['data_faults'])
+    fault_keys = [
+        result_key for variant in variants
+        for result_key in gen_result_keys(exp_config, gen_fault_key(*variant))
+    ]
+    services = get_services(exp_config)
+    timestamp = str(int(time.time()))
+
+    for service in services:
+        predictions = (
+            select_service_predictions(checkpoint.read(key, fault_keys), service)
+            for key in image_keys if key in checkpoint
+        )
+
+        output_obj = {'experiment': experiment_name, 'config': exp_config}
+        if metrics_summary is not None:
+            output_obj['metrics'] = metrics_summary
+        if early_stopping is not None:
+            output_obj['early_stopping'] = early_stopping.summary(service)
+        output_path = output_dir + experiment_name
+        if len(services) > 1:
+            output_obj['config'] = dict(exp_config, service=service)
+            output_path += '-' + service
+        output_path += '-' + timestamp
+
+        if exp_config.get('results_format', JSON_FORMAT) == COLUMNAR_FORMAT:
+            write_columnar_results(
+                output_path + COLUMNAR_EXTENSION, output_obj, fault_keys, predictions
+            )
+        else:
+            dump_json_stream(output_path + '.json', output_obj, 'predictions', predictions)
+
+
+# Lists the fault variants (fault x parameter value) of an experiment. Each variant is a tuple
+# (fault_name, fault_param_name, fault_param_value), with None parameters for non-parameterized
+# faults
+def gen_fault_variants(exp_data_faults):
+    variants = []
+    for fault in exp_data_faults:
+        if not has_key(fault, 'parameter'):
+            variants.append((fault['name'], None, None))
+        else:
+            fault_param = fault['parameter']
+            for param_value in fault_param['values']:
+                variants.append((fault['name'], fault_param['name'], param_value))
+
+    return variants
+
+
+# Retrieves the 'sweep_mode' of an experiment, raising a ValueError if unknown (rather than falling
+# back to the exhaustive sweep, which may be far more expensive than the configured one)
+def get_sweep_mode(exp_config):
+    sweep_mode = exp_config.get('sweep_mode', EXHAUSTIVE_SWEEP)
+    if sweep_mode != EXHAUSTIVE_SWEEP and sweep_mode not in ADAPTIVE_SWEEPS:
+        raise ValueError('Unknown sweep mode: ' + str(sweep_mode))
+    return sweep_mode
+
+
+# Lists the fault variants searched adaptively (see sweep) in an experiment with an adaptive
+# 'sweep_mode', per fault: the variants of its parameterized faults with several values, in the
+# configured order of the values (from the mildest to the most severe)
+def gen_searched_variants(exp_config):
+    if get_sweep_mode(exp_config) not in ADAPTIVE_SWEEPS:
+        return {}
+
+    searched_variants = {}
+    for variant in gen_fault_variants(exp_config['data_faults']):
+        searched_variants.setdefault(variant[0], []).append(variant)
+    return {
+        fault_name: fault_variants for fault_name, fault_variants in searched_variants.items()
+        if len(fault_variants) > 1
+    }
+
+
+# Derives the seed of the random values of a fault variant for an image (None without a seed). It
+# only depends on the image and the variant, so that the faulty image of an image does not depend
+# on the batches or workers it is injected with, except for the faults reusing random assets per
+# variant (e.g., fog's plasma fractal), which are seeded per variant
+def gen_fault_seed(seed, variant, image_key):
+    if seed is None:
+        return None
+    if variant[0] in ASSET_SEEDED_FAULTS:
+        return gen_seed(seed, gen_fault_key(*variant))
+    return gen_seed(seed, gen_fault_key(*variant), image_key)
+
+
+# Generates the key of a fault variant in the predictions output (e.g., 'fog-severity_3')
+def gen_fault_key(fault_name, fault_param=None, fault_param_value=None):
+    if fault_param is None or fault_param_value is None:
+        return fault_name
+    return fault_name + '-' + fault_param + '_' + str(fault_param_value)
+
+
+# Generates the key of a mitigated faulty image in the predictions output, when all mitigations
+# are applied to each faulty image (e.g., 'fog-severity_3+median_filter')
+def gen_mitigated_key(fault_key, mitigation):
+    return fault_key + '+' + mitigation
+
+
+# Lists the keys of the faulty predictions of a fault variant in the predictions output: its fault
+# key or, when all mitigations are applied to each faulty image, a key per mitigation
+def gen_result_keys(exp_config, fault_key):
+    mitigations = exp_config.get('mitigations', [])
+    if mitigations and exp_config.get('mitigation_mode', RANDOM_MITIGATION) == ALL_MITIGATIONS:
+        return [gen_mitigated_key(fault_key, mitigation) for mitigation in mitigations]
+    return [fault_key]
+
+
+# Filters the fault variants of an image whose predictions are not recorded in the checkpoint.
+# variant_keys maps each variant to its result keys (see gen_result_keys), by default its fault key
+def get_pending_variants(image, variants, checkpoint=None, variant_keys=None):
+    if checkpoint is None:
+        return variants
+
+    return [
+        variant for variant in variants
+        if not all(
+            checkpoint.has_fault_predictions(image.key, result_key)
+            for result_key in (variant_keys[variant] if variant_keys else [gen_fault_key(*variant)])
+        )
+    ]
+
+
+# Chooses the mitigation applied to a faulty image. With a seed, the choice is reproducible (it only
+# depends on the seed, the image and the fault key), otherwise it is drawn from the system's source
+def choose_mitigation(mitigations, seed, image_key, fault_key):
+    if seed is None:
+        return random.SystemRandom().choice(mitigations)
+    return random.Random(gen_seed(seed, 'mitigation', image_key, fault_key)).choice(mitigations)
+
+
+# Formats an error as reported to the user
+def format_error(err):
+    return '{}: {}'.format(type(err).__name__, err)
+
+
+# Injects the pending fault variants into a batch of images, given as (image, variants) tuples.
+# Each source image is decoded once and every variant is produced from the shared array, being
+# encoded only when saved. Faults with a batch kernel are applied in a single pass to the images of
+# the batch that share a shape. Faulty images are written to their paths or, when in_memory is set,
+# returned as (faulty_image_path, bytes) tuples. Failed variants are returned as
+# (faulty_image_path, fault_name, error) tuples, so that a failing variant does not abort the
+# remaining ones. Returns an (artifacts, errors, timings) tuple per image, where timings lists the
+# (fault_name, seconds) injection times of its variants (a batch kernel's time is split among its
+# images). When a seed is given, the stochastic kernels (per-image or batch) draw the random values
+# of each image from a seed derived from it (see gen_fault_seed), so their faulty images do not
+# depend on the batches, and seeded kernels (e.g., fog) reuse their random assets per fault variant
+def inject_images_faults(task):
+    image_tasks, temp_dir, in_memory, seed, faulty_store = task
+    results = [([], [], []) for _ in image_tasks]
+    decoded_imgs = {}
+    batches = {}  # (variant, shape) -> indexes of the images
+    store_keys = {}  # (idx, variant) -> key in the faulty store
+
+    def store_data(idx, variant, data):
+        new_path = gen_faulty_image_path(temp_dir, image_tasks[idx][0].key, *variant)
+        if in_memory:
+            results[idx][0].append((new_path, data))
+        else:
+            with open(new_path, 'wb') as faulty_file:
+                faulty_file.write(data)
+
+    def store(idx, variant, faulty_img):
+        extension = os.path.splitext(image_tasks[idx][0].key)[1]
+        data = encode_image(faulty_img, extension)
+        if (idx, variant) in store_keys:
+            faulty_store.put(store_keys[(idx, variant)], data)
+        store_data(idx, variant, data)
+
+    def fail(idx, variant, err):
+        new_path = gen_faulty_image_path(temp_dir, image_tasks[idx][0].key, *variant)
+        results[idx][1].append((new_path, variant[0], format_error(err)))
+
+    for idx, (image, variants) in enumerate(image_tasks):
+        try:
+            with image.open() as image_file:
+                image_data = image_file.read()
+            if faulty_store is not None:
+                variants = reuse_faulty_images(
+                    faulty_store, image, image_data, variants, seed, store_keys, idx, store_data
+                )
+                if not variants:
+                    continue  # All the faulty images were stored
+            decoded_imgs[idx] = img = load_image(io.BytesIO(image_data))
+        except Exception as err:
+            for variant in variants:
+                fail(idx, variant, err)
+            continue
+
+        for variant in variants:
+            if len(image_tasks) > 1 and is_batch_fault(variant[0]):
+                batches.setdefault((variant, img.shape), []).append(idx)
+                continue
+            try:
+                start = time.perf_counter()
+                fault_seed = gen_fault_seed(seed, variant, image.key)
+                faulty_img = apply_fault(img, variant[0], variant[2], fault_seed)
+                if faulty_img is not None:
+                    store(idx, variant, faulty_img)
+                    results[idx][2].append((variant[0], time.perf_counter() - start))
+            except Exception as err:
+                fail(idx, variant, err)
+
+    for (variant, shape), indexes in batches.items():
+        seeds = [gen_fault_seed(seed, variant, image_tasks[idx][0].key) for idx in indexes]
+        try:
+            start = time.perf_counter()
+            batch = np.stack([decoded_imgs[idx] for idx in indexes])
+            faulty_batch = apply_fault_batch(batch, variant[0], variant[2], seeds)
+            for idx, faulty_img in zip(indexes, faulty_batch):
+                store(idx, variant, faulty_img)
+            image_seconds = (time.perf_counter() - start) / len(indexes)
+            for idx in indexes:
+                results[idx][2].append((variant[0], image_seconds))
+        except Exception as err:
+            for idx in indexes:
+                fail(idx, variant, err)
+
+    return results
+
+
+# Reuses the faulty images of an image already present in the faulty store, passing their bytes to
+# store_data. Returns the variants still to be injected, recording the store keys of those whose
+# faulty images are reproducible (so that they are stored once injected)
+def reuse_faulty_images(faulty_store, image, image_data, variants, seed, store_keys, idx,
+                        store_data):
+    source_hash = faulty_store.hash_source(image_data)
+    extension = os.path.splitext(image.key)[1]
+    pending_variants = []
+
+    for variant in variants:
+        if not is_reproducible_fault(variant[0], seed):
+            pending_variants.append(variant)
+            continue
+
+        # Deterministic faults do not depend on the seed, so their key is shared across seeds
+        key_seed = None if is_reproducible_fault(variant[0]) else seed
+        key = faulty_store.gen_key(source_hash, gen_fault_key(*variant), extension, key_seed)
+        data = faulty_store.get(key)
+        if data is not None:
+            store_data(idx, variant, data)
+        else:
+            store_keys[(idx, variant)] = key
+            pending_variants.append(variant)
+
+    return pending_variants
+
+
+# Applies mitigations to a faulty image (a path or its encoded bytes), decoding it once, and
+# returns the encoded mitigated images (one per mitigation)
+def mitigate_artifact(task):
+    faulty_image, mitigations, extension = task
+    faulty_file = open(faulty_image, 'rb') if isinstance(faulty_image, str) else \
+        io.BytesIO(faulty_image)
+    with faulty_file, warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        img = load_image(faulty_file)
+        return [encode_image(mitigate_image(img, mitigation), extension)
+                for mitigation in mitigations]
+
+
+# Runs a task in a process pool or, if there is no pool, in the calling thread
+def run_task(pool, func, task):
+    return func(task) if pool is None else pool.submit(func, task).result()
+
+
+# Runs tasks in a process pool (all submitted at once) or, if there is no pool, in the calling
+# thread, and returns their results in order
+def run_tasks(pool, func, tasks):
+    if pool is None:
+        return [func(task) for task in tasks]
+    futures = [pool.submit(func, task) for task in tasks]
+    return [future.result() for future in futures]
+
+
+# Creates a pool of worker processes and starts them right away (by running a task), so that they
+# are forked from the calling thread before other threads (pipeline stages, dispatchers, concurrent
+# experiments) may hold locks that the forked children would inherit in a locked state
+def create_process_pool(workers):
+    pool = ProcessPoolExecutor(max_workers=workers)
+    pool.submit(int).result()
+    return pool
+
+
+# Loads the modules and shared assets of the faults and mitigations of an experiment, so that the
+# worker processes forked afterwards inherit them
+def preload_experiment_assets(exp_config):
+    fault_names = set(fault['name'] for fault in exp_config['data_faults'])
+    preload_weather_masks(fault_names & set(WEATHER_MASK_FAULTS))
+    preload_fault_modules(fault_names)
+    preload_mitigation_modules(exp_config.get('mitigations', []))
+
+
+# Retrieves the number of workers of a pipeline stage from the experiment's 'pipeline' config
+# (e.g., {"inject_workers": 4}). The injection workers default to the 'injection_workers' setting
+def get_stage_workers(exp_config, stage, default_workers=DEFAULT_STAGE_WORKERS):
+    if stage == 'inject':
+        default_workers = exp_config.get('injection_workers', default_workers)
+    return exp_config.get('pipeline', {}).get(stage + '_workers', default_workers)
+
+
+# Runs an experiment as a pipeline in which every image flows through fault injection, mitigation
+# and prediction as soon as it is ready. The stages are connected by bounded queues (capping the
+# faulty images held in memory or in the workspace) and have their own number of workers, set in
+# the experiment's 'pipeline' config. CPU-bound stages run on the shared cpu_pool, if given, or on
+# their own process pools when they have more than one worker, and images are injected in batches
+# of 'inject_batch_size' images. The predictions of each image are appended to the checkpoint and
+# its faulty images deleted as soon as they are predicted. When a faulty_store is given, faulty
+# images stored by previous runs or experiments are reused instead of being injected again. With an
+# adaptive 'sweep_mode' (see sweep), the faults with several parameter values are searched for their
+# breaking values once the base predictions of an image are known, so only the values needed by the
+# searches are injected and predicted. With an early_stopping (see stopping), the fault variants
+# whose change rates are settled are no longer injected nor predicted, and no more images are read
+# once all of them are settled (the searched faults are not stopped). The stage durations, fault
+# injection times and processed images are recorded in metrics (see metrics.ExperimentMetrics),
+# and the progress is displayed with printer (see print_step) as the processed images are
+# recorded. Returns the keys of the images in dataset order
+def run_experiment(curr_experiment, exp_data, artifacts, dispatcher, checkpoint, cpu_pool=None,
+                   printer=print_step, faulty_store=None, metrics=None, early_stopping=None):
+    all_variants = gen_fault_variants(curr_experiment['data_faults'])
+    searched_variants = gen_searched_variants(curr_experiment)
+    sweep_mode = get_sweep_mode(curr_experiment)
+    variants = [variant for variant in all_variants if variant[0] not in searched_variants]
+    mitigations = curr_experiment.get('mitigations', [])
+    in_memory = isinstance(artifacts, MemoryArtifactStore)
+    queue_size = curr_experiment.get('pipeline', {}).get('queue_size', DEFAULT_QUEUE_SIZE)
+    seed = curr_experiment.get('seed')
+    fan_out = curr_experiment.get('mitigation_mode', RANDOM_MITIGATION) == ALL_MITIGATIONS
+    variant_keys = {
+        variant: gen_result_keys(curr_experiment, gen_fault_key(*variant))
+        for variant in all_variants
+    }
+    static_keys = [result_key for variant in variants for result_key in variant_keys[variant]]
+    services = get_services(curr_experiment)
+    dataset_len = len(exp_data) if hasattr(exp_data, '__len__') else '?'
+    image_keys = []
+    pools = []
+    inject_batches = itertools.count(1)
+    if metrics is None:
+        metrics = ExperimentMetrics(MetricsRegistry(), None, curr_experiment['provider'])
+
+    # Creates the process pool of a CPU-bound stage (None to run its tasks in the stage threads)
+    def create_pool(workers):
+        if cpu_pool is not None:
+            return cpu_pool
+        if workers <= 1:
+            return None
+        pools.append(create_process_pool(workers))
+        return pools[-1]
+
+    # Injects fault variants into images, given as (image, variants) tuples, into the artifact
+    # store. Returns the faulty images of each image, as (fault_key, faulty_image_path) tuples
+    def inject_variants(image_tasks):
+        task = (
+            image_tasks, artifacts.dir_path, in_memory, seed, faulty_store
+        )
+        image_faulty_images = []
+        for (image, image_variants), (image_artifacts, errors, timings) in zip(
+            image_tasks, run_task(inject_pool, inject_images_faults, task)
+        ):
+            for new_path, data in image_artifacts:
+                artifacts.put(new_path, data)
+            for fault_name, seconds in timings:
+                metrics.record_fault(fault_name, seconds)
+
+            failed_paths = set()
+            for new_path, fault_name, error in errors:
+                message = 'Failed to inject fault {} on {} ({})'.format(
+                    fault_name, image.key, error)
+                print(message, end='\n\n')
+                metrics.record_fault_error(fault_name)
+                failed_paths.add(new_path)
+
+            faulty_images = []
+            for variant in image_variants:
+                new_path = gen_faulty_image_path(artifacts.dir_path, image.key, *variant)
+                if new_path not in failed_paths and new_path in artifacts:
+                    faulty_images.append((gen_fault_key(*variant), new_path))
+            image_faulty_images.append(faulty_images)
+
+        return image_faulty_images
+
+    # Checks whether the change rates of a fault variant are settled for every service
+    def is_settled(variant):
+        return early_stopping is not None and all(
+            early_stopping.is_settled(result_key, service)
+            for result_key in variant_keys[variant] for service in services
+        )
+
+    # Checks whether every fault variant is settled, so that no more images need to be read
+    def is_stopped():
+        return early_stopping is not None and bool(variants) and not searched_variants and \
+            all(is_settled(variant) for variant in variants)
+
+    # Records the prediction changes of the faulty predictions of an image for the fault keys of
+    # the non-searched variants, given its base and faulty predictions
+    def record_changes(base_preds, fault_preds):
+        for fault_key in static_keys:
+            if fault_key in fault_preds:
+                flipped_services = get_flipped_services(base_preds, fault_preds[fault_key])
+                for service in fault_preds[fault_key]:
+                    early_stopping.record(fault_key, service, service in flipped_services)
+
+    # Retrieves the base predictions of an image, from its predictions or the checkpoint
+    def get_base_predictions(image, image_pred_object):
+        if 'base' in image_pred_object:
+            return image_pred_object['base']
+        return checkpoint.read(image.key, [])['base']
+
+    # Lists the searched faults of an image whose searches are not recorded in the checkpoint
+    def get_pending_searches(image):
+        return [
+            fault_name for fault_name in searched_variants
+            if not checkpoint.has_search(image.key, fault_name)
+        ]
+
+    # Stage 1: injects the pending fault variants of a batch of images into the artifact store
+    # (the variants of the searched faults are injected as their searches go, in the predict stage)
+    def inject(images):
+        image_tasks = []
+        for image in images:
+            if early_stopping is not None and image.key in checkpoint:
+                recorded = checkpoint.read(image.key, static_keys)  # Recorded by a previous run
+                if recorded['base']:
+                    record_changes(recorded['base'], recorded['faults'])
+            pending_variants = [
+                variant
+                for variant in get_pending_variants(image, variants, checkpoint, variant_keys)
+                if not is_settled(variant)
+            ]
+            predict_base = not checkpoint.has_base_predictions(image.key)
+            if pending_variants or predict_base or get_pending_searches(image):
+                image_tasks.append((image, pending_variants))  # Otherwise, already recorded
+        if not image_tasks:
+            return []
+
+        if faulty_store is not None and next(inject_batches) % FAULTY_STORE_EVICTION_INTERVAL == 0:
+            faulty_store.evict()
+
+        return [
+            (image, not checkpoint.has_base_predictions(image.key), faulty_images, {})
+            for (image, _), faulty_images in zip(image_tasks, inject_variants(image_tasks))
+        ]
+
+    # Stage 2: applies a mitigation (chosen per faulty image) or, in fan-out mode, every mitigation
+    # to the faulty images of an image, recording the mitigation applied to each result
+    def mitigate(job):
+        image, predict_base, faulty_images, applied_mitigations = job
+        tasks, assigned_mitigations = [], []
+        for fault_key, faulty_image_path in faulty_images:
+            extension = os.path.splitext(faulty_image_path)[1]
+            assigned = mitigations if fan_out else \
+                [choose_mitigation(mitigations, seed, image.key, fault_key)]
+            tasks.append((artifacts.source(faulty_image_path), assigned, extension))
+            assigned_mitigations.append(assigned)
+
+        mitigated_images = []
+        for (fault_key, faulty_image_path), assigned, mitigated_data in zip(
+            faulty_images, assigned_mitigations, run_tasks(mitigate_pool, mitigate_artifact, tasks)
+        ):
+            if not fan_out:
+                artifacts.put(faulty_image_path, mitigated_data[0])
+                mitigated_images.append((fault_key, faulty_image_path))
+                applied_mitigations[fault_key] = assigned[0]
+                continue
+
+            for mitigation, data in zip(assigned, mitigated_data):
+                result_key = gen_mitigated_key(fault_key, mitigation)
+                mitigated_path = gen_mitigated_image_path(faulty_image_path, mitigation)
+                artifacts.put(mitigated_path, data)
+                mitigated_images.append((result_key, mitigated_path))
+                applied_mitigations[result_key] = mitigation
+            artifacts.delete(faulty_image_path)  # Only its mitigated images are predicted
+
+        return image, predict_base, mitigated_images, applied_mitigations
+
+    # Stage 3: performs the pending base and faulty predictions of an image
+    def predict(job):
+        image, predict_base, faulty_images, applied_mitigations = job
+        base_future = dispatcher.submit(image.source) if predict_base else None
+        fault_futures = [
+            (fault_key, dispatcher.submit(artifacts.source(faulty_image_path)))
+            for fault_key, faulty_image_path in faulty_images
+        ]
 
         try:
-            for image_path in exp_data:
-                if not has_key(fault, 'parameter'):
-                    new_path = gen_faulty_image_path(image_path, fault_name)
-                    inject_fault(image_path, new_path, fault_name)  # Inject the fault
-                else:
-                    fault_param = fault['parameter']
-                    for param_value in fault_param['values']:
-                        # Inject the fault w/ parameter
-                        new_path = gen_faulty_image_path(
-                            image_path, fault_name, fault_param['name'], param_value
-                        )
-                        inject_fault(image_path, new_path, fault_name, param_value)
+            image_pred_object = {'key': image.key, 'faults': {}}
+            if base_future is not None:
+                image_pred_object['base'] = base_future.result()  # Base predictions
+
+            # Faulty predictions
+            for fault_key, fault_future in fault_futures:
+                image_pred_object['faults'][fault_key] = fault_future.result()
+            if applied_mitigations:
+                image_pred_object['mitigations'] = applied_mitigations
+            pending_searches = get_pending_searches(image)
+            if early_stopping is not None and image_pred_object['faults']:
+                record_changes(get_base_predictions(image, image_pred_object),
+                               image_pred_object['faults'])
+            if pending_searches:
+                search_faults(image, get_base_predictions(image, image_pred_object),
+                              pending_searches, image_pred_object)
         except BaseException:
-            print('Failed to inject fault {} on {}'.format(fault_name, image_path))
+            print('Failed to get predictions for image {}'.format(image.key))
             raise
 
-    print_step(INJECT_FAULTS, ['data faults', dataset_len], complete=True, extra_end='\n')
-
-
-# Applies a random mitigation for each faulty image
-def apply_mitigations(mitigations):
-    if (not len(mitigations)):
-        return
-
-    faulty_images = glob.glob(DEFAULT_TEMP_DIR + '*', recursive=True)
-    faulty_images_len = len(faulty_images)
-    secure_random = random.SystemRandom()
-
-    # Apply random mitigations to faulty images
-    for idx, faulty_image in enumerate(faulty_images):
-        step_str = ' (' + str(idx) + '/' + str(faulty_images_len) + ')'
-        print_step(APPLY_MITIGATIONS, [step_str], multistep=True)
-        random_mitigation = secure_random.choice(mitigations)
-        with warnings.catch_warnings():
-            warnings.simplefilter('ignore', category=RuntimeWarning)
-            apply_mitigation(faulty_image, random_mitigation)
-
-    print_step(APPLY_MITIGATIONS, [''], complete=True)
-
-
-# Performs the predictions (base + faulty) for all the data points in the experiment data
-def perform_predictions(curr_experiment, exp_data, service_client):
-    predictions = []
-    dataset_len = len(exp_data)
-
-    print_step(GET_PREDICTIONS, [' '])
-    for idx, image_path in enumerate(exp_data):
-        image_pred_object = {
-            'key': os.path.basename(image_path),
-            'base': [],
-            'faults': {}
+        return image_pred_object, faulty_images
+
+    # Searches the breaking values of faults for an image (see sweep.SeveritySearch), recording
+    # the evaluated faulty predictions and the outcome of each search in image_pred_object. Each
+    # round injects, mitigates and predicts the next value of every unfinished search at once, and
+    # a value breaks the predictions when any of its results differs from the base predictions of
+    # any service. The breaking value of each service is the lowest evaluated value that changed
+    # its predictions
+    def search_faults(image, base_preds, fault_names, image_pred_object):
+        searches = {
+            fault_name: SeveritySearch(
+                [variant[2] for variant in searched_variants[fault_name]], sweep_mode
+            )
+            for fault_name in fault_names
         }
+        flips = {fault_name: {} for fault_name in fault_names}  # Service -> flipping values
+        applied_mitigations = {}
+
+        while True:
+            round_variants = []
+            for fault_name, search in searches.items():
+                value = search.next_value()
+                if value is not None:
+                    round_variants.append(next(
+                        variant for variant in searched_variants[fault_name] if variant[2] == value
+                    ))
+            if not round_variants:
+                break
+
+            faulty_images = inject_variants([(image, round_variants)])[0]
+            if mitigations:
+                faulty_images = mitigate((image, False, faulty_images, applied_mitigations))[2]
+            fault_futures = [
+                (fault_key, faulty_image_path,
+                 dispatcher.submit(artifacts.source(faulty_image_path)))
+                for fault_key, faulty_image_path in faulty_images
+            ]
+            round_preds = {}
+            for fault_key, faulty_image_path, fault_future in fault_futures:
+                round_preds[fault_key] = fault_future.result()
+                artifacts.delete(faulty_image_path)  # Already predicted
+
+            for variant in round_variants:
+                fault_name, _, value = variant
+                result_keys = variant_keys[variant]
+                if not all(result_key in round_preds for result_key in result_keys):
+                    searches[fault_name].record(value, None)  # Injection failed
+                    continue
+
+                flipped_services = set()
+                for result_key in result_keys:
+                    image_pred_object['faults'][result_key] = round_preds[result_key]
+                    flipped_services.update(
+                        get_flipped_services(base_preds, round_preds[result_key])
+                    )
+                searches[fault_name].record(value, bool(flipped_services))
+                for service in flipped_services:
+                    flips[fault_name].setdefault(service, []).append(value)
+
+        image_pred_object['searches'] = {}
+        for fault_name, search in searches.items():
+            metrics.record_search(fault_name, len(search.evaluated), len(search.values))
+            image_pred_object['searches'][fault_name] = {
+                'evaluated': search.evaluated,
+                'breaking': {
+                    service: (
+                        min(flips[fault_name][service], key=search.values.index)
+                        if service in flips[fault_name] else None
+                    )
+                    for service in base_preds
+                }
+            }
+        if applied_mitigations:
+            image_pred_object.setdefault('mitigations', {}).update(applied_mitigations)
+
+    # Lists the image keys (in dataset order) as the images are read, grouping the images in
+    # batches for the injection stage. With an early_stopping, the images stop being read once
+    # every fault variant is settled (the images recorded by a previous run are still read)
+    def iter_image_batches():
+        batch = []
+        for image in exp_data:
+            if image.key not in checkpoint and is_stopped():
+                break
+            image_keys.append(image.key)
+            batch.append(image)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    # Load the shared fault assets before the worker processes are forked
+    preload_experiment_assets(curr_experiment)
+
+    batch_size = curr_experiment.get('pipeline', {}).get('inject_batch_size', 1)
+    inject_workers = get_stage_workers(curr_experiment, 'inject')
+    inject_pool = create_pool(inject_workers)
+    stages = [Stage('inject', metrics.time_stage('inject', inject), inject_workers, expand=True)]
+    if mitigations:
+        mitigate_workers = get_stage_workers(curr_experiment, 'mitigate')
+        mitigate_pool = create_pool(mitigate_workers)
+        stages.append(Stage('mitigate', metrics.time_stage('mitigate', mitigate), mitigate_workers))
+
+    # By default, enough images are predicted at a time to keep the dispatcher busy
+    predict_workers = get_stage_workers(curr_experiment, 'predict', max(2, dispatcher.concurrency))
+    stages.append(Stage('predict', metrics.time_stage('predict', predict), predict_workers))
+
+    # The progress display is a consumer of the processed images metric
+    if dataset_len != '?':
+        metrics.set_total_images(dataset_len)
+    progress_listener = metrics.add_progress_listener(
+        lambda processed: printer(PROCESS_IMAGES, [processed, dataset_len], multistep=True)
+    )
+    printer(PROCESS_IMAGES, [0, dataset_len])
+    try:
+        for image_pred_object, faulty_images in Pipeline(stages, queue_size).run(
+            iter_image_batches()
+        ):
+            checkpoint.append(image_pred_object)
+            for fault_key, faulty_image_path in faulty_images:
+                artifacts.delete(faulty_image_path)  # Already predicted
+            metrics.record_image()
+    except BaseException:
+        dispatcher.shutdown(cancel=True)
+        raise
+    finally:
+        metrics.registry.remove_listener(progress_listener)
+        for pool in pools:
+            pool.shutdown(cancel_futures=True)
+
+    printer(PROCESS_IMAGES, [len(image_keys), len(image_keys)], complete=True)
+    return image_keys
+
+
+# Prints a step of an experiment that runs concurrently with others. Only completed steps are
+# printed, as plain lines prefixed by the experiment name, since the terminal lines of concurrent
+# experiments cannot be updated in place
+def print_concurrent_step(experiment_name, message, parameters=[], complete=False, multistep=False,
+                          extra_end=''):
+    if complete:
+        print('[{}]'.format(experiment_name) + message.format(*parameters))
+
+
+# Launches a fault injection experiment in its own workspace (a temp dir unique to the run), so
+# that concurrent experiments, or concurrent runs of the tool, do not share their faulty images.
+# The experiment's metrics are recorded in metrics_registry (a registry of its own if not given)
+# and their summary is saved with the results. Raises a ValueError if the experiment's provider and
+# service are not supported
+def launch_experiment(experiment_name, curr_experiment, providers_config, cpu_pool=None,
+                      concurrent=False, metrics_registry=None):
+    printer = print_step
+    if concurrent:
+        printer = functools.partial(print_concurrent_step, experiment_name)
+        print('- Experiment "{}" started'.format(experiment_name))
+    else:
+        print('\n- Experiment: "{}"\n'.format(experiment_name))
 
-        step_str = ' (' + str((idx + 1)) + '/' + str(dataset_len) + ')'
-        print_step(GET_PREDICTIONS, [step_str], multistep=True)
-
+    # Check the sweep mode before any work starts
+    get_sweep_mode(curr_experiment)
+
+    # Get the configured dataset and setup the configured provider/service
+    exp_data = get_experiment_data(DEFAULT_DATASET_DIR, curr_experiment)
+    service_client = get_client(curr_experiment, providers_config)
+
+    # Set the faulty images store (in the workspace, deleted whatever the outcome, along with the
+    # client's threads and connections)
+    workspace = create_workspace(DEFAULT_TEMP_DIR, experiment_name)
+    try:
+        artifacts = create_artifact_store(curr_experiment, workspace)
+
+        # Open the predictions checkpoint, resuming it if configured
+        create_dir(curr_experiment['output_dir'])
+        checkpoint = Checkpoint(
+            gen_checkpoint_path(curr_experiment, experiment_name), experiment_name,
+            curr_experiment, resume=curr_experiment.get('resume', False)
+        )
+
+        # Inject data faults, apply mitigations and get the base and faulty predictions from
+        # service, image by image
+        early_stopping = EarlyStopping.from_config(curr_experiment)
+        metrics = ExperimentMetrics(
+            metrics_registry if metrics_registry is not None else MetricsRegistry(),
+            experiment_name, curr_experiment['provider']
+        )
+        cache = get_cache(curr_experiment, DEFAULT_CACHE_DIR)
+        metrics.watch_cache(cache)
+        dispatcher = get_dispatcher(
+            curr_experiment, providers_config, service_client, cache, metrics
+        )
+        faulty_store = create_faulty_store(
+            curr_experiment, DEFAULT_CACHE_DIR, get_faults_version()
+        )
         try:
-            # Get the base predictions
-            preds = get_predictions(curr_experiment, service_client, image_path)
-            image_pred_object['base'] = preds
-
-            # Get the faulty predictions
-            for idx, fault in enumerate(curr_experiment['data_faults']):
-                fault_name = fault['name']
-
-                if not has_key(fault, 'parameter'):
-                    faulty_image_path = gen_faulty_image_path(image_path, fault_name)
-                    preds = get_predictions(curr_experiment, service_client, faulty_image_path)
-                    image_pred_object['faults'][fault_name] = preds
-                else:
-                    fault_param = fault['parameter']
-                    for param_value in fault_param['values']:
-                        faulty_image_path = gen_faulty_image_path(
-                            image_path, fault_name, fault_param['name'], param_value
-                        )
-                        preds = get_predictions(curr_experiment, service_client, faulty_image_path)
-                        fault_key = fault_name + '-' + fault_param['name'] + '_' + str(param_value)
-                        image_pred_object['faults'][fault_key] = preds
-        except BaseException:
-            print('Failed to get predictions for image {}'.format(image_path))
-            raise
-
-        predictions.append(image_pred_object)
-
-    print_step(GET_PREDICTIONS, [''], complete=True)
-    return predictions  # Predictions (base + faulty)
-
-
-# Launches the configured fault injection experiments. Experiments are launched in the order they
-# are defined in the experiments configuration file
+            image_keys = run_experiment(
+                curr_experiment, exp_data, artifacts, dispatcher, checkpoint, cpu_pool, printer,
+                faulty_store, metrics, early_stopping
+            )
+        finally:
+            if faulty_store is not None:
+                faulty_store.evict()
+            dispatcher.shutdown()
+            cache.close()
+            checkpoint.close()
+            metrics.finish()
+    finally:
+        service_client.close()
+        delete_dir(workspace)
+    cache_stats = CACHE_STATS.format(cache.hits, cache.misses, cache.collapsed)
+    print('[{}]'.format(experiment_name) + cache_stats if concurrent else cache_stats)
+
+    # Save the experiment results
+    printer(SAVE_RESULTS)
+    save_results(curr_experiment, experiment_name, image_keys, checkpoint, metrics.summary(),
+                 early_stopping)
+    printer(SAVE_RESULTS, complete=True)
+
+
+# Launches the configured fault injection experiments. By default, experiments are launched one
+# after another, in the order they are defined in the experiments configuration file. The optional
+# 'scheduler' config runs up to 'max_concurrent_experiments' independent experiments at once, and
+# 'cpu_budget' sets a pool of worker processes shared by the CPU-bound stages of all experiments.
+# Concurrent experiments always share such a pool (of a worker per CPU by default), forked on the
+# main thread before the experiments start, as forking from the experiment threads may deadlock the
+# workers. The fault assets cache is shared by the experiments of a process, with the largest of
+# their 'asset_cache_mb' caps. Experiments of the same provider share its concurrency and rate
+# limits (see services), which are reset once the experiments end. The metrics of all experiments
+# are recorded in a registry, which the optional 'metrics' config writes to a Prometheus textfile
+# ('textfile') every 'interval' seconds during the run
 def launch_experiments(exp_config, providers_config):
     experiments = exp_config['experiments']
-    for experiment_name in experiments:
-        curr_experiment = experiments[experiment_name]
-        print('\n- Experiment: "{}"\n'.format(experiment_name))
-
-        # Setup the configured provider/service
-        service_client = get_client(curr_experiment, providers_config)
-        if service_client is None:
-            return
-
-        # Get the configured dataset and set the temp dir
-        exp_data = get_experiment_data(DEFAULT_DATASET_DIR, curr_experiment)
-        recreate_dir(DEFAULT_TEMP_DIR)
+    scheduler_config = exp_config.get('scheduler', {})
+    max_concurrent = scheduler_config.get('max_concurrent_experiments', 1)
+    cpu_budget = scheduler_config.get('cpu_budget')
+    if max_concurrent > 1 and not cpu_budget:
+        cpu_budget = os.cpu_count()
+
+    # Load the fault assets of all experiments before the shared worker processes are forked
+    configure_asset_cache(max(
+        experiment.get('asset_cache_mb', DEFAULT_ASSET_CACHE_MB)
+        for experiment in experiments.values()
+    ))
+    cpu_pool = None
+    if cpu_budget:
+        for experiment in experiments.values():
+            preload_experiment_assets(experiment)
+        cpu_pool = create_process_pool(cpu_budget)
+    metrics_registry = MetricsRegistry()
+    metrics_config = exp_config.get('metrics', {})
+    exporter = None
+    if 'textfile' in metrics_config:
+        exporter = MetricsExporter(
+            metrics_registry, metrics_config['textfile'],
+            metrics_config.get('interval', DEFAULT_EXPORT_INTERVAL)
+        ).start()
+
+    try:
+        if max_concurrent <= 1:
+            for experiment_name in experiments:
+                launch_experiment(
+                    experiment_name, experiments[experiment_name], providers_config, cpu_pool,
+                    metrics_registry=metrics_registry
+                )
+        else:
+            launch_concurrent_experiments(
+                experiments, providers_config, cpu_pool, max_concurrent, metrics_registry
+            )
+    finally:
+        if cpu_pool is not None:
+            cpu_pool.shutdown(cancel_futures=True)
+        if exporter is not None:
+            exporter.stop()
+        reset_providers()
 
-        # Inject data faults into the dataset
-        inject_faults(exp_data, curr_experiment['data_faults'])
-
-        if has_key(curr_experiment, 'mitigations'):
-            apply_mitigations(curr_experiment['mitigations'])
-
-        # Get the base and faulty predictions from service
-        predictions = perform_predictions(curr_experiment, exp_data, service_client)
+    print('\nAll experiments finished')
 
-        # Save the experiment results
-        print_step(SAVE_RESULTS)
-        save_results(curr_experiment, experiment_name, predictions)
-        print_step(SAVE_RESULTS, complete=True)
 
-    print('\nAll experiments finished')
+# Launches experiments concurrently, up to max_concurrent at a time. A failing experiment does not
+# stop the others; the first error is raised once all of them are finished
+def launch_concurrent_experiments(experiments, providers_config, cpu_pool, max_concurrent,
+                                  metrics_registry=None):
+    print()
+    with ThreadPoolExecutor(max_workers=max_concurrent) as executor:
+        futures = [
+            (experiment_name, executor.submit(
+                launch_experiment, experiment_name, experiments[experiment_name],
+                providers_config, cpu_pool, True, metrics_registry
+            ))
+            for experiment_name in experiments
+        ]
+
+    errors = []
+    for experiment_name, future in futures:
+        try:
+            future.result()
+        except BaseException as err:
+            print('[{}] Failed: {}'.format(experiment_name, format_error(err)))
+            errors.append(err)
+    if errors:
+        raise errors[0]
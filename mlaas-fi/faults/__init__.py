@@ -1 +1,5 @@
-from .faults import inject_fault
+from .assets import configure_asset_cache, preload_weather_masks
+from .batch import apply_fault_batch, is_batch_fault
+from .faults import ASSET_SEEDED_FAULTS, FAULT_KERNELS, apply_fault, get_faults_version
+from .faults import inject_fault, is_reproducible_fault, preload_fault_modules
+from .utils import encode_image, load_image, save_image
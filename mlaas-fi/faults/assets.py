@@ -0,0 +1,145 @@
+import os
+import threading
+import numpy as np
+
+from collections import OrderedDict
+from PIL import Image
+
+
+# Directory of the weather masks
+MASKS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'masks')
+
+# Default memory cap of the asset cache
+DEFAULT_ASSET_CACHE_MB = 256
+
+
+# In-process LRU cache of the assets used by the faults (decoded and resized weather masks,
+# plasma fractals), capped by the memory taken by the cached assets. The cache is a module-level
+# singleton, so assets loaded before a process pool is created (see preload_weather_masks) are
+# shared with the worker processes when they are forked
+class AssetCache:
+    def __init__(self, max_mb=DEFAULT_ASSET_CACHE_MB):
+        self.max_bytes = max_mb * 1024 * 1024
+        self.size = 0
+        self.assets = OrderedDict()
+        self.lock = threading.Lock()
+
+    # Retrieves an asset, creating (and caching) it with factory on a miss
+    def get(self, key, factory):
+        with self.lock:
+            if key in self.assets:
+                self.assets.move_to_end(key)
+                return self.assets[key][0]
+
+        asset = factory()
+        asset_size = get_asset_size(asset)
+        with self.lock:
+            if key not in self.assets and asset_size <= self.max_bytes:
+                self.assets[key] = (asset, asset_size)
+                self.size += asset_size
+                while self.size > self.max_bytes:
+                    _, (_, evicted_size) = self.assets.popitem(last=False)
+                    self.size -= evicted_size
+        return asset
+
+    # Changes the memory cap, evicting the least recently used assets above it
+    def resize(self, max_mb):
+        with self.lock:
+            self.max_bytes = max_mb * 1024 * 1024
+            while self.assets and self.size > self.max_bytes:
+                _, (_, evicted_size) = self.assets.popitem(last=False)
+                self.size -= evicted_size
+
+
+# Estimates the memory taken by an asset (an array or a PIL image)
+def get_asset_size(asset):
+    if isinstance(asset, np.ndarray):
+        return asset.nbytes
+    return asset.width * asset.height * len(asset.getbands())
+
+
+asset_cache = AssetCache()
+
+
+# Sets the memory cap of the asset cache
+def configure_asset_cache(max_mb):
+    asset_cache.resize(max_mb)
+
+
+# Retrieves a weather mask (e.g., 'frost') as an RGB PIL image, resized to size if given
+def get_weather_mask(condition, size=None):
+    if size is None:
+        def load_mask():
+            with Image.open(os.path.join(MASKS_DIR, condition + '.jpeg')) as mask:
+                return mask.convert('RGB')
+
+        return asset_cache.get(('mask', condition), load_mask)
+
+    return asset_cache.get(
+        ('mask', condition, tuple(size)), lambda: get_weather_mask(condition).resize(size)
+    )
+
+
+# Loads the weather masks into the asset cache, optionally resized to some sizes (e.g., the size
+# shared by all the images of a dataset)
+def preload_weather_masks(conditions, sizes=()):
+    for condition in conditions:
+        get_weather_mask(condition)
+        for size in sizes:
+            get_weather_mask(condition, size)
+
+
+# Generates a heightmap using the diamond-square algorithm, i.e., a square 2d array of side mapsize
+# (a power of two) with floats in [0, 1]. Port of imagecorruptions' plasma_fractal drawing its
+# random values from a numpy Generator
+def gen_plasma_fractal(mapsize, wibbledecay, rng):
+    assert (mapsize & (mapsize - 1) == 0)
+    maparray = np.empty((mapsize, mapsize), dtype=np.float64)
+    maparray[0, 0] = 0
+    stepsize = mapsize
+    wibble = 100
+
+    def wibbledmean(array):
+        return array / 4 + wibble * rng.uniform(-wibble, wibble, array.shape)
+
+    # For each square of points stepsize apart, calculate middle value as mean of points + wibble
+    def fillsquares():
+        cornerref = maparray[0:mapsize:stepsize, 0:mapsize:stepsize]
+        squareaccum = cornerref + np.roll(cornerref, shift=-1, axis=0)
+        squareaccum += np.roll(squareaccum, shift=-1, axis=1)
+        maparray[stepsize // 2:mapsize:stepsize,
+                 stepsize // 2:mapsize:stepsize] = wibbledmean(squareaccum)
+
+    # For each diamond of points stepsize apart, calculate middle value as mean of points + wibble
+    def filldiamonds():
+        drgrid = maparray[stepsize // 2:mapsize:stepsize, stepsize // 2:mapsize:stepsize]
+        ulgrid = maparray[0:mapsize:stepsize, 0:mapsize:stepsize]
+        ldrsum = drgrid + np.roll(drgrid, 1, axis=0)
+        lulsum = ulgrid + np.roll(ulgrid, -1, axis=1)
+        maparray[0:mapsize:stepsize, stepsize // 2:mapsize:stepsize] = wibbledmean(ldrsum + lulsum)
+        tdrsum = drgrid + np.roll(drgrid, 1, axis=1)
+        tulsum = ulgrid + np.roll(ulgrid, -1, axis=0)
+        maparray[stepsize // 2:mapsize:stepsize, 0:mapsize:stepsize] = wibbledmean(tdrsum + tulsum)
+
+    while stepsize >= 2:
+        fillsquares()
+        filldiamonds()
+        stepsize //= 2
+        wibble /= wibbledecay
+
+    maparray -= maparray.min()
+    return maparray / maparray.max()
+
+
+# Retrieves a plasma fractal. Seeded fractals are cached per (mapsize, wibbledecay, seed), so they
+# are reused by every image with the same shape, while unseeded ones are always generated anew
+def get_plasma_fractal(mapsize, wibbledecay, seed=None):
+    if seed is None:
+        return gen_plasma_fractal(mapsize, wibbledecay, np.random.default_rng())
+
+    def factory():
+        fractal = gen_plasma_fractal(mapsize, wibbledecay, np.random.default_rng(seed))
+        fractal.setflags(write=False)
+        return fractal
+
+    return asset_cache.get(('plasma', mapsize, wibbledecay, seed), factory)
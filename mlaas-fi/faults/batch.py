@@ -0,0 +1,104 @@
+import numpy as np
+
+from PIL import Image
+
+
+# Vectorized implementations of the cheap per-pixel faults over a batch of same-shaped images, i.e.
+# a stacked (N, H, W, C) uint8 array, processed in a single pass. They follow the per-image
+# semantics of the kernels in faults.kernels (imagecorruptions and scikit-image), drawing the
+# random values of each image from its own numpy Generator (rngs), so that the faulty image of an
+# image does not depend on the other images of its batch. Deterministic faults give exactly the
+# same output as their per-image kernels. The noise faults draw float32 noise, which halves their
+# memory traffic
+
+# Severity constants, as in imagecorruptions
+GAUSSIAN_NOISE_SCALES = [.08, .12, 0.18, 0.26, 0.38]
+IMPULSE_NOISE_AMOUNTS = [.03, .06, .09, 0.17, 0.27]
+BRIGHTNESS_SHIFTS = [.1, .2, .3, .4, .5]
+CONTRAST_FACTORS = [0.4, .3, .2, .1, .05]
+
+
+# Converts float images in [0, 1] back to uint8 as imagecorruptions does (scaling and truncating)
+def _to_ubyte(batch):
+    return np.uint8(np.clip(batch, 0, 1) * 255)
+
+
+def gaussian_noise(batch, rngs, severity=1):
+    c = GAUSSIAN_NOISE_SCALES[severity - 1]
+    noise = np.stack([rng.standard_normal(size=batch.shape[1:], dtype=np.float32) for rng in rngs])
+    noise *= c
+    noise += batch * np.float32(1 / 255.)
+    return _to_ubyte(noise)
+
+
+# Salt & pepper noise (imagecorruptions' impulse_noise): each value is replaced with probability
+# amount, by salt or pepper with equal probability. A single uniform draw decides both
+def sp_noise(batch, rngs, severity=1):
+    c = IMPULSE_NOISE_AMOUNTS[severity - 1]
+    draw = np.stack([rng.random(size=batch.shape[1:], dtype=np.float32) for rng in rngs])
+    batch = batch.copy()
+    batch[draw < c / 2] = 255
+    batch[(draw >= c / 2) & (draw < c)] = 0
+    return batch
+
+
+def brightness(batch, rngs, severity=1):
+    from skimage.color import hsv2rgb, rgb2hsv
+    c = BRIGHTNESS_SHIFTS[severity - 1]
+    batch = rgb2hsv(batch / 255.)
+    batch[..., 2] = np.clip(batch[..., 2] + c, 0, 1)
+    return _to_ubyte(hsv2rgb(batch))
+
+
+def contrast(batch, rngs, severity=1):
+    c = CONTRAST_FACTORS[severity - 1]
+    batch = batch / 255.
+    means = np.mean(batch, axis=(1, 2), keepdims=True)  # Per image and channel
+    return _to_ubyte((batch - means) * c + means)
+
+
+# Pepper noise over count / (H * W) of the values, which are set to black. Only the positions of
+# the (few) defective values are drawn, instead of a random value per pixel
+def defective_pixels(batch, rngs, count=1):
+    proportion = min(1, count / (batch.shape[1] * batch.shape[2]))
+    batch = batch.copy()
+    for img, rng in zip(batch, rngs):
+        n_defective = rng.binomial(img.size, proportion)
+        img.reshape(-1)[rng.choice(img.size, n_defective, replace=False)] = 0
+    return batch
+
+
+# Returns (N, H, W) luma images, exactly as PIL's 'L' conversion, converting the whole batch at
+# once as a single (N * H, W) image
+def grayscale(batch, rngs):
+    n, height, width, channels = batch.shape
+    tall_img = Image.fromarray(np.ascontiguousarray(batch).reshape(n * height, width, channels))
+    return np.asarray(tall_img.convert('L')).reshape(n, height, width)
+
+
+# Maps a data fault to its batch kernel and whether the kernel takes the fault parameter
+BATCH_FAULT_KERNELS = {
+    'brightness': (brightness, True),
+    'contrast': (contrast, True),
+    'defective_pixels': (defective_pixels, True),
+    'gaussian_noise': (gaussian_noise, True),
+    'grayscale': (grayscale, False),
+    'sp_noise': (sp_noise, True)
+}
+
+
+# Checks whether a data fault has a batch kernel
+def is_batch_fault(fault):
+    return fault in BATCH_FAULT_KERNELS
+
+
+# Applies a data fault to a batch of same-shaped RGB images, a (N, H, W, 3) uint8 array, and
+# returns the faulty batch. seeds are the seeds of the images' random values (None for fresh
+# entropy), e.g., derived from the image keys, so that an image gets the same faulty image in any
+# batch and through its per-image kernel (see faults.apply_fault)
+def apply_fault_batch(batch, fault, fault_parameter=None, seeds=None):
+    seeds = seeds if seeds is not None else [None] * len(batch)
+    rngs = [np.random.default_rng(seed) for seed in seeds]
+
+    kernel, parameterized = BATCH_FAULT_KERNELS[fault]
+    return kernel(batch, rngs, fault_parameter) if parameterized else kernel(batch, rngs)
@@ -1,45 +1,105 @@
-from .image import *
+from importlib import import_module
+from importlib.metadata import PackageNotFoundError, version
 
+from . import kernels
+from .utils import load_image, save_image
 
-# Injects a specific data fault in an image with the given parameters
-def inject_fault(image_path, new_image_path, fault, fault_parameter=None):
+
+# Maps a data fault to its array kernel and whether the kernel takes the fault parameter
+FAULT_KERNELS = {
     # Blur
-    if fault == 'gaussian_blur':
-        gaussian_blur(image_path, new_image_path, severity=fault_parameter)
-    elif fault == 'motion_blur':
-        motion_blur(image_path, new_image_path, severity=fault_parameter)
-    elif fault == 'zoom_blur':
-        zoom_blur(image_path, new_image_path, severity=fault_parameter)
+    'gaussian_blur': (kernels.gaussian_blur, True),
+    'motion_blur': (kernels.motion_blur, True),
+    'zoom_blur': (kernels.zoom_blur, True),
 
     # Noise
-    elif fault == 'gaussian_noise':
-        gaussian_noise(image_path, new_image_path, severity=fault_parameter)
-    elif fault == 'sp_noise':
-        sp_noise(image_path, new_image_path, severity=fault_parameter)
+    'gaussian_noise': (kernels.gaussian_noise, True),
+    'sp_noise': (kernels.sp_noise, True),
 
     # Weather-related image faults
-    elif fault == 'condensation':
-        condensation(image_path, new_image_path)
-    elif fault == 'fog':
-        fog(image_path, new_image_path, severity=fault_parameter)
-    elif fault == 'frost':
-        frost(image_path, new_image_path)
-    elif fault == 'rain_snow':
-        rain_snow(image_path, new_image_path, severity=fault_parameter)
+    'condensation': (kernels.condensation, False),
+    'fog': (kernels.fog, True),
+    'frost': (kernels.frost, False),
+    'rain_snow': (kernels.rain_snow, True),
 
     # Others
-    elif fault == 'brightness':
-        brightness(image_path, new_image_path, severity=fault_parameter)
-    elif fault == 'chromatic_aberration':
-        chromatic_aberration(image_path, new_image_path, factor=fault_parameter)
-    elif fault == 'contrast':
-        contrast(image_path, new_image_path, severity=fault_parameter)
-    elif fault == 'defective_pixels':
-        defective_pixels(image_path, new_image_path, count=fault_parameter)
-    elif fault == 'grayscale':
-        grayscale(image_path, new_image_path)
-    elif fault == 'pixelation':
-        pixelation(image_path, new_image_path, severity=fault_parameter)
-
-    else:
-        return
+    'brightness': (kernels.brightness, True),
+    'chromatic_aberration': (kernels.chromatic_aberration, True),
+    'contrast': (kernels.contrast, True),
+    'defective_pixels': (kernels.defective_pixels, True),
+    'grayscale': (kernels.grayscale, False),
+    'pixelation': (kernels.pixelation, True)
+}
+
+
+# Faults with random outputs (the others always produce the same faulty image from a source image).
+# Their kernels take the seed of their random values
+STOCHASTIC_FAULTS = [
+    'defective_pixels', 'fog', 'gaussian_noise', 'motion_blur', 'rain_snow', 'sp_noise'
+]
+
+# Stochastic faults whose random assets are reused per seed (see faults.assets), which are seeded
+# per fault variant instead of per image, so that all the images of a variant share the assets
+ASSET_SEEDED_FAULTS = ['fog']
+
+# Heavy modules imported by the kernels of the faults (per-image or batch) on first use, so that
+# importing the faults module is cheap and only the configured faults pay for their libraries
+CORRUPTION_FAULTS = [
+    'brightness', 'contrast', 'gaussian_blur', 'gaussian_noise', 'motion_blur', 'pixelation',
+    'rain_snow', 'sp_noise', 'zoom_blur'
+]
+FAULT_MODULES = {
+    **{fault: ['imagecorruptions'] for fault in CORRUPTION_FAULTS},
+    'brightness': ['imagecorruptions', 'skimage.color'],
+    'defective_pixels': ['skimage.util']
+}
+
+# Version of the fault kernels, to be bumped whenever a kernel changes its outputs
+FAULTS_VERSION = 2
+
+# Libraries whose versions affect the outputs of the fault kernels
+FAULT_LIBRARIES = ['imagecorruptions', 'numpy', 'Pillow', 'scikit-image']
+
+
+# Applies a specific data fault to a decoded image (see load_image) with the given parameter and
+# returns the faulty image array, or None if the fault is unknown
+def apply_fault(img, fault, fault_parameter=None, seed=None):
+    if fault not in FAULT_KERNELS:
+        return None
+
+    kernel, parameterized = FAULT_KERNELS[fault]
+    kwargs = {'seed': seed} if fault in STOCHASTIC_FAULTS else {}
+    return kernel(img, fault_parameter, **kwargs) if parameterized else kernel(img, **kwargs)
+
+
+# Imports the modules required by the kernels of the given faults, e.g., before the worker processes
+# are forked, so that they inherit the imported modules instead of importing them on their own
+def preload_fault_modules(faults):
+    for fault in faults:
+        for module_name in FAULT_MODULES.get(fault, []):
+            import_module(module_name)
+
+
+# Injects a specific data fault in an image with the given parameters
+def inject_fault(image_path, new_image_path, fault, fault_parameter=None):
+    faulty_img = apply_fault(load_image(image_path), fault, fault_parameter)
+    if faulty_img is not None:
+        save_image(faulty_img, new_image_path)
+
+
+# Checks whether a fault always produces the same faulty image from a source image, either because
+# it is deterministic or because its kernel draws its random values from the given seed
+def is_reproducible_fault(fault, seed=None):
+    return seed is not None or fault not in STOCHASTIC_FAULTS
+
+
+# Generates the version of the fault kernels and of the libraries they rely on (e.g.,
+# 'faults-1/imagecorruptions-1.1.2/numpy-1.23.1/...')
+def get_faults_version():
+    versions = ['faults-' + str(FAULTS_VERSION)]
+    for library in FAULT_LIBRARIES:
+        try:
+            versions.append(library + '-' + version(library))
+        except PackageNotFoundError:
+            versions.append(library + '-none')
+    return '/'.join(versions)
@@ -0,0 +1,134 @@
+import warnings
+import numpy as np
+
+from PIL import Image
+
+from . import batch
+from .assets import get_plasma_fractal
+from .utils import blend_weather_mask, corrupt_image
+
+
+# Fog parameters (plasma fractal scale and wibble decay) per severity, as in imagecorruptions
+FOG_PARAMS = [(1.5, 2), (2., 2), (2.5, 1.7), (2.5, 1.5), (3., 1.4)]
+
+
+# Array-in/array-out implementations of the image faults. Every kernel receives a decoded RGB
+# uint8 array (see faults.utils.load_image) and returns the faulty image as a uint8 array, so a
+# source image can be decoded once and shared by all of its fault variants. imagecorruptions and
+# scikit-image are imported on first use (see faults.FAULT_MODULES). The stochastic kernels take
+# the seed of their random values (None for fresh entropy); seeded noise faults run their batch
+# kernel (see faults.batch) on the image, so that an image gets the same faulty image either way
+
+
+# Applies a batch kernel to a single image, drawing its random values from seed
+def apply_batch_kernel(kernel, img, seed, parameter):
+    return kernel(img[np.newaxis], [np.random.default_rng(seed)], parameter)[0]
+
+
+def gaussian_blur(img, severity=1):
+    with warnings.catch_warnings():
+        warnings.simplefilter(action='ignore', category=FutureWarning)
+        return corrupt_image(img, 'gaussian_blur', severity)
+
+
+def motion_blur(img, severity=1, seed=None):
+    return corrupt_image(img, 'motion_blur', severity, seed)
+
+
+def zoom_blur(img, severity=1):
+    return corrupt_image(img, 'zoom_blur', severity)
+
+
+def gaussian_noise(img, severity=1, seed=None):
+    if seed is not None:
+        return apply_batch_kernel(batch.gaussian_noise, img, seed, severity)
+    return corrupt_image(img, 'gaussian_noise', severity)
+
+
+def sp_noise(img, severity=1, seed=None):
+    if seed is not None:
+        return apply_batch_kernel(batch.sp_noise, img, seed, severity)
+    return corrupt_image(img, 'impulse_noise', severity)
+
+
+def condensation(img):
+    return blend_weather_mask(img, 'condensation')
+
+
+# imagecorruptions' fog, with the plasma fractal taken from the asset cache when a seed is given
+def fog(img, severity=1, seed=None):
+    c = FOG_PARAMS[severity - 1]
+    height, width = img.shape[:2]
+    map_size = 1 << (max(height, width) - 1).bit_length()  # Next power of 2
+    plasma = get_plasma_fractal(map_size, c[1], seed)[:height, :width]
+
+    x = img / 255.
+    max_val = x.max()
+    x += c[0] * plasma[..., np.newaxis]
+    return np.uint8(np.clip(x * max_val / (max_val + c[0]), 0, 1) * 255)
+
+
+def frost(img):
+    return blend_weather_mask(img, 'frost')
+
+
+def rain_snow(img, severity=1, seed=None):
+    return corrupt_image(img, 'snow', severity, seed)
+
+
+def brightness(img, severity=1):
+    return corrupt_image(img, 'brightness', severity)
+
+
+# Implements simple chromatic aberration by altering the g and b channels of the image
+# Modification of https://github.com/yoonsikp/kromo
+def chromatic_aberration(img, factor=1):
+    img = Image.fromarray(img).convert('RGB')
+
+    r, g, b = img.split()
+    rdata = np.asarray(r)
+
+    # Apply the chromatic aberration
+    gfinal = g.resize((round((1 + 0.018 * factor) * rdata.shape[1]),
+                       round((1 + 0.018 * factor) * rdata.shape[0])), Image.ANTIALIAS)
+    bfinal = b.resize((round((1 + 0.044 * factor) * rdata.shape[1]),
+                       round((1 + 0.044 * factor) * rdata.shape[0])), Image.ANTIALIAS)
+
+    rwidth, rheight = r.size
+    gwidth, gheight = gfinal.size
+    bwidth, bheight = bfinal.size
+    rhdiff = (bheight - rheight) // 2
+    rwdiff = (bwidth - rwidth) // 2
+    ghdiff = (bheight - gheight) // 2
+    gwdiff = (bwidth - gwidth) // 2
+
+    # Centre the channels
+    new_img = Image.merge('RGB', (
+        r.crop((-rwdiff, -rhdiff, bwidth - rwdiff, bheight - rhdiff)),
+        gfinal.crop((-gwdiff, -ghdiff, bwidth - gwdiff, bheight - ghdiff)),
+        bfinal))
+    new_img = new_img.crop((rwdiff, rhdiff, rwidth + rwdiff, rheight + rhdiff))
+
+    return np.asarray(new_img)
+
+
+def contrast(img, severity=1):
+    return corrupt_image(img, 'contrast', severity)
+
+
+def defective_pixels(img, count=1, seed=None):
+    if seed is not None:
+        return apply_batch_kernel(batch.defective_pixels, img, seed, count)
+
+    from skimage.util import img_as_ubyte, random_noise
+    total_pixels = img.shape[0] * img.shape[1]
+    proportion = count / total_pixels
+    return img_as_ubyte(random_noise(img, mode='pepper', clip=True, amount=proportion))
+
+
+def grayscale(img):
+    return np.asarray(Image.fromarray(img).convert('L'))
+
+
+def pixelation(img, severity=1):
+    return corrupt_image(img, 'pixelate', severity)
@@ -1,24 +1,70 @@
+import io
+import threading
 import numpy as np
 
-from imagecorruptions import corrupt
 from PIL import Image
-from pkg_resources import resource_filename
+
+from .assets import get_weather_mask
+
+
+# Lock of numpy's global generator, which the seeded imagecorruptions calls seed temporarily
+global_rng_lock = threading.Lock()
+
+
+# Decodes an image (a path or a file-like object) into an RGB uint8 array
+def load_image(image):
+    with Image.open(image) as img:
+        return np.asarray(img.convert('RGB'))
+
+
+# Encodes an image array into the format implied by a file extension (e.g., '.jpg')
+def encode_image(img, extension):
+    img_format = Image.registered_extensions()[extension.lower()]
+    buffer = io.BytesIO()
+    Image.fromarray(img).save(buffer, img_format)
+    return buffer.getvalue()
+
+
+# Encodes an image array and saves it to a given path
+def save_image(img, image_path):
+    Image.fromarray(img).save(image_path)
+
+
+# Helper function for imagecorruptions (array in, array out). imagecorruptions (and scipy, which it
+# pulls in) is imported on first use, see faults.FAULT_MODULES. imagecorruptions draws its random
+# values from numpy's global generator, so with a seed the generator is seeded for the call (and
+# restored afterwards), under a lock as the injection threads share it
+def corrupt_image(img, corruption, severity, seed=None):
+    from imagecorruptions import corrupt
+    if seed is None:
+        return corrupt(img, corruption_name=corruption, severity=severity)
+
+    with global_rng_lock:
+        state = np.random.get_state()
+        np.random.seed(seed)
+        try:
+            return corrupt(img, corruption_name=corruption, severity=severity)
+        finally:
+            np.random.set_state(state)
 
 
 # Helper function for imagecorruptions
 def apply_img_corruption(image_path, new_image_path, corruption, severity):
-    img = np.asarray(Image.open(image_path))
-    img_corrupt = corrupt(img, corruption_name=corruption, severity=severity)
-    img_corrupt = Image.fromarray(img_corrupt)
-    img_corrupt.save(new_image_path)
+    img_corrupt = corrupt_image(load_image(image_path), corruption, severity)
+    save_image(img_corrupt, new_image_path)
 
 
 # Masks from:
 # - Condensation: https://github.com/francescosecci/Python_Image_Failures
 # - Frost: https://github.com/bethgelab/imagecorruptions
-def apply_weather_mask(image_path, new_image_path, condition):
-    mask_path = resource_filename(__name__, './masks/' + condition + '.jpeg')
-    img = Image.open(image_path).convert('RGB')
-    img_mask = Image.open(mask_path).convert('RGB').resize(img.size)
+# The decoded and resized masks are taken from the asset cache
+def blend_weather_mask(img, condition):
+    img = Image.fromarray(img).convert('RGB')
+    img_mask = get_weather_mask(condition, img.size)
     img_blend = Image.blend(img, img_mask, alpha=0.4)
-    img_blend.save(new_image_path)
+    return np.asarray(img_blend)
+
+
+def apply_weather_mask(image_path, new_image_path, condition):
+    img_blend = blend_weather_mask(load_image(image_path), condition)
+    save_image(img_blend, new_image_path)
@@ -1,19 +1,57 @@
-from constants import EXP_CONFIG_FILE, PROVIDERS_CONFIG_FILE
-from experiments import launch_experiments
-from utils import parse_json
+import time
 
+START_TIME = time.perf_counter()  # Before the other imports, to measure the startup time
 
-if __name__ == '__main__':
+import argparse  # noqa: E402
+import os  # noqa: E402
+import sys  # noqa: E402
+
+from constants import DEFAULT_DATASET_DIR, EXP_CONFIG_FILE, PROVIDERS_CONFIG_FILE  # noqa: E402
+from utils import create_dir, dump_json, parse_json  # noqa: E402
+
+
+# Commands of the fault injector. Each command imports the modules it needs when it runs, and the
+# providers' SDKs and the imaging libraries are only imported on first use (see services and
+# faults), so a command only pays for what it uses
+RUN_COMMAND = 'run'
+INJECT_COMMAND = 'inject-only'
+PREDICT_COMMAND = 'predict-only'
+VALIDATE_COMMAND = 'validate-config'
+
+
+# Prints the startup time of the tool (from the start of this script until a command starts its
+# work, including the imports of the command), when requested with --timing
+def report_startup(args):
+    if args.timing:
+        print('Startup: {:.3f}s ({})'.format(time.perf_counter() - START_TIME, args.command))
+
+
+# Parses the providers and experiments configs, keeping only the selected experiments (if any)
+def load_configs(args):
+    providers_config = parse_json(args.providers_config)
+    exp_config = parse_json(args.exp_config)
+    if args.experiments:
+        exp_config['experiments'] = {
+            experiment_name: exp_config['experiments'][experiment_name]
+            for experiment_name in args.experiments
+        }
+    return providers_config, exp_config
+
+
+# Runs the configured experiments (fault injection, mitigation and predictions)
+def run(args):
+    from experiments import launch_experiments
+    report_startup(args)
     print('Fault Injector for MLaaS v0.1')
 
     # Parse the providers config
-    providers_config = parse_json(PROVIDERS_CONFIG_FILE)
+    providers_config, exp_config = load_configs(args)
     n_provider_config = len(providers_config['providers'])
-    print('Found {} configured providers in {}'.format(n_provider_config, PROVIDERS_CONFIG_FILE))
+    print('Found {} configured providers in {}'.format(n_provider_config, args.providers_config))
 
     # Parse the experiments config
-    exp_config = parse_json(EXP_CONFIG_FILE)
-    print('Found {} experiments in {}'.format(len(exp_config), EXP_CONFIG_FILE))
+    n_experiments = len(exp_config['experiments'])
+    print('Found {} experiments in {}'.format(n_experiments, args.exp_config))
 
     # Launch experiments
     try:
@@ -21,3 +59,168 @@ if __name__ == '__main__':
     except BaseException as err:
         print('\nUnexpected Error: {}, {}\n'.format(err, type(err)))
         raise
+
+
+# Injects the faults of the configured experiments into their datasets, without predictions. The
+# faulty images are saved to <output_dir>/<experiment>-faulty/, as an experiment would produce them
+# (with the same seeds and fault kernels)
+def inject_only(args):
+    from experiments import gen_fault_variants, get_experiment_data
+    from faults import preload_fault_modules
+    report_startup(args)
+
+    _, exp_config = load_configs(args)
+    for experiment_name, experiment in exp_config['experiments'].items():
+        variants = gen_fault_variants(experiment['data_faults'])
+        preload_fault_modules(set(variant[0] for variant in variants))
+        output_dir = os.path.join(args.output_dir or experiment['output_dir'],
+                                  experiment_name + '-faulty')
+        create_dir(output_dir)
+        batch_size = experiment.get('pipeline', {}).get('inject_batch_size', 1)
+
+        images, n_faulty_images = [], 0
+        for image in get_experiment_data(DEFAULT_DATASET_DIR, experiment):
+            images.append(image)
+            if len(images) == batch_size:
+                n_faulty_images += inject_batch(images, variants, output_dir, experiment)
+                images = []
+        if images:
+            n_faulty_images += inject_batch(images, variants, output_dir, experiment)
+        print('[{}] Saved {} faulty images to {}'.format(
+            experiment_name, n_faulty_images, output_dir))
+
+
+# Injects fault variants into a batch of images, saving the faulty images to output_dir. Returns
+# the number of saved faulty images
+def inject_batch(images, variants, output_dir, experiment):
+    from experiments import inject_images_faults
+    image_tasks = [(image, variants) for image in images]
+    task = (image_tasks, output_dir, False, experiment.get('seed'), None)
+    n_faulty_images = 0
+    for image, (_, errors, _) in zip(images, inject_images_faults(task)):
+        for _, fault_name, error in errors:
+            print('Failed to inject fault {} on {} ({})'.format(fault_name, image.key, error))
+        n_faulty_images += len(variants) - len(errors)
+    return n_faulty_images
+
+
+# Predicts the images of a directory (e.g., the faulty images saved by inject-only) with the
+# provider and services of the configured experiments, without injecting faults. The predictions
+# are saved to <output_dir>/<experiment>-predictions-<timestamp>.json
+def predict_only(args):
+    from datasets import list_dataset_images
+    from services import reset_providers
+    report_startup(args)
+
+    providers_config, exp_config = load_configs(args)
+    images = list_dataset_images(args.images)
+    try:
+        predict_experiments(args, exp_config, providers_config, images)
+    finally:
+        reset_providers()
+
+
+# Predicts the images with the provider and services of each experiment (see predict_only)
+def predict_experiments(args, exp_config, providers_config, images):
+    from constants import DEFAULT_CACHE_DIR
+    from services import get_cache, get_client, get_dispatcher
+    for experiment_name, experiment in exp_config['experiments'].items():
+        client = get_client(experiment, providers_config)
+        cache = get_cache(experiment, DEFAULT_CACHE_DIR)
+        dispatcher = get_dispatcher(experiment, providers_config, client, cache)
+        try:
+            futures = [(image.key, dispatcher.submit(image.source)) for image in images]
+            predictions = {}
+            for key, future in futures:
+                try:
+                    predictions[key] = future.result()
+                except Exception as err:
+                    print('Failed to predict {} ({})'.format(key, err))
+        finally:
+            dispatcher.shutdown()
+            cache.close()
+            client.close()
+
+        output_dir = args.output_dir or experiment['output_dir']
+        create_dir(output_dir)
+        output_path = os.path.join(output_dir, '{}-predictions-{}.json'.format(
+            experiment_name, int(time.time())))
+        dump_json(output_path, {
+            'experiment': experiment_name,
+            'config': experiment,
+            'images': args.images,
+            'predictions': predictions
+        })
+        print('[{}] Saved the predictions of {} images to {}'.format(
+            experiment_name, len(predictions), output_path))
+
+
+# Validates the providers and experiments configs without running anything. Exits with status 1
+# if they have errors
+def validate(args):
+    from config import validate_config
+    report_startup(args)
+
+    providers_config, exp_config = load_configs(args)
+    errors = validate_config(exp_config, providers_config, DEFAULT_DATASET_DIR)
+    for experiment_name, error in errors:
+        print('[{}] {}'.format(experiment_name, error) if experiment_name else error)
+    if errors:
+        sys.exit(1)
+    print('{} experiments are valid'.format(len(exp_config['experiments'])))
+
+
+COMMANDS = {
+    RUN_COMMAND: run,
+    INJECT_COMMAND: inject_only,
+    PREDICT_COMMAND: predict_only,
+    VALIDATE_COMMAND: validate
+}
+
+
+# Adds the options common to all the commands to a parser. The options of the subcommands default
+# to SUPPRESS, so that they do not override the same options given before the command
+def add_common_arguments(parser, defaults=True):
+    def default(value):
+        return value if defaults else argparse.SUPPRESS
+
+    parser.add_argument('--exp-config', default=default(EXP_CONFIG_FILE),
+                        help='experiments config file')
+    parser.add_argument('--providers-config', default=default(PROVIDERS_CONFIG_FILE),
+                        help='providers config file')
+    parser.add_argument('--experiments', nargs='+', default=default(None),
+                        help='experiments to use (default: all)')
+    parser.add_argument('--timing', action='store_true', default=default(False),
+                        help='print the startup time')
+
+
+def parse_args():
+    common = argparse.ArgumentParser(add_help=False)
+    add_common_arguments(common, defaults=False)
+
+    # The common options are also accepted without a command, which runs the experiments
+    parser = argparse.ArgumentParser(description='Fault Injector for MLaaS')
+    add_common_arguments(parser)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser(RUN_COMMAND, parents=[common],
+                          help='run the experiments (default command)')
+    inject_parser = subparsers.add_parser(INJECT_COMMAND, parents=[common],
+                                          help='inject the faults of the experiments only')
+    inject_parser.add_argument('--output-dir', help='directory of the faulty images (default: '
+                                                    'the output_dir of each experiment)')
+    predict_parser = subparsers.add_parser(PREDICT_COMMAND, parents=[common],
+                                           help='predict a directory of images only')
+    predict_parser.add_argument('images', help='directory of the images to predict')
+    predict_parser.add_argument('--output-dir', help='directory of the predictions (default: '
+                                                     'the output_dir of each experiment)')
+    subparsers.add_parser(VALIDATE_COMMAND, parents=[common], help='validate the configs')
+
+    args = parser.parse_args()
+    if args.command is None:
+        args.command = RUN_COMMAND
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    COMMANDS[args.command](args)
@@ -0,0 +1,342 @@
+import bisect
+import os
+import tempfile
+import threading
+import time
+
+
+# Metrics recorded during the experiments, with their type and description
+STAGE_SECONDS = 'mlaasfi_stage_seconds'
+FAULT_SECONDS = 'mlaasfi_fault_injection_seconds'
+FAULT_ERRORS = 'mlaasfi_fault_errors_total'
+REQUEST_SECONDS = 'mlaasfi_request_seconds'
+REQUEST_ATTEMPTS = 'mlaasfi_request_attempts_total'
+RETRIES = 'mlaasfi_retries_total'
+PAYLOAD_BYTES = 'mlaasfi_payload_bytes_total'
+CACHE_LOOKUPS = 'mlaasfi_cache_lookups_total'
+IMAGES_PROCESSED = 'mlaasfi_images_processed_total'
+IMAGES_TOTAL = 'mlaasfi_images'
+EXPERIMENT_SECONDS = 'mlaasfi_experiment_seconds'
+SEARCHED_VALUES = 'mlaasfi_searched_values_total'
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+METRICS = {
+    STAGE_SECONDS: (HISTOGRAM, 'Duration of a pipeline stage per item'),
+    FAULT_SECONDS: (HISTOGRAM, 'Duration of a fault injection per image (kernel and encoding)'),
+    FAULT_ERRORS: (COUNTER, 'Failed fault injections'),
+    REQUEST_SECONDS: (HISTOGRAM, 'Latency of the requests to the provider'),
+    REQUEST_ATTEMPTS: (COUNTER, 'Request attempts to the provider, per outcome'),
+    RETRIES: (COUNTER, 'Retried requests, per error class'),
+    PAYLOAD_BYTES: (COUNTER, 'Bytes of the image payloads sent to the provider'),
+    CACHE_LOOKUPS: (COUNTER, 'Prediction cache lookups, per result'),
+    IMAGES_PROCESSED: (COUNTER, 'Images whose predictions were recorded'),
+    IMAGES_TOTAL: (GAUGE, 'Images of the dataset (when known)'),
+    EXPERIMENT_SECONDS: (GAUGE, 'Duration of the experiment'),
+    SEARCHED_VALUES: (COUNTER, 'Parameter values of the searched faults, evaluated or skipped')
+}
+
+# Upper bounds (in seconds) of the histogram buckets
+DEFAULT_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# Default interval (in seconds) between two writes of the Prometheus textfile
+DEFAULT_EXPORT_INTERVAL = 15
+
+# Permissions of the Prometheus textfile, readable by a collector running as another user
+TEXTFILE_MODE = 0o644
+
+
+# Histogram of observed values over fixed buckets (as Prometheus ones), keeping their count, sum
+# and maximum. Quantiles are estimated by interpolating within the buckets
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last bucket is +Inf
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def copy(self):
+        histogram = Histogram(self.buckets)
+        histogram.counts = list(self.counts)
+        histogram.count, histogram.sum, histogram.max = self.count, self.sum, self.max
+        return histogram
+
+    def quantile(self, q):
+        if not self.count:
+            return 0.
+        rank = q * self.count
+        cumulative = 0
+        for idx, bucket_count in enumerate(self.counts):
+            if cumulative + bucket_count >= rank and bucket_count:
+                lower = self.buckets[idx - 1] if idx else 0.
+                upper = self.buckets[idx] if idx < len(self.buckets) else self.max
+                return min(self.max, lower + (upper - lower) * (rank - cumulative) / bucket_count)
+            cumulative += bucket_count
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'mean': round(self.sum / self.count, 6) if self.count else 0.,
+            'p50': round(self.quantile(0.5), 6),
+            'p90': round(self.quantile(0.9), 6),
+            'p99': round(self.quantile(0.99), 6),
+            'max': round(self.max, 6)
+        }
+
+
+# Formats a label set as a Prometheus label string (e.g., '{experiment="exp_1",stage="inject"}')
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels
+    )
+    return '{' + ','.join('{}="{}"'.format(name, value) for name, value in escaped) + '}'
+
+
+# Thread-safe registry of the counters, gauges and histograms of a run, each series identified by a
+# metric name (see METRICS) and a label set. Collectors sample values kept elsewhere (e.g., the
+# prediction cache stats) when the metrics are read, and listeners are called on every counter or
+# gauge update (e.g., to display the progress)
+class MetricsRegistry:
+    def __init__(self):
+        self.values = {}  # (name, labels) -> counter/gauge value
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.collectors = {}  # (name, labels) -> function returning the value
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def __key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def __notify(self, name, labels, value):
+        for listener in self.listeners:
+            listener(name, labels, value)
+
+    def inc(self, name, value=1, **labels):
+        key = self.__key(name, labels)
+        with self.lock:
+            self.values[key] = total = self.values.get(key, 0) + value
+        self.__notify(name, labels, total)
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[self.__key(name, labels)] = value
+        self.__notify(name, labels, value)
+
+    def observe(self, name, value, **labels):
+        key = self.__key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def collect(self, name, func, **labels):
+        with self.lock:
+            self.collectors[self.__key(name, labels)] = func
+
+    def add_listener(self, listener):
+        with self.lock:
+            self.listeners = self.listeners + [listener]
+
+    def remove_listener(self, listener):
+        with self.lock:
+            self.listeners = [other for other in self.listeners if other is not listener]
+
+    # Lists the (name, labels, value) counter and gauge series and the (name, labels, histogram)
+    # histogram series, sorted by name and labels
+    def __snapshot(self):
+        with self.lock:
+            values = dict(self.values)
+            histograms = {key: histogram.copy() for key, histogram in self.histograms.items()}
+            collectors = dict(self.collectors)
+        values.update({key: func() for key, func in collectors.items()})
+        return sorted(values.items()), sorted(histograms.items(), key=lambda item: item[0])
+
+    # Summarizes the series whose labels include the given ones (e.g., an experiment), as a JSON
+    # object of series per metric name (without the filtered labels)
+    def summary(self, **labels):
+        def matches(series_labels):
+            return all(dict(series_labels).get(name) == value for name, value in labels.items())
+
+        def series(series_labels):
+            return {name: value for name, value in series_labels if name not in labels}
+
+        values, histograms = self.__snapshot()
+        summary = {}
+        for (name, series_labels), value in values:
+            if matches(series_labels):
+                summary.setdefault(name, []).append(
+                    {'labels': series(series_labels), 'value': value}
+                )
+        for (name, series_labels), histogram in histograms:
+            if matches(series_labels):
+                summary.setdefault(name, []).append(
+                    {'labels': series(series_labels), **histogram.summary()}
+                )
+        return summary
+
+    # Formats all the series in the Prometheus text exposition format
+    def to_prometheus(self):
+        values, histograms = self.__snapshot()
+        lines, described = [], set()
+
+        def describe(name):
+            if name not in described:
+                metric_type, description = METRICS.get(name, (GAUGE, name))
+                lines.append('# HELP {} {}'.format(name, description))
+                lines.append('# TYPE {} {}'.format(name, metric_type))
+                described.add(name)
+
+        for (name, labels), value in values:
+            describe(name)
+            lines.append('{}{} {}'.format(name, format_labels(labels), value))
+        for (name, labels), histogram in histograms:
+            describe(name)
+            cumulative = 0
+            for bound, bucket_count in zip(histogram.buckets + ['+Inf'], histogram.counts):
+                cumulative += bucket_count
+                bucket_labels = format_labels(labels + (('le', str(bound)),))
+                lines.append('{}_bucket{} {}'.format(name, bucket_labels, cumulative))
+            lines.append('{}_sum{} {}'.format(name, format_labels(labels), histogram.sum))
+            lines.append('{}_count{} {}'.format(name, format_labels(labels), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    # Writes the series to a Prometheus textfile (e.g., for the node exporter textfile collector).
+    # The file is replaced atomically, so a scrape never reads a partial file
+    def write_textfile(self, path):
+        dir_path = os.path.dirname(path) or '.'
+        os.makedirs(dir_path, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=dir_path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as textfile:
+                textfile.write(self.to_prometheus())
+            os.chmod(tmp_path, TEXTFILE_MODE)  # mkstemp creates the file readable by its owner only
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+
+# Writes the metrics of a registry to a Prometheus textfile every interval seconds, from a
+# background thread, and once more when stopped
+class MetricsExporter:
+    def __init__(self, registry, path, interval=DEFAULT_EXPORT_INTERVAL):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def __run(self):
+        while not self.stopped.wait(self.interval):
+            self.registry.write_textfile(self.path)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.registry.write_textfile(self.path)
+
+
+# Records the metrics of an experiment in a registry, labeled by the experiment and its provider.
+# It is passed to the services (see services.get_dispatcher), which report their requests through
+# record_request, record_attempt and record_retry
+class ExperimentMetrics:
+    def __init__(self, registry, experiment, provider):
+        self.registry = registry
+        self.experiment = experiment
+        self.provider = provider
+        self.start_time = time.monotonic()
+
+    def record_stage(self, stage, seconds):
+        self.registry.observe(STAGE_SECONDS, seconds, experiment=self.experiment, stage=stage)
+
+    # Wraps a pipeline stage function so that the duration of each call is recorded
+    def time_stage(self, stage, func):
+        def timed_func(item):
+            start = time.perf_counter()
+            try:
+                return func(item)
+            finally:
+                self.record_stage(stage, time.perf_counter() - start)
+        return timed_func
+
+    def record_fault(self, fault, seconds):
+        self.registry.observe(FAULT_SECONDS, seconds, experiment=self.experiment, fault=fault)
+
+    def record_fault_error(self, fault):
+        self.registry.inc(FAULT_ERRORS, experiment=self.experiment, fault=fault)
+
+    # Records a request sent to the provider: its latency and its payload size (in bytes)
+    def record_request(self, seconds, payload_bytes):
+        labels = {'experiment': self.experiment, 'provider': self.provider}
+        self.registry.observe(REQUEST_SECONDS, seconds, **labels)
+        self.registry.inc(PAYLOAD_BYTES, payload_bytes, **labels)
+
+    # Records the outcome of a request attempt: 'success', an error class (see services.retry) or
+    # 'circuit_open' for requests rejected by the provider's circuit breaker
+    def record_attempt(self, outcome):
+        self.registry.inc(REQUEST_ATTEMPTS, experiment=self.experiment, provider=self.provider,
+                          outcome=outcome)
+
+    def record_retry(self, error_class):
+        self.registry.inc(RETRIES, experiment=self.experiment, provider=self.provider,
+                          error_class=error_class)
+
+    # Records the outcome of the breaking value search of a fault for an image (see sweep): the
+    # number of evaluated parameter values out of the fault's values
+    def record_search(self, fault, evaluated, total):
+        self.registry.inc(SEARCHED_VALUES, evaluated, experiment=self.experiment, fault=fault,
+                          result='evaluated')
+        self.registry.inc(SEARCHED_VALUES, total - evaluated, experiment=self.experiment,
+                          fault=fault, result='skipped')
+
+    # Samples the lookups of a prediction cache whenever the metrics are read
+    def watch_cache(self, cache):
+        for result in ['hits', 'misses', 'collapsed']:
+            self.registry.collect(
+                CACHE_LOOKUPS, lambda result=result: getattr(cache, result),
+                experiment=self.experiment, result=result
+            )
+
+    def set_total_images(self, total):
+        self.registry.set(IMAGES_TOTAL, total, experiment=self.experiment)
+
+    def record_image(self):
+        self.registry.inc(IMAGES_PROCESSED, experiment=self.experiment)
+
+    # Calls listener with the number of processed images of the experiment whenever it changes
+    # (e.g., to display the progress). Returns the registered listener, to remove it later
+    def add_progress_listener(self, listener):
+        def on_update(name, labels, value):
+            if name == IMAGES_PROCESSED and labels.get('experiment') == self.experiment:
+                listener(value)
+        self.registry.add_listener(on_update)
+        return on_update
+
+    def finish(self):
+        self.registry.set(EXPERIMENT_SECONDS, round(time.monotonic() - self.start_time, 3),
+                          experiment=self.experiment)
+
+    # Summarizes the metrics of the experiment (see MetricsRegistry.summary)
+    def summary(self):
+        return self.registry.summary(experiment=self.experiment)
@@ -1 +1,2 @@
-from .mitigations import apply_mitigation
+from .mitigations import MITIGATION_KERNELS, apply_mitigation, mitigate_image
+from .mitigations import preload_mitigation_modules
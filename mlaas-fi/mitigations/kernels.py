@@ -0,0 +1,43 @@
+import io
+import numpy as np
+
+from PIL import Image
+
+
+# Array-in/array-out implementations of the mitigations. Every kernel receives a decoded RGB uint8
+# array and returns the mitigated image as a uint8 array. scikit-image is imported by the kernels
+# that use it, on first use (see mitigations.MITIGATION_MODULES)
+
+
+def bit_depth_reduction(img):
+    new_img = Image.fromarray(img).convert('P', palette=Image.ADAPTIVE, colors=200)
+    return np.asarray(new_img.convert('RGB'))
+
+
+def gaussian_filter(img):
+    from skimage.filters import _gaussian
+    from skimage.util import img_as_ubyte
+    return img_as_ubyte(_gaussian.gaussian(img, channel_axis=-1))
+
+
+def JPEG_compression(img):
+    buffer = io.BytesIO()
+    Image.fromarray(img).save(buffer, 'JPEG', quality=75)
+    buffer.seek(0)
+    return np.asarray(Image.open(buffer).convert('RGB'))
+
+
+def median_filter(img):
+    from skimage.filters import _median
+    from skimage.util import img_as_ubyte
+    return img_as_ubyte(_median.median(img))
+
+
+def wavelet_denoising(img):
+    from skimage.restoration import denoise_wavelet
+    from skimage.util import img_as_ubyte
+    return img_as_ubyte(
+        denoise_wavelet(
+            img, channel_axis=-1, method='BayesShrink', mode='soft', rescale_sigma=True
+        )
+    )
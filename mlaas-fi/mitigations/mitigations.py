@@ -1,17 +1,46 @@
-from .image import *
+from importlib import import_module
+
+from faults import load_image, save_image
+
+from . import kernels
+
+
+# Maps a mitigation technique to its array kernel
+MITIGATION_KERNELS = {
+    'bit_depth_reduction': kernels.bit_depth_reduction,
+    'gaussian_filter': kernels.gaussian_filter,
+    'jpeg_compression': kernels.JPEG_compression,
+    'median_filter': kernels.median_filter,
+    'wavelet_denoising': kernels.wavelet_denoising
+}
+
+
+# Heavy modules imported by the mitigation kernels on first use
+MITIGATION_MODULES = {
+    'gaussian_filter': ['skimage.filters', 'skimage.util'],
+    'median_filter': ['skimage.filters', 'skimage.util'],
+    'wavelet_denoising': ['skimage.restoration', 'skimage.util']
+}
+
+
+# Imports the modules required by the kernels of the given mitigations (see
+# faults.preload_fault_modules)
+def preload_mitigation_modules(mitigations):
+    for mitigation in mitigations:
+        for module_name in MITIGATION_MODULES.get(mitigation, []):
+            import_module(module_name)
+
+
+# Applies a mitigation technique to a decoded image and returns the mitigated image array, or the
+# image itself if the mitigation is unknown
+def mitigate_image(img, mitigation):
+    if mitigation not in MITIGATION_KERNELS:
+        return img
+    return MITIGATION_KERNELS[mitigation](img)
 
 
 # Applies a mitigation technique to a given image
 def apply_mitigation(image_path, mitigation):
-    if mitigation == 'bit_depth_reduction':
-        bit_depth_reduction(image_path)
-    elif mitigation == 'gaussian_filter':
-        gaussian_filter(image_path)
-    elif mitigation == 'jpeg_compression':
-        JPEG_compression(image_path)
-    elif mitigation == 'median_filter':
-        median_filter(image_path)
-    elif mitigation == 'wavelet_denoising':
-        wavelet_denoising(image_path)
-    else:
+    if mitigation not in MITIGATION_KERNELS:
         return
+    save_image(mitigate_image(load_image(image_path), mitigation), image_path)
@@ -0,0 +1,120 @@
+import queue
+import threading
+
+
+# Default capacity of the queues between pipeline stages
+DEFAULT_QUEUE_SIZE = 8
+
+# Interval (in seconds) at which blocked stage threads check whether the pipeline was aborted
+ABORT_CHECK_INTERVAL = 0.1
+
+# Marks the end of the items of a queue
+_END = object()
+
+
+# A pipeline stage: func is applied to every item by a number of worker threads. func returns the
+# item passed to the next stage, or None to drop the item. An expanding stage returns a list of
+# items instead, each one passed to the next stage
+class Stage:
+    def __init__(self, name, func, workers=1, expand=False):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.expand = expand
+
+
+# Streams items through a sequence of stages connected by bounded queues, so that every item flows
+# to the next stage as soon as it is ready and at most queue_size items wait between two stages.
+# Yields the outputs of the last stage in completion order. If a stage raises, the pipeline is
+# aborted and the error is raised to the consumer
+class Pipeline:
+    def __init__(self, stages, queue_size=DEFAULT_QUEUE_SIZE):
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=max(1, queue_size)) for _ in range(len(stages) + 1)]
+        self.aborted = threading.Event()
+        self.error = None
+        self.threads = []
+
+    def __put(self, target_queue, item):
+        while not self.aborted.is_set():
+            try:
+                target_queue.put(item, timeout=ABORT_CHECK_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __get(self, source_queue):
+        while not self.aborted.is_set():
+            try:
+                return source_queue.get(timeout=ABORT_CHECK_INTERVAL)
+            except queue.Empty:
+                continue
+        return _END
+
+    def __abort(self, err):
+        if self.error is None:
+            self.error = err
+        self.aborted.set()
+
+    def __feed(self, items):
+        try:
+            for item in items:
+                if not self.__put(self.queues[0], item):
+                    return
+            self.__put(self.queues[0], _END)
+        except BaseException as err:
+            self.__abort(err)
+
+    def __work(self, idx, stage, remaining_workers, lock):
+        in_queue, out_queue = self.queues[idx], self.queues[idx + 1]
+        try:
+            while True:
+                item = self.__get(in_queue)
+                if item is _END:
+                    self.__put(in_queue, _END)  # Let the sibling workers finish too
+                    break
+
+                output = stage.func(item)
+                outputs = output if stage.expand else [output]
+                if not all(self.__put(out_queue, output) for output in outputs
+                           if output is not None):
+                    break
+        except BaseException as err:
+            self.__abort(err)
+        finally:
+            with lock:
+                remaining_workers[0] -= 1
+                last_worker = remaining_workers[0] == 0
+            if last_worker:
+                self.__put(out_queue, _END)
+
+    def __start_thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def run(self, items):
+        self.__start_thread(self.__feed, items)
+        for idx, stage in enumerate(self.stages):
+            remaining_workers, lock = [stage.workers], threading.Lock()
+            for _ in range(stage.workers):
+                self.__start_thread(self.__work, idx, stage, remaining_workers, lock)
+
+        try:
+            while True:
+                output = self.__get(self.queues[-1])
+                if output is _END:
+                    break
+                yield output
+        except BaseException as err:
+            self.__abort(err)
+            raise
+        finally:
+            if self.error is None:
+                self.aborted.set()  # Stops the threads if the consumer stopped early
+            for thread in self.threads:
+                thread.join()
+
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,256 @@
+import array
+import json
+import os
+import shutil
+import sys
+import numpy as np
+
+from utils import parse_json
+
+
+# Results formats: a JSON document, or a columnar directory of NumPy arrays with interned labels
+JSON_FORMAT = 'json'
+COLUMNAR_FORMAT = 'columnar'
+
+# Version of the columnar layout, extension of the columnar results directories, and name of the
+# column of the base predictions
+COLUMNAR_VERSION = 1
+COLUMNAR_EXTENSION = '.results'
+BASE_COLUMN = 'base'
+
+# Files of a columnar results directory
+INDEX_FILE = 'index.json'
+LABEL_IDS_FILE = 'label_ids.npy'
+OFFSETS_FILE = 'offsets.npy'
+PRESENT_FILE = 'present.npy'
+MITIGATIONS_FILE = 'mitigations.npy'
+
+
+# Interns strings into a vocabulary, mapping each distinct string to an integer id
+class Vocabulary:
+    def __init__(self):
+        self.ids = {}
+        self.values = []
+
+    def intern(self, value):
+        value_id = self.ids.get(value)
+        if value_id is None:
+            value_id = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return value_id
+
+
+# Smallest unsigned integer type able to hold the ids of a vocabulary
+def get_id_dtype(vocabulary_size):
+    return np.uint16 if vocabulary_size <= np.iinfo(np.uint16).max else np.uint32
+
+
+# Builds the columnar layout of results: an index (the header of the results, the image keys,
+# columns and vocabularies) and NumPy arrays. The columns are the base predictions and the faulty
+# predictions of each fault key, and their labels are interned into a vocabulary and stored as ids
+# in label_ids, column after column, so that a column is a contiguous slice. The labels of image i
+# in column c are label_ids[offsets[c, i]:offsets[c, i + 1]], present[c, i] tells whether they were
+# recorded, and mitigations[c, i] is the id of the mitigation applied to the faulty image (-1 if
+# none). The breaking value searches of the images (see sweep), if any, are kept in the index. The
+# predictions are consumed one image at a time (as prediction objects of the JSON format). Returns
+# an (index, arrays) tuple
+def build_columnar_results(header, columns, predictions):
+    columns = [BASE_COLUMN, *columns]
+    column_idxs = {column: idx for idx, column in enumerate(columns)}
+    labels, mitigations = Vocabulary(), Vocabulary()
+    column_ids = [array.array('I') for _ in columns]
+    column_lengths = [array.array('q') for _ in columns]
+    present, applied_mitigations, image_keys = [], [], []
+    searches = {}
+
+    for pred_object in predictions:
+        image_keys.append(pred_object['key'])
+        if 'searches' in pred_object:
+            searches[pred_object['key']] = pred_object['searches']
+        image_present = np.zeros(len(columns), dtype=bool)
+        image_mitigations = np.full(len(columns), -1, dtype=np.int16)
+        image_preds = {BASE_COLUMN: pred_object['base'], **pred_object['faults']}
+        for column, column_preds in image_preds.items():
+            if column not in column_idxs:
+                continue
+            idx = column_idxs[column]
+            column_ids[idx].extend(labels.intern(label) for label in column_preds)
+            column_lengths[idx].append(len(column_preds))
+            image_present[idx] = True
+        for column, mitigation in pred_object.get('mitigations', {}).items():
+            if column in column_idxs:
+                image_mitigations[column_idxs[column]] = mitigations.intern(mitigation)
+
+        for idx in np.flatnonzero(~image_present):
+            column_lengths[idx].append(0)
+        present.append(image_present)
+        applied_mitigations.append(image_mitigations)
+
+    # Offsets of the images of each column in the concatenated label ids
+    lengths = np.array([np.frombuffer(lengths, dtype=np.int64) for lengths in column_lengths],
+                       dtype=np.int64).reshape(len(columns), len(image_keys))
+    offsets = np.zeros((len(columns), len(image_keys) + 1), dtype=np.int64)
+    np.cumsum(lengths, axis=1, out=offsets[:, 1:])
+    offsets += np.concatenate([[0], np.cumsum(offsets[:-1, -1])])[:, np.newaxis]
+    label_ids = np.concatenate(
+        [np.frombuffer(ids, dtype=np.uint32) for ids in column_ids] + [np.array([], np.uint32)]
+    ).astype(get_id_dtype(len(labels.values)))
+
+    index = {
+        **header,
+        'version': COLUMNAR_VERSION,
+        'images': image_keys,
+        'columns': columns,
+        'labels': labels.values,
+        'mitigations': mitigations.values
+    }
+    if searches:
+        index['searches'] = searches
+    arrays = {
+        LABEL_IDS_FILE: label_ids,
+        OFFSETS_FILE: offsets,
+        PRESENT_FILE: np.ascontiguousarray(
+            np.array(present, dtype=bool).reshape(len(image_keys), len(columns)).T
+        ),
+        MITIGATIONS_FILE: np.ascontiguousarray(
+            np.array(applied_mitigations, dtype=np.int16).reshape(len(image_keys), len(columns)).T
+        )
+    }
+    return index, arrays
+
+
+# Writes results in the columnar format (see build_columnar_results): a directory with the index
+# and a .npy file per array. The directory is written next to path and renamed once complete
+def write_columnar_results(path, header, columns, predictions):
+    index, arrays = build_columnar_results(header, columns, predictions)
+    tmp_path = path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    for file_name, values in arrays.items():
+        np.save(os.path.join(tmp_path, file_name), values)
+    with open(os.path.join(tmp_path, INDEX_FILE), 'w') as index_file:
+        json.dump(index, index_file)
+    os.replace(tmp_path, path)
+
+
+# Reader of columnar results (see write_columnar_results). The arrays are memory-mapped, so a
+# column (fault key) or an image is read without loading the whole results. Label ids may be
+# decoded through the labels vocabulary
+class ColumnarResults:
+    def __init__(self, path):
+        arrays = {
+            file_name: np.load(os.path.join(path, file_name), mmap_mode='r')
+            for file_name in [LABEL_IDS_FILE, OFFSETS_FILE, PRESENT_FILE, MITIGATIONS_FILE]
+        }
+        self.__setup(path, parse_json(os.path.join(path, INDEX_FILE)), arrays)
+
+    # Loads JSON results in the columnar layout, in memory (e.g., to analyze them)
+    @classmethod
+    def from_json(cls, json_path):
+        header = parse_json(json_path)
+        predictions = header.pop('predictions')
+        columns = list(dict.fromkeys(
+            fault_key for pred_object in predictions for fault_key in pred_object['faults']
+        ))
+        results = cls.__new__(cls)
+        results.__setup(json_path, *build_columnar_results(header, columns, predictions))
+        return results
+
+    def __setup(self, path, index, arrays):
+        self.path = path
+        self.index = index
+        self.labels = index['labels']
+        self.image_keys = index['images']
+        self.columns = index['columns']
+        self.image_idxs = {key: idx for idx, key in enumerate(self.image_keys)}
+        self.column_idxs = {column: idx for idx, column in enumerate(self.columns)}
+        self.label_ids = arrays[LABEL_IDS_FILE]
+        self.offsets = arrays[OFFSETS_FILE]
+        self.present = arrays[PRESENT_FILE]
+        self.mitigation_ids = arrays[MITIGATIONS_FILE]
+
+    def __len__(self):
+        return len(self.image_keys)
+
+    # Fault keys of the faulty predictions (i.e., the columns besides the base one)
+    @property
+    def fault_keys(self):
+        return self.columns[1:]
+
+    # Retrieves the label ids of a column as an (offsets, label ids) tuple, where the ids of image i
+    # are ids[offsets[i]:offsets[i + 1]] (for vectorized analyses)
+    def get_column_ids(self, column):
+        offsets = np.asarray(self.offsets[self.column_idxs[column]])
+        return offsets - offsets[0], self.label_ids[offsets[0]:offsets[-1]]
+
+    # Retrieves the label ids of an image in a column (None if not recorded)
+    def get_ids(self, image_key, column=BASE_COLUMN):
+        column_idx, image_idx = self.column_idxs[column], self.image_idxs[image_key]
+        if not self.present[column_idx, image_idx]:
+            return None
+        start, end = self.offsets[column_idx, image_idx:image_idx + 2]
+        return self.label_ids[start:end]
+
+    # Retrieves the labels of an image in a column (None if not recorded)
+    def get_labels(self, image_key, column=BASE_COLUMN):
+        ids = self.get_ids(image_key, column)
+        return None if ids is None else [self.labels[label_id] for label_id in ids]
+
+    # Retrieves the labels of every image in a column (a fault key or the base one), as a dict of
+    # labels per image key
+    def get_column(self, column):
+        column_idx = self.column_idxs[column]
+        offsets, ids = self.get_column_ids(column)
+        ids = np.asarray(ids)
+        present = np.asarray(self.present[column_idx])
+        return {
+            key: [self.labels[label_id] for label_id in ids[offsets[idx]:offsets[idx + 1]]]
+            for idx, key in enumerate(self.image_keys) if present[idx]
+        }
+
+    # Retrieves the prediction object of an image, as stored in the JSON results format
+    def get_image(self, image_key):
+        image_idx = self.image_idxs[image_key]
+        pred_object = {'key': image_key, 'base': self.get_labels(image_key), 'faults': {}}
+        mitigations = {}
+        for fault_key in self.fault_keys:
+            fault_labels = self.get_labels(image_key, fault_key)
+            if fault_labels is not None:
+                pred_object['faults'][fault_key] = fault_labels
+                mitigation_id = self.mitigation_ids[self.column_idxs[fault_key], image_idx]
+                if mitigation_id >= 0:
+                    mitigations[fault_key] = self.index['mitigations'][mitigation_id]
+        if mitigations:
+            pred_object['mitigations'] = mitigations
+        if image_key in self.index.get('searches', {}):
+            pred_object['searches'] = self.index['searches'][image_key]
+        return pred_object
+
+    # Iterates over the prediction objects of the images, in dataset order
+    def __iter__(self):
+        return (self.get_image(image_key) for image_key in self.image_keys)
+
+
+# Loads results in either format: a columnar results directory or a JSON results file
+def load_results(path):
+    return ColumnarResults(path) if os.path.isdir(path) else ColumnarResults.from_json(path)
+
+
+# Converts JSON results to the columnar format, in a directory next to the JSON file. Returns the
+# path of the directory
+def convert_json_results(json_path):
+    results = parse_json(json_path)
+    predictions = results.pop('predictions')
+    columns = list(dict.fromkeys(
+        fault_key for pred_object in predictions for fault_key in pred_object['faults']
+    ))
+    output_path = os.path.splitext(json_path)[0] + COLUMNAR_EXTENSION
+    write_columnar_results(output_path, results, columns, predictions)
+    return output_path
+
+
+if __name__ == '__main__':
+    # Converts the given JSON results files (e.g., python results.py results/exp_1-1660000000.json)
+    for json_path in sys.argv[1:]:
+        print('Converted {} to {}'.format(json_path, convert_json_results(json_path)))
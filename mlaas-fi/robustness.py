@@ -0,0 +1,266 @@
+import argparse
+import json
+import os
+import numpy as np
+
+from results import BASE_COLUMN, load_results
+
+
+# Robustness metrics of the faulty predictions against the base ones, averaged over the images:
+# - jaccard: Jaccard index of the label sets (1 when both are empty)
+# - precision: fraction of the faulty labels also in the base labels (1 when there are none)
+# - recall: fraction of the base labels also in the faulty labels (1 when there are none)
+# - flip_rate: fraction of images whose label set changed (e.g., a face detected/not-detected
+#   or an unsafe label appearing/disappearing)
+# - text_edit_distance: character edit distance between the base and faulty texts (lines joined
+#   by newlines), normalized by the length of the longest one (TEXT_DETECTION only)
+LABEL_METRICS = ['jaccard', 'precision', 'recall', 'flip_rate']
+TEXT_METRICS = ['text_edit_distance']
+TEXT_SERVICES = ['TEXT_DETECTION']
+
+# Columns identifying a row of scores, and default grouping of the aggregated scores
+SCORE_KEYS = ['experiment', 'provider', 'service', 'fault', 'parameter', 'value', 'mitigation']
+DEFAULT_AGGREGATION = ['fault']
+
+# Number of text pairs whose edit distances are computed at once
+EDIT_DISTANCE_CHUNK = 512
+
+# Number of set bits of each byte value
+POPCOUNT = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+
+# Splits a fault key into its fault name, parameter name, parameter value and mitigation (e.g.,
+# 'fog-severity_3+median_filter' into ('fog', 'severity', 3, 'median_filter'))
+def parse_fault_key(fault_key):
+    fault_key, _, mitigation = fault_key.partition('+')
+    fault, _, parameter = fault_key.partition('-')
+    parameter_name, _, value = parameter.rpartition('_')
+    if not parameter:
+        return fault, None, None, mitigation or None
+    try:
+        value = json.loads(value)
+    except ValueError:
+        pass
+    return fault, parameter_name, value, mitigation or None
+
+
+# Builds the label bitsets of a column of results, given its offsets and label ids: an array with
+# a row of packed bits per image, in which bit l is set if the image has the label of id l
+def gen_bitsets(offsets, label_ids, n_labels):
+    n_images = len(offsets) - 1
+    bits = np.zeros((n_images, max(1, n_labels)), dtype=bool)
+    rows = np.repeat(np.arange(n_images), np.diff(offsets))
+    bits[rows, np.asarray(label_ids, dtype=np.int64)] = True
+    return np.packbits(bits, axis=-1)
+
+
+# Counts the set bits of each row of packed bitsets (along the last axis)
+def count_bits(bitsets):
+    return POPCOUNT[bitsets].sum(axis=-1, dtype=np.int64)
+
+
+# Computes the label metrics of the images of several columns against the base column, from their
+# bitsets (columns x images x bytes and images x bytes). Returns a dict of columns x images arrays
+def score_bitsets(base_bitsets, fault_bitsets):
+    base_counts = count_bits(base_bitsets)
+    fault_counts = count_bits(fault_bitsets)
+    intersections = count_bits(fault_bitsets & base_bitsets)
+    unions = base_counts + fault_counts - intersections
+
+    def ratio(numerators, denominators):
+        return np.divide(numerators, denominators, out=np.ones(numerators.shape),
+                         where=denominators > 0)
+
+    return {
+        'jaccard': ratio(intersections, unions),
+        'precision': ratio(intersections, fault_counts),
+        'recall': ratio(intersections, np.broadcast_to(base_counts, intersections.shape)),
+        'flip_rate': (intersections != unions).astype(np.float64)
+    }
+
+
+# Encodes texts as a padded array of code points (padded with pad_value), with their lengths
+def encode_texts(texts, pad_value):
+    lengths = np.array([len(text) for text in texts], dtype=np.int64)
+    codes = np.full((len(texts), max(1, lengths.max(initial=0))), pad_value, dtype=np.int32)
+    for idx, text in enumerate(texts):
+        codes[idx, :len(text)] = np.frombuffer(text.encode('utf-32-le'), dtype=np.int32)
+    return codes, lengths
+
+
+# Computes the Levenshtein distances of pairs of texts, for many pairs at once: the rows of the
+# dynamic programming matrices of all pairs are computed together, each row in a few vectorized
+# operations (the insertions along a row are resolved with a cumulative minimum)
+def compute_edit_distances(sources, targets):
+    source_codes, source_lengths = encode_texts(sources, -1)
+    target_codes, target_lengths = encode_texts(targets, -2)
+    positions = np.arange(target_codes.shape[1] + 1)
+    prev_row = np.broadcast_to(positions, (len(sources), len(positions))).astype(np.int32)
+
+    for i in range(1, source_codes.shape[1] + 1):
+        costs = source_codes[:, i - 1:i] != target_codes
+        row = np.empty_like(prev_row)
+        row[:, 0] = i
+        row[:, 1:] = np.minimum(prev_row[:, 1:] + 1, prev_row[:, :-1] + costs)
+        row = np.minimum.accumulate(row - positions, axis=1) + positions
+        finished = source_lengths < i  # Rows past the end of a source are not used
+        row[finished] = prev_row[finished]
+        prev_row = row
+
+    return prev_row[np.arange(len(sources)), target_lengths]
+
+
+# Strips the common prefix and suffix of two texts, which do not change their edit distance
+def strip_common_ends(source, target):
+    prefix_length = len(os.path.commonprefix([source, target]))
+    source, target = source[prefix_length:], target[prefix_length:]
+    suffix_length = len(os.path.commonprefix([source[::-1], target[::-1]]))
+    return source[:len(source) - suffix_length], target[:len(target) - suffix_length]
+
+
+# Computes the edit distances of pairs of base and faulty texts, normalized by the length of the
+# longest text of each pair
+def score_texts(base_texts, fault_texts):
+    distances = np.zeros(len(base_texts))
+    pending = [
+        (idx, *strip_common_ends(base, fault))
+        for idx, (base, fault) in enumerate(zip(base_texts, fault_texts)) if base != fault
+    ]
+    pending.sort(key=lambda pair: (len(pair[1]), len(pair[2])))
+
+    # Pairs of similar lengths are computed together, to reduce the padding
+    for start in range(0, len(pending), EDIT_DISTANCE_CHUNK):
+        idxs, sources, targets = zip(*pending[start:start + EDIT_DISTANCE_CHUNK])
+        idxs = list(idxs)
+        max_lengths = [max(len(base_texts[idx]), len(fault_texts[idx])) for idx in idxs]
+        distances[idxs] = compute_edit_distances(sources, targets) / np.array(max_lengths)
+    return distances
+
+
+# Computes the normalized edit distances of the texts of the images in the given columns against
+# their base texts, as a columns x images array (0 for the images without predictions). The text
+# pairs of all the columns are computed together
+def score_text_columns(results, columns):
+    base_labels = results.get_column(BASE_COLUMN)
+    base_texts, fault_texts, positions = [], [], []
+    for column_idx, column in enumerate(columns):
+        for image_key, labels in results.get_column(column).items():
+            base_texts.append('\n'.join(base_labels[image_key]))
+            fault_texts.append('\n'.join(labels))
+            positions.append((column_idx, results.image_idxs[image_key]))
+
+    distances = np.zeros((len(columns), len(results.image_keys)))
+    if positions:
+        distances[tuple(np.array(positions).T)] = score_texts(base_texts, fault_texts)
+    return distances
+
+
+# Scores the faulty predictions of results (see results.load_results) against their base ones,
+# per fault key (i.e., per fault, parameter value and mitigation). Returns a list of rows with the
+# SCORE_KEYS, the number of scored images and the mean of each metric
+def score_results(results):
+    config = results.index.get('config', {})
+    service = config.get('service')
+    fault_keys = results.fault_keys
+    n_labels = len(results.labels)
+
+    offsets, label_ids = results.get_column_ids(BASE_COLUMN)
+    base_bitsets = gen_bitsets(offsets, label_ids, n_labels)
+    fault_bitsets = np.stack([
+        gen_bitsets(*results.get_column_ids(fault_key), n_labels) for fault_key in fault_keys
+    ]) if fault_keys else np.zeros((0, *base_bitsets.shape), dtype=np.uint8)
+    scores = score_bitsets(base_bitsets, fault_bitsets)
+
+    if service in TEXT_SERVICES:
+        scores['text_edit_distance'] = score_text_columns(results, fault_keys)
+
+    rows = []
+    for column_idx, fault_key in enumerate(fault_keys):
+        present = np.asarray(results.present[results.column_idxs[fault_key]])
+        fault, parameter, value, mitigation = parse_fault_key(fault_key)
+        row = {
+            'experiment': results.index.get('experiment'),
+            'provider': config.get('provider'),
+            'service': service,
+            'fault': fault,
+            'parameter': parameter,
+            'value': value,
+            'mitigation': mitigation,
+            'images': int(present.sum())
+        }
+        for metric, metric_scores in scores.items():
+            row[metric] = float(metric_scores[column_idx][present].mean()) if row['images'] \
+                else None
+        rows.append(row)
+
+    return rows
+
+
+# Aggregates rows of scores (e.g., of several results files, providers or services) by the given
+# score keys, averaging each metric over the images of the grouped rows. The other score keys are
+# kept when they are shared by all the grouped rows (e.g., the provider when grouping one
+# provider's results) and listed otherwise
+def aggregate_scores(rows, by=DEFAULT_AGGREGATION):
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(row[key] for key in by), []).append(row)
+
+    aggregated = []
+    for group_values, group_rows in groups.items():
+        aggregated_row = dict(zip(by, group_values))
+        for key in SCORE_KEYS:
+            if key not in by:
+                values = list(dict.fromkeys(row[key] for row in group_rows))
+                aggregated_row[key] = values[0] if len(values) == 1 else values
+        aggregated_row['images'] = sum(row['images'] for row in group_rows)
+
+        for metric in LABEL_METRICS + TEXT_METRICS:
+            scored_rows = [row for row in group_rows if row.get(metric) is not None]
+            images = sum(row['images'] for row in scored_rows)
+            if images:
+                aggregated_row[metric] = sum(
+                    row[metric] * row['images'] for row in scored_rows
+                ) / images
+        aggregated.append(aggregated_row)
+
+    return aggregated
+
+
+# Formats rows of scores as a text table, with the given score keys and the metrics they have
+def format_scores(rows, keys):
+    metrics = [metric for metric in LABEL_METRICS + TEXT_METRICS
+               if any(metric in row for row in rows)]
+    header = keys + ['images'] + metrics
+    lines = [header] + [
+        [str(row.get(key)) for key in keys + ['images']] + [
+            '{:.4f}'.format(row[metric]) if row.get(metric) is not None else '-'
+            for metric in metrics
+        ]
+        for row in rows
+    ]
+    widths = [max(len(line[idx]) for line in lines) for idx in range(len(header))]
+    return '\n'.join(
+        '  '.join(cell.ljust(width) for cell, width in zip(line, widths)) for line in lines
+    )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Scores the robustness of MLaaS services from '
+                                                 'experiment results (JSON or columnar)')
+    parser.add_argument('results', nargs='+', help='results files or columnar directories')
+    parser.add_argument('--by', nargs='+', choices=SCORE_KEYS, default=None,
+                        help='score keys to aggregate by (default: one row per fault key)')
+    parser.add_argument('--output', help='JSON file to save the scores to')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    rows = [row for path in args.results for row in score_results(load_results(path))]
+    if args.by:
+        rows = aggregate_scores(rows, args.by)
+
+    print(format_scores(rows, args.by or SCORE_KEYS))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(rows, output_file)
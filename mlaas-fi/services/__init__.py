@@ -1 +1,2 @@
-from .services import get_client, get_predictions
+from .services import get_cache, get_client, get_dispatcher, get_predictions, get_services
+from .services import is_supported, reset_providers, submit_predictions
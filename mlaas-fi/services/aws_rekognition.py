@@ -1,7 +1,9 @@
+from importlib.metadata import version
+
 from boto3 import client
 from botocore.config import Config
 
-from .utils import RETRY_TIMES
+from .utils import as_payload_type, read_image_payload
 
 
 # Default labels for nudity and violence
@@ -10,8 +12,17 @@ VIOLENCE_LABELS = ['Violence', 'Visually Disturbing']
 
 
 class AWSRekognition:
-    def __init__(self, aws_config):
-        config = Config(retries={'max_attempts': RETRY_TIMES, 'mode': 'standard'})
+    # Client version (part of the prediction cache keys)
+    VERSION = 'boto3-' + version('boto3')
+
+    # A Rekognition client may be given in place of the configured one (e.g., a fake client)
+    def __init__(self, aws_config, rekognition_client=None):
+        if rekognition_client is not None:
+            self.client = rekognition_client
+            return
+
+        # boto3 retries are disabled, as failed requests are retried by the dispatcher
+        config = Config(retries={'total_max_attempts': 1, 'mode': 'standard'})
         self.client = client(
             'rekognition',
             aws_access_key_id=aws_config['access_key_id'],
@@ -35,11 +46,6 @@ class AWSRekognition:
         label_names = [response_label['Name'] for response_label in response_labels]
         return label_names
 
-    # Detects adult and suggestive content in an image
-    # Leveraged API: detect_moderation_labels from boto3
-    def __detect_nudity(self, img):
-        return self.__detect_unsafe_labels(img, unsafe_labels=NUDITY_LABELS)
-
     # Detects text occurrences (lines only) in an image
     # Leveraged API: detect_text from boto3
     def __detect_text(self, img):
@@ -50,25 +56,25 @@ class AWSRekognition:
         ]
         return texts_content
 
-    # Detects unsafe content, defined by the unsafe_labels parameter, in an image
-    # Supported unsafe labels: explicit nudity, suggestive, violence, visually disturbing, rude
-    #                          gestures, drugs, tobacco, alcohol, gambling, hate symbols
+    # Lists the moderation labels of an image (shared by the nudity and violence services)
     # Leveraged API: detect_moderation_labels from boto3
-    def __detect_unsafe_labels(self, img, unsafe_labels=None):
+    def __detect_moderation_labels(self, img):
         response = self.client.detect_moderation_labels(Image=img)
-        response_labels = response['ModerationLabels']
+        return response['ModerationLabels']
+
+    # Filters the unsafe content, defined by the unsafe_labels parameter, in moderation labels
+    # Supported unsafe labels: explicit nudity, suggestive, violence, visually disturbing, rude
+    #                          gestures, drugs, tobacco, alcohol, gambling, hate symbols
+    @staticmethod
+    def __filter_unsafe_labels(moderation_labels, unsafe_labels=None):
         label_names = [
-            resp_label['Name'] for resp_label in response_labels if unsafe_labels is not None and (
+            resp_label['Name'] for resp_label in moderation_labels
+            if unsafe_labels is not None and (
                 resp_label['Name'] in unsafe_labels or resp_label['ParentName'] in unsafe_labels
             )
         ]
         return label_names
 
-    # Detects violence (labels 'Violence', 'Visually Disturbing') in an image
-    # Leveraged API: detect_moderation_labels from boto3
-    def __detect_violence(self, img):
-        return self.__detect_unsafe_labels(img, unsafe_labels=VIOLENCE_LABELS)
-
     # Recognizes a single celebrity in an image (other celebrities found are not returned)
     # Leveraged API: recognize_celebrities from boto3
     def __recognize_celebrities(self, img):
@@ -78,20 +84,46 @@ class AWSRekognition:
         celebrities_ids = celebrities_ids[:1]  # Return only a single celebrity
         return celebrities_ids
 
-    # Run an AWS Rekognition service for a given image
-    def run_service(self, service, image):
+    # Counts the Rekognition calls made for an image by run_services: one per service, except for
+    # the nudity and violence services, which share a moderation call
+    @staticmethod
+    def count_requests(services):
+        moderation_services = ['NUDITY_DETECTION', 'VIOLENCE_DETECTION']
+        n_moderation = int(any(service in moderation_services for service in services))
+        return n_moderation + len([s for s in services if s not in moderation_services])
+
+    # Run AWS Rekognition services for a given image (a path, the image bytes or a buffer),
+    # returning the predictions per service. The nudity and violence services (labels 'Explicit
+    # Nudity', 'Suggestive' and 'Violence', 'Visually Disturbing') share a moderation request
+    def run_services(self, services, image):
         # Map a service to a prediction function
         service_map = {
             'CELEBRITY_RECOGNITION': self.__recognize_celebrities,
             'FACE_DETECTION': self.__detect_faces,
             'LABEL_DETECTION': self.__detect_labels,
-            'NUDITY_DETECTION': self.__detect_nudity,
-            'VIOLENCE_DETECTION': self.__detect_violence,
             'TEXT_DETECTION': self.__detect_text
         }
+        moderation_map = {'NUDITY_DETECTION': NUDITY_LABELS, 'VIOLENCE_DETECTION': VIOLENCE_LABELS}
+
+        # Apply the functions to the given image
+        # boto3 takes bytes and bytearray blobs as they are
+        img_payload = {'Bytes': as_payload_type(read_image_payload(image), (bytes, bytearray))}
+        outputs = {}
+        if any(service in moderation_map for service in services):
+            moderation_labels = self.__detect_moderation_labels(img_payload)
+        for service in services:
+            if service in moderation_map:
+                outputs[service] = self.__filter_unsafe_labels(
+                    moderation_labels, moderation_map[service]
+                )
+            else:
+                outputs[service] = service_map[service](img_payload)
+        return outputs
+
+    # Run an AWS Rekognition service for a given image (a path, the image bytes or a buffer)
+    def run_service(self, service, image):
+        return self.run_services([service], image)[service]
 
-        # Apply the function to the given image
-        with open(image, 'rb') as img_file:
-            img_payload = {'Bytes': img_file.read()}
-        output = service_map[service](img_payload)
-        return output
+    # Nothing to release: the boto3 client holds no threads of its own
+    def close(self):
+        pass
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+from concurrent.futures import Future
+
+
+# Number of insertions between two eviction passes
+EVICTION_INTERVAL = 100
+
+# Seconds to wait for the lock of a cache file shared with other processes or experiments
+LOCK_TIMEOUT = 60
+
+
+# Persistent, content-addressed cache of predictions backed by SQLite. Entries are keyed by the
+# hash of the image bytes, the provider, the service and the client version, so byte-identical
+# images (e.g., base images shared by experiments) are only sent once to a service. Entries are
+# evicted by age and, least recently used first, by the total size of the stored predictions. The
+# cache also collapses concurrent requests for the same key into a single call, whose predictions
+# are shared through a future
+class PredictionCache:
+    def __init__(self, path=':memory:', max_size_mb=None, max_age_days=None):
+        self.max_size = max_size_mb * 1024 * 1024 if max_size_mb is not None else None
+        self.max_age = max_age_days * 24 * 3600 if max_age_days is not None else None
+        self.hits = 0
+        self.misses = 0
+        self.collapsed = 0
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.insertions = 0
+
+        # Concurrent experiments may share the cache file: writers wait for the lock (up to
+        # LOCK_TIMEOUT seconds) and WAL mode lets readers proceed during writes
+        self.db = sqlite3.connect(path, timeout=LOCK_TIMEOUT, check_same_thread=False)
+        if path != ':memory:':
+            self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS predictions (key TEXT PRIMARY KEY, predictions TEXT, '
+            'size INTEGER, created REAL, accessed REAL)'
+        )
+        self.db.execute('CREATE INDEX IF NOT EXISTS accessed_idx ON predictions (accessed)')
+        self.evict()
+
+    # Generates the cache key of an image payload for a provider, service and client version
+    @staticmethod
+    def gen_key(payload, provider, service, client_version):
+        image_hash = hashlib.sha256(payload).hexdigest()
+        return '/'.join([image_hash, provider, service, client_version])
+
+    def __lookup(self, key):
+        query = 'SELECT predictions FROM predictions WHERE key = ?'
+        row = self.db.execute(query, (key,)).fetchone()
+        if row is None:
+            return None
+        # Committed right away, as an open write transaction would lock out the other writers of a
+        # shared cache file
+        self.db.execute('UPDATE predictions SET accessed = ? WHERE key = ?', (time.time(), key))
+        self.db.commit()
+        return json.loads(row[0])
+
+    def __store(self, key, predictions):
+        content = json.dumps(predictions)
+        now = time.time()
+        self.db.execute(
+            'INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?)',
+            (key, content, len(content), now, now)
+        )
+        self.db.commit()
+        self.insertions += 1
+
+    # Removes the entries older than the max age and the least recently used entries above the
+    # max size
+    def evict(self):
+        with self.lock:
+            if self.max_age is not None:
+                self.db.execute(
+                    'DELETE FROM predictions WHERE created < ?', (time.time() - self.max_age,)
+                )
+            if self.max_size is not None:
+                total_size = self.db.execute('SELECT SUM(size) FROM predictions').fetchone()[0]
+                rows = self.db.execute('SELECT key, size FROM predictions ORDER BY accessed')
+                evicted_keys = []
+                for key, size in rows:
+                    if total_size is None or total_size <= self.max_size:
+                        break
+                    evicted_keys.append((key,))
+                    total_size -= size
+                self.db.executemany('DELETE FROM predictions WHERE key = ?', evicted_keys)
+            self.db.commit()
+
+    # Returns a future of the predictions for a key: the cached predictions, the future of an
+    # identical request in flight, or otherwise the future returned by submit, whose predictions
+    # are cached once done
+    def get_or_submit(self, key, submit):
+        with self.lock:
+            predictions = self.__lookup(key)
+            if predictions is not None:
+                self.hits += 1
+                future = Future()
+                future.set_result(predictions)
+                return future
+
+            future = self.in_flight.get(key)
+            if future is not None:
+                self.collapsed += 1
+                return future
+            self.misses += 1
+            future = self.in_flight[key] = Future()
+
+        def complete(submitted):
+            err = submitted.exception()
+            with self.lock:
+                if err is None:
+                    self.__store(key, submitted.result())
+                self.in_flight.pop(key, None)
+            if err is None:
+                future.set_result(submitted.result())
+            else:
+                future.set_exception(err)
+
+            if err is None and self.insertions % EVICTION_INTERVAL == 0:
+                self.evict()
+
+        try:
+            submit().add_done_callback(complete)
+        except BaseException as err:
+            with self.lock:
+                self.in_flight.pop(key, None)
+            future.set_exception(err)
+        return future
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,267 @@
+import contextlib
+import threading
+import time
+
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+from .retry import THROTTLING, TRANSIENT, FATAL, CircuitOpenError, RetryPolicy, classify_error
+
+
+# Default dispatch settings of a provider (a single request at a time, no rate limit)
+DEFAULT_CONCURRENCY = 1
+DEFAULT_REQUESTS_PER_SECOND = None
+
+# Minimum interval between two throttling slowdowns (so that a burst of 429s halves the limits
+# once), and lower bound of the adaptive request rate, as a fraction of the configured one
+SLOWDOWN_INTERVAL = 1
+MIN_RATE_FRACTION = 0.05
+
+
+# Token bucket rate limiter: tokens are refilled at a constant rate (requests per second) up to
+# the bucket capacity, and each API call consumes one token, blocking while none is available
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1, rate))
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    # Changes the refill rate (tokens already in the bucket are kept)
+    def set_rate(self, rate):
+        with self.lock:
+            self.__refill()
+            self.rate = float(rate)
+
+    def __refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    # Consumes tokens if available, returning 0, otherwise returns the seconds until they are. A
+    # request costing more tokens than the bucket capacity waits for a full bucket and leaves it in
+    # debt, so that the following requests wait for the tokens it overdrew
+    def try_acquire(self, tokens=1):
+        with self.lock:
+            self.__refill()
+            required = min(tokens, self.capacity)
+            if self.tokens >= required:
+                self.tokens -= tokens
+                return 0
+            return (required - self.tokens) / self.rate
+
+    # Blocks until the given number of tokens is available and consumes them
+    def acquire(self, tokens=1):
+        while True:
+            wait_time = self.try_acquire(tokens)
+            if not wait_time:
+                return
+            time.sleep(wait_time)
+
+
+# Adaptive concurrency (and rate) limiter, with an additive-increase/multiplicative-decrease
+# policy: a throttled request halves the number of requests allowed in flight and the request rate,
+# while each run of successful requests as long as the current limit raises the limit by one and
+# the rate by a tenth of the configured one, up to their configured values
+class AdaptiveLimiter:
+    def __init__(self, max_concurrency, bucket=None):
+        self.max_concurrency = max_concurrency
+        self.limit = max_concurrency
+        self.in_flight = 0
+        self.successes = 0
+        self.last_slowdown = 0
+        self.bucket = bucket
+        self.max_rate = bucket.rate if bucket is not None else None
+        self.cond = threading.Condition()
+
+    # Blocks until a request is allowed in flight
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= self.limit:
+                self.cond.wait()
+            self.in_flight += 1
+
+    # Releases a request, adapting the limits to whether it was throttled
+    def release(self, throttled=False):
+        with self.cond:
+            self.in_flight -= 1
+            if throttled:
+                self.__slow_down()
+            else:
+                self.__speed_up()
+            self.cond.notify_all()
+
+    def __slow_down(self):
+        self.successes = 0
+        now = time.monotonic()
+        if now - self.last_slowdown < SLOWDOWN_INTERVAL:
+            return
+
+        self.last_slowdown = now
+        self.limit = max(1, self.limit // 2)
+        if self.bucket is not None:
+            self.bucket.set_rate(max(self.max_rate * MIN_RATE_FRACTION, self.bucket.rate / 2))
+
+    def __speed_up(self):
+        self.successes += 1
+        if self.successes < self.limit:
+            return
+
+        self.successes = 0
+        self.limit = min(self.max_concurrency, self.limit + 1)
+        if self.bucket is not None and self.bucket.rate < self.max_rate:
+            self.bucket.set_rate(min(self.max_rate, self.bucket.rate + self.max_rate / 10))
+
+
+# Creates the adaptive limiter of a provider's concurrency and requests per second
+def create_limiter(concurrency=DEFAULT_CONCURRENCY,
+                   requests_per_second=DEFAULT_REQUESTS_PER_SECOND):
+    bucket = TokenBucket(requests_per_second) if requests_per_second else None
+    return AdaptiveLimiter(max(1, concurrency), bucket)
+
+
+# Dispatches prediction requests to a service client over a thread pool, keeping the number of
+# requests in flight under the provider's concurrency and their rate under its requests per second.
+# The limits are enforced by the given limiter, which may be shared by the dispatchers of several
+# experiments of a provider. Failed requests are retried according to the retry policy (see
+# services.retry): throttled requests shrink the concurrency and rate limits, and transient
+# failures are recorded by the provider's circuit breaker, if any. The outcomes of the attempts and
+# the retries are reported to metrics (see metrics.ExperimentMetrics), if given. A prediction
+# making several API calls (cost, e.g., a call per service) consumes a rate token per call, while
+# calls batching several predictions (cost 0) take their tokens as they are sent. The limits only
+# apply to the calls actually sent: predict(image, limit) wraps them in limit(), so that
+# predictions served by a cache take no rate tokens nor concurrency slots, and returns a future of
+# the predictions, so that their long-running operations hold neither a slot nor a thread
+class PredictionDispatcher:
+    def __init__(self, predict, concurrency=DEFAULT_CONCURRENCY,
+                 requests_per_second=DEFAULT_REQUESTS_PER_SECOND, retry_policy=None,
+                 circuit_breaker=None, limiter=None, metrics=None, cost=1):
+        self.predict = predict
+        self.cost = cost
+        self.concurrency = max(1, concurrency)
+        self.limiter = limiter if limiter is not None else \
+            create_limiter(concurrency, requests_per_second)
+        self.bucket = self.limiter.bucket
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.circuit_breaker = circuit_breaker
+        self.metrics = metrics
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        self.pending = set()  # Futures of the submitted predictions not done yet
+        self.lock = threading.Lock()
+
+    # Applies the provider's limits to the calls of a prediction: the circuit breaker, the rate
+    # tokens of the calls and a concurrency slot, recording their outcome in the limiter and the
+    # circuit breaker
+    @contextlib.contextmanager
+    def __limit(self):
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.before_call()
+        if self.bucket is not None and self.cost:
+            self.bucket.acquire(self.cost)
+
+        self.limiter.acquire()
+        try:
+            yield
+        except BaseException as err:
+            error_class = classify_error(err)[0]
+            self.limiter.release(throttled=error_class == THROTTLING)
+            self.__record(error_class)
+            raise
+
+        self.limiter.release()
+        self.__record(None)
+
+    def __report(self, outcome):
+        if self.metrics is not None:
+            self.metrics.record_attempt(outcome)
+
+    # Records the outcome of a request (its error class, None on success) in the circuit breaker.
+    # Only successes close it and only transient errors count as failures, while throttled and
+    # rejected requests (fatal errors, e.g., a 400 or 403) count as neither: they reached a live
+    # endpoint without showing that it serves requests
+    def __record(self, error_class):
+        if self.circuit_breaker is None:
+            return
+        if error_class is None:
+            self.circuit_breaker.record_success()
+        elif error_class == TRANSIENT:
+            self.circuit_breaker.record_failure()
+        else:
+            self.circuit_breaker.record_ignored()
+
+    # Runs an attempt of a prediction. predict returns a future of the predictions, which completes
+    # the prediction's future (or retries it) through a callback, so that no dispatcher thread waits
+    # for long-running operations (e.g., Azure Read results)
+    def __run(self, image, future, attempt):
+        try:
+            predictions = self.predict(image, self.__limit)
+        except BaseException as err:
+            self.__fail(image, future, attempt, err)
+            return
+        predictions.add_done_callback(
+            lambda done: self.__complete(image, future, attempt, done)
+        )
+
+    def __complete(self, image, future, attempt, predictions):
+        err = predictions.exception()
+        if err is not None:
+            self.__fail(image, future, attempt, err)
+            return
+        self.__report('success')
+        future.set_result(predictions.result())
+
+    # Retries a failed attempt after its backoff delay, unless the error is fatal, the circuit is
+    # open or the attempts are exhausted, which fail the prediction
+    def __fail(self, image, future, attempt, err):
+        if isinstance(err, CircuitOpenError):
+            self.__report('circuit_open')
+            future.set_exception(err)
+            return
+
+        error_class, retry_after = classify_error(err)
+        self.__report(error_class)
+        if error_class == FATAL or attempt >= self.retry_policy.max_attempts:
+            future.set_exception(err)
+            return
+
+        delay = self.retry_policy.get_delay(attempt, retry_after)
+        if self.metrics is not None:
+            self.metrics.record_retry(error_class)
+        print('Got %s error %s, retrying in %.1fs' % (type(err).__name__, err, delay))
+        try:
+            self.executor.submit(self.__retry, image, future, attempt + 1, delay)
+        except RuntimeError:  # Shut down
+            future.set_exception(err)
+
+    def __retry(self, image, future, attempt, delay):
+        time.sleep(delay)
+        self.__run(image, future, attempt)
+
+    def __start(self, image, future):
+        if future.set_running_or_notify_cancel():
+            self.__run(image, future, 1)
+
+    # Submits a prediction request for an image, returning a future of its predictions
+    def submit(self, image):
+        future = Future()
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self.__discard)
+        self.executor.submit(self.__start, image, future)
+        return future
+
+    def __discard(self, future):
+        with self.lock:
+            self.pending.discard(future)
+
+    # Shuts the dispatcher down once the submitted predictions are done, or right away with cancel,
+    # cancelling the predictions not started yet
+    def shutdown(self, cancel=False):
+        with self.lock:
+            pending = list(self.pending)
+        if cancel:
+            for future in pending:
+                future.cancel()
+        else:
+            wait(pending)
+        self.executor.shutdown(wait=True, cancel_futures=cancel)
@@ -0,0 +1,441 @@
+import argparse
+import collections
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+import uuid
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from .dispatcher import TokenBucket
+
+
+# Default address of the fake Azure server (port 0 picks a free port)
+DEFAULT_FAKE_HOST = '127.0.0.1'
+DEFAULT_FAKE_PORT = 0
+
+# Default HTTP statuses of the injected errors, and maximum Read operations kept by the server
+DEFAULT_ERROR_STATUSES = [500, 503]
+MAX_READ_OPERATIONS = 10000
+
+# gRPC status of the injected per-image errors of the fake Google client (UNAVAILABLE)
+IMAGE_ERROR_GRPC_STATUS = 14
+
+# Number of distinct fake labels, text lines and celebrities
+FAKE_VOCABULARY_SIZE = 32
+
+
+# Samples a latency (in seconds) from a latency config, i.e., a distribution and its parameters
+# (in milliseconds), optionally capped by 'max_ms':
+# - {"distribution": "constant", "ms": 100}
+# - {"distribution": "uniform", "min_ms": 50, "max_ms": 150}
+# - {"distribution": "exponential", "mean_ms": 100}
+# - {"distribution": "lognormal", "median_ms": 100, "sigma": 0.5}
+def sample_latency(latency_config, rng):
+    distribution = latency_config.get('distribution', 'constant')
+    if distribution == 'constant':
+        latency = latency_config.get('ms', 0)
+    elif distribution == 'uniform':
+        latency = rng.uniform(latency_config.get('min_ms', 0), latency_config['max_ms'])
+    elif distribution == 'exponential':
+        mean = latency_config.get('mean_ms', 0)
+        latency = rng.expovariate(1 / mean) if mean else 0
+    elif distribution == 'lognormal':
+        latency = rng.lognormvariate(math.log(latency_config['median_ms']),
+                                     latency_config.get('sigma', 0.5))
+    else:
+        raise ValueError('Unknown latency distribution: ' + distribution)
+
+    if distribution != 'uniform' and 'max_ms' in latency_config:
+        latency = min(latency, latency_config['max_ms'])
+    return max(0, latency) / 1000
+
+
+# Derives the content of an image, as seen by the fakes, from the hash of its bytes: the number of
+# faces, labels, text lines, a celebrity and the adult, racy and violence likelihoods (from 0 to 5,
+# as the Google Vision ones). Identical images get identical predictions
+def gen_fake_content(payload):
+    digest = hashlib.sha256(payload).digest()
+    return {
+        'faces': digest[0] % 3,
+        'labels': sorted({'label-' + str(value % FAKE_VOCABULARY_SIZE) for value in digest[1:6]}),
+        'lines': ['text-' + str(value % FAKE_VOCABULARY_SIZE)
+                  for value in digest[6:6 + digest[6] % 4]],
+        'celebrity': ('celebrity-' + str(digest[10] % FAKE_VOCABULARY_SIZE)
+                      if digest[10] % 2 else None),
+        'adult': digest[11] % 6,
+        'racy': digest[12] % 6,
+        'violence': digest[13] % 6
+    }
+
+
+# Behavior shared by the fakes of a provider (the 'fake' entry of its providers config): request
+# latencies, a requests per second limit ('tps', throttled requests are rejected at once) and the
+# injected errors ('error_rate' of the admitted requests fail with one of 'error_statuses'). The
+# outcomes of the requests are counted in stats
+class FakeBehavior:
+    def __init__(self, fake_config=None):
+        fake_config = fake_config if fake_config is not None else {}
+        self.latency = fake_config.get('latency', {})
+        self.read_latency = fake_config.get('read_latency', {})
+        self.read_failure_rate = fake_config.get('read_failure_rate', 0)
+        self.error_rate = fake_config.get('error_rate', 0)
+        self.error_statuses = fake_config.get('error_statuses', DEFAULT_ERROR_STATUSES)
+        self.image_error_rate = fake_config.get('image_error_rate', 0)
+        tps = fake_config.get('tps')
+        self.bucket = TokenBucket(tps, fake_config.get('burst')) if tps else None
+        self.rng = random.Random(fake_config.get('seed'))
+        self.stats = collections.Counter()
+        self.lock = threading.Lock()
+
+    def __random(self):
+        with self.lock:
+            return self.rng.random()
+
+    def __count(self, outcome):
+        with self.lock:
+            self.stats[outcome] += 1
+
+    # Samples a latency from a latency config (in seconds)
+    def sample(self, latency_config):
+        with self.lock:
+            return sample_latency(latency_config, self.rng)
+
+    # Checks whether an event of the given rate (e.g., an injected failure) happens
+    def happens(self, rate):
+        return rate > 0 and self.__random() < rate
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+    # Serves a request, waiting for its latency. Returns None if the request succeeds, or a
+    # (status, retry_after) tuple if it is throttled or fails
+    def serve(self):
+        self.__count('requests')
+        if self.bucket is not None:
+            wait_time = self.bucket.try_acquire()
+            if wait_time:
+                self.__count('throttled')
+                return 429, wait_time
+
+        time.sleep(self.sample(self.latency))
+        if self.happens(self.error_rate):
+            self.__count('errors')
+            with self.lock:
+                return self.rng.choice(self.error_statuses), None
+        self.__count('served')
+        return None
+
+
+# In-process stand-in of the boto3 Rekognition client, implementing the calls of AWSRekognition.
+# Throttled requests raise a ThrottlingException and failed ones an InternalServerError or
+# ServiceUnavailableException ClientError, as boto3 does
+class FakeRekognitionClient:
+    def __init__(self, behavior):
+        self.behavior = behavior
+
+    def __call(self, operation_name, image):
+        from botocore.exceptions import ClientError
+        outcome = self.behavior.serve()
+        if outcome is not None:
+            status, _ = outcome
+            code = {429: 'ThrottlingException', 503: 'ServiceUnavailableException'}.get(
+                status, 'InternalServerError')
+            raise ClientError({
+                'Error': {'Code': code, 'Message': 'Fake {} error'.format(status)},
+                'ResponseMetadata': {'HTTPStatusCode': 400 if status == 429 else status}
+            }, operation_name)
+        return gen_fake_content(image['Bytes'])
+
+    def detect_faces(self, Image):
+        content = self.__call('DetectFaces', Image)
+        return {'FaceDetails': [{'Confidence': 99.0}] * content['faces']}
+
+    def detect_labels(self, Image):
+        content = self.__call('DetectLabels', Image)
+        return {'Labels': [{'Name': label, 'Confidence': 90.0} for label in content['labels']]}
+
+    def detect_text(self, Image):
+        content = self.__call('DetectText', Image)
+        return {'TextDetections': [
+            {'DetectedText': line, 'Type': line_type}
+            for line in content['lines'] for line_type in ['LINE', 'WORD']
+        ]}
+
+    def detect_moderation_labels(self, Image):
+        content = self.__call('DetectModerationLabels', Image)
+        labels = [('Explicit Nudity', content['adult']), ('Suggestive', content['racy']),
+                  ('Violence', content['violence'])]
+        return {'ModerationLabels': [
+            {'Name': name, 'ParentName': '', 'Confidence': 20.0 * likelihood}
+            for name, likelihood in labels if likelihood >= 4
+        ]}
+
+    def recognize_celebrities(self, Image):
+        content = self.__call('RecognizeCelebrities', Image)
+        celebrity = content['celebrity']
+        return {'CelebrityFaces': [{'Name': celebrity}] if celebrity is not None else []}
+
+
+# In-process stand-in of the Google ImageAnnotatorClient, implementing batch_annotate_images. A
+# throttled or failed call raises the google.api_core error of its HTTP status, and each image of
+# an admitted call fails with an UNAVAILABLE error at the 'image_error_rate'. Like the clients of
+# the other providers, the fake clients import their provider's library on first use
+class FakeImageAnnotatorClient:
+    def __init__(self, behavior):
+        self.behavior = behavior
+
+    def __annotate(self, request):
+        from google.cloud import vision
+        if self.behavior.happens(self.behavior.image_error_rate):
+            return vision.AnnotateImageResponse(error={
+                'code': IMAGE_ERROR_GRPC_STATUS, 'message': 'Fake image error'
+            })
+
+        content = gen_fake_content(request.image.content)
+        response = vision.AnnotateImageResponse()
+        for feature in request.features:
+            if feature.type_ == vision.Feature.Type.FACE_DETECTION:
+                response.face_annotations = [
+                    vision.FaceAnnotation(detection_confidence=0.99)
+                ] * content['faces']
+            elif feature.type_ == vision.Feature.Type.LABEL_DETECTION:
+                response.label_annotations = [
+                    vision.EntityAnnotation(description=label, score=0.9)
+                    for label in content['labels']
+                ]
+            elif feature.type_ == vision.Feature.Type.TEXT_DETECTION:
+                response.text_annotations = [
+                    vision.EntityAnnotation(description=line) for line in content['lines']
+                ]
+            elif feature.type_ == vision.Feature.Type.SAFE_SEARCH_DETECTION:
+                response.safe_search_annotation = vision.SafeSearchAnnotation(
+                    adult=content['adult'], racy=content['racy'], violence=content['violence']
+                )
+        return response
+
+    def batch_annotate_images(self, requests):
+        from google.api_core.exceptions import from_http_status
+        from google.cloud import vision
+        outcome = self.behavior.serve()
+        if outcome is not None:
+            raise from_http_status(outcome[0], 'Fake {} error'.format(outcome[0]))
+        return vision.BatchAnnotateImagesResponse(
+            responses=[self.__annotate(request) for request in requests]
+        )
+
+
+# Handler of the fake Azure server, which speaks the Analyze Image, Read and Face Detect endpoints
+# used by MSFTVision. Read operations complete after a latency sampled from 'read_latency' (and
+# fail at the 'read_failure_rate'), so clients poll them as they would the real API
+class FakeAzureHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def __send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def __send_error(self, status, message, retry_after=None):
+        # Azure returns Retry-After in whole seconds
+        headers = {'Retry-After': str(math.ceil(retry_after))} if retry_after else None
+        self.__send_json(status, {'error': {'code': str(status), 'message': message}}, headers)
+
+    # Reads the request body and checks the subscription key, throttling and injected errors,
+    # returning the body if the request is served (an error response is sent otherwise)
+    def __begin(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not self.headers.get('Ocp-Apim-Subscription-Key'):
+            self.__send_error(401, 'Access denied due to missing subscription key')
+            return None
+
+        outcome = self.server.behavior.serve()
+        if outcome is not None:
+            status, retry_after = outcome
+            self.__send_error(status, 'Fake {} error'.format(status), retry_after)
+            return None
+        return body
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path not in ['/vision/v3.2/analyze', '/vision/v3.2/read/analyze',
+                            '/face/v1.0/detect']:
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            self.__send_error(404, 'Resource not found')
+            return
+
+        body = self.__begin()
+        if body is None:
+            return
+        content = gen_fake_content(body)
+
+        if url.path == '/vision/v3.2/analyze':
+            self.__send_json(200, {
+                'tags': [{'name': label, 'confidence': 0.9} for label in content['labels']],
+                'adult': {'isAdultContent': content['adult'] >= 4,
+                          'isRacyContent': content['racy'] >= 4},
+                'requestId': str(uuid.uuid4())
+            })
+        elif url.path == '/vision/v3.2/read/analyze':
+            operation_id = self.server.add_read_operation(content['lines'])
+            operation_url = 'http://{}:{}/vision/v3.2/read/analyzeResults/{}'.format(
+                *self.server.server_address[:2], operation_id)
+            self.send_response(202)
+            self.send_header('Operation-Location', operation_url)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        else:
+            self.__send_json(200, [
+                {'faceRectangle': {'top': 0, 'left': 0, 'width': 10, 'height': 10}}
+            ] * content['faces'])
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == '/fake/stats':  # Request outcome counts, for load tests
+            self.__send_json(200, self.server.behavior.get_stats())
+            return
+        if not path.startswith('/vision/v3.2/read/analyzeResults/'):
+            self.__send_error(404, 'Resource not found')
+            return
+
+        if self.__begin() is None:
+            return
+        operation = self.server.get_read_operation(path.rsplit('/', 1)[1])
+        if operation is None:
+            self.__send_error(404, 'Operation not found')
+        elif time.monotonic() < operation['ready_time']:
+            self.__send_json(200, {'status': 'running'})
+        elif operation['failed']:
+            self.__send_json(200, {'status': 'failed'})
+        else:
+            self.__send_json(200, {'status': 'succeeded', 'analyzeResult': {
+                'version': '3.2.0',
+                'readResults': [
+                    {'page': 1, 'lines': [{'text': line} for line in operation['lines']]}
+                ]
+            }})
+
+
+# Local HTTP server standing in for the Azure Vision and Face APIs, served by a thread per
+# connection. The pending Read operations are kept in memory (up to MAX_READ_OPERATIONS)
+class FakeAzureServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, behavior, host=DEFAULT_FAKE_HOST, port=DEFAULT_FAKE_PORT):
+        super().__init__((host, port), FakeAzureHandler)
+        self.behavior = behavior
+        self.read_operations = collections.OrderedDict()
+        self.operations_lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address[:2])
+
+    def add_read_operation(self, lines):
+        operation_id = str(uuid.uuid4())
+        operation = {
+            'lines': lines,
+            'ready_time': time.monotonic() + self.behavior.sample(self.behavior.read_latency),
+            'failed': self.behavior.happens(self.behavior.read_failure_rate)
+        }
+        with self.operations_lock:
+            self.read_operations[operation_id] = operation
+            if len(self.read_operations) > MAX_READ_OPERATIONS:
+                self.read_operations.popitem(last=False)
+        return operation_id
+
+    def get_read_operation(self, operation_id):
+        with self.operations_lock:
+            return self.read_operations.get(operation_id)
+
+    # Serves requests in a background thread
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+# Local stand-in of a provider, created from the 'fake' entry of its providers config. Its fake
+# clients and server share a behavior, so the throttling limits apply to all the experiments
+# targeting the provider
+class FakeProvider:
+    def __init__(self, fake_config=None):
+        self.fake_config = fake_config if fake_config is not None else {}
+        self.behavior = FakeBehavior(self.fake_config)
+        self.server = None
+        self.lock = threading.Lock()
+
+    def create_rekognition_client(self):
+        return FakeRekognitionClient(self.behavior)
+
+    def create_annotator_client(self):
+        return FakeImageAnnotatorClient(self.behavior)
+
+    # Starts the fake Azure server on first use, returning an MSFTVision config that targets it
+    # (its endpoints, unless set in the 'fake' entry, and placeholder subscription keys)
+    def get_azure_config(self, msft_config):
+        with self.lock:
+            if self.server is None and 'endpoint' not in self.fake_config:
+                self.server = FakeAzureServer(
+                    self.behavior, self.fake_config.get('host', DEFAULT_FAKE_HOST),
+                    self.fake_config.get('port', DEFAULT_FAKE_PORT)
+                ).start()
+        endpoint = self.fake_config.get('endpoint', self.server.url if self.server else None)
+        return {
+            **msft_config,
+            'endpoint_vision': endpoint,
+            'endpoint_face': endpoint,
+            'subscription_key_vision': msft_config.get('subscription_key_vision', 'fake'),
+            'subscription_key_face': msft_config.get('subscription_key_face', 'fake')
+        }
+
+    def close(self):
+        if self.server is not None:
+            self.server.stop()
+            self.server = None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Runs a fake Azure Vision/Face API server')
+    parser.add_argument('--host', default=DEFAULT_FAKE_HOST)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--config', help='JSON file with the fake behavior (a "fake" entry)')
+    return parser.parse_args()
+
+
+# Runs the fake Azure server standalone (e.g., python -m services.fake --port 8765), so that the
+# MSFT_AZURE endpoints of a providers config can target it from other processes
+if __name__ == '__main__':
+    args = parse_args()
+    fake_config = {}
+    if args.config:
+        with open(args.config) as config_file:
+            fake_config = json.load(config_file)
+
+    server = FakeAzureServer(FakeBehavior(fake_config), args.host, args.port)
+    print('Fake Azure server listening on {}'.format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print('Request outcomes: {}'.format(server.behavior.get_stats()))
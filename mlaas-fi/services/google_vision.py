@@ -1,55 +1,207 @@
+import threading
+import time
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from importlib.metadata import version
+
+from google.api_core.exceptions import from_grpc_status
 from google.cloud import vision
 
+from .utils import as_payload_type, read_image_payload
+
 
 # Default labels for nudity and violence
 NUDITY_LABELS = ['adult', 'racy']
 VIOLENCE_LABELS = ['violence']
 
+# Annotation feature of each service (the nudity and violence services share the safe search one)
+SERVICE_FEATURES = {
+    'FACE_DETECTION': vision.Feature.Type.FACE_DETECTION,
+    'LABEL_DETECTION': vision.Feature.Type.LABEL_DETECTION,
+    'NUDITY_DETECTION': vision.Feature.Type.SAFE_SEARCH_DETECTION,
+    'VIOLENCE_DETECTION': vision.Feature.Type.SAFE_SEARCH_DETECTION,
+    'TEXT_DETECTION': vision.Feature.Type.TEXT_DETECTION
+}
+
+# Default batching settings: maximum images per batch_annotate_images call (the API limit), maximum
+# image bytes per call (below the 10 MB request limit, leaving room for the rest of the request),
+# seconds to wait for a batch to fill up, and number of batch calls in flight
+DEFAULT_BATCH_SIZE = 16
+DEFAULT_BATCH_MAX_BYTES = 8 * 1024 * 1024
+DEFAULT_BATCH_LINGER = 0.05
+DEFAULT_BATCH_WORKERS = 4
+
+
+# Accumulates annotation requests from concurrent callers and sends them in batch_annotate_images
+# calls. A batch is flushed when it reaches batch_size requests or batch_max_bytes of images (a
+# larger image is sent alone), or batch_linger seconds after its first request, and each caller
+# receives its own AnnotateImageResponse through a future. Each call takes a token of the given
+# bucket (see dispatcher.TokenBucket), if any, as the provider's rate limit applies to calls rather
+# than images. The batcher is shut down by close
+class AnnotateBatcher:
+    def __init__(self, client, batch_size=DEFAULT_BATCH_SIZE, batch_linger=DEFAULT_BATCH_LINGER,
+                 batch_workers=DEFAULT_BATCH_WORKERS, batch_max_bytes=DEFAULT_BATCH_MAX_BYTES,
+                 bucket=None):
+        self.client = client
+        self.batch_size = max(1, batch_size)
+        self.batch_max_bytes = batch_max_bytes
+        self.batch_linger = batch_linger
+        self.bucket = bucket
+        self.executor = ThreadPoolExecutor(max_workers=max(1, batch_workers))
+        self.pending = []  # (request, future, size) tuples
+        self.pending_bytes = 0
+        self.first_pending_time = None
+        self.cond = threading.Condition()
+        self.flusher = None
+        self.closed = False
+
+    def __start(self):
+        if self.flusher is None:
+            self.flusher = threading.Thread(target=self.__run, daemon=True)
+            self.flusher.start()
+
+    # Waits for a full batch or for the linger timeout of a partial one, and sends it. Once closed,
+    # the pending requests are sent right away
+    def __run(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    if self.closed:
+                        return
+                    self.cond.wait()
+                while not self.__is_full() and not self.closed:
+                    timeout = self.first_pending_time + self.batch_linger - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self.cond.wait(timeout)
+
+                batch = self.__take_batch()
+                self.first_pending_time = time.monotonic() if self.pending else None
+            self.executor.submit(self.__send, batch)
+
+    def __is_full(self):
+        return len(self.pending) >= self.batch_size or self.pending_bytes >= self.batch_max_bytes
+
+    # Takes the first pending requests within the batch size and bytes (at least one request)
+    def __take_batch(self):
+        n_requests, batch_bytes = 0, 0
+        for _, _, size in self.pending[:self.batch_size]:
+            if n_requests and batch_bytes + size > self.batch_max_bytes:
+                break
+            n_requests += 1
+            batch_bytes += size
+
+        batch = self.pending[:n_requests]
+        self.pending = self.pending[n_requests:]
+        self.pending_bytes -= batch_bytes
+        return batch
+
+    # Sends a batch and demultiplexes its responses to the futures of the requests
+    def __send(self, batch):
+        try:
+            if self.bucket is not None:
+                self.bucket.acquire()
+            response = self.client.batch_annotate_images(requests=[req for req, _, _ in batch])
+        except BaseException as e:
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+
+        for (_, future, _), img_response in zip(batch, response.responses):
+            if img_response.error.code:
+                future.set_exception(
+                    from_grpc_status(img_response.error.code, img_response.error.message)
+                )
+            else:
+                future.set_result(img_response)
+
+    # Submits an annotation request, returning a future of its AnnotateImageResponse
+    def submit(self, request):
+        future = Future()
+        with self.cond:
+            if self.closed:
+                raise RuntimeError('Batcher closed')
+            if not self.pending:
+                self.first_pending_time = time.monotonic()
+            size = len(request.image.content)
+            self.pending.append((request, future, size))
+            self.pending_bytes += size
+            self.__start()
+            self.cond.notify()
+        return future
+
+    def annotate(self, request):
+        return self.submit(request).result()
+
+    # Sends the pending requests and stops the flusher thread and the batch workers
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        if self.flusher is not None:
+            self.flusher.join()
+        self.executor.shutdown(wait=True)
+
 
 class GoogleVision:
-    def __init__(self):
-        self.client = vision.ImageAnnotatorClient()
+    # Client version (part of the prediction cache keys)
+    VERSION = 'google-cloud-vision-' + version('google-cloud-vision')
+
+    # An annotator client may be given in place of the default one (e.g., a fake client), and the
+    # token bucket of the provider's requests per second limits the batch calls, if given
+    def __init__(self, google_config=None, annotator_client=None, bucket=None):
+        google_config = google_config if google_config is not None else {}
+        self.client = (annotator_client if annotator_client is not None
+                       else vision.ImageAnnotatorClient())
+        self.batcher = AnnotateBatcher(
+            self.client,
+            google_config.get('batch_size', DEFAULT_BATCH_SIZE),
+            google_config.get('batch_linger', DEFAULT_BATCH_LINGER),
+            google_config.get('batch_workers', DEFAULT_BATCH_WORKERS),
+            google_config.get('batch_max_bytes', DEFAULT_BATCH_MAX_BYTES), bucket
+        )
+
+    # Annotates an image with the given features in a single request, through the batcher
+    # Leveraged API: batch_annotate_images from google.cloud.vision
+    def __annotate(self, img, feature_types):
+        request = vision.AnnotateImageRequest(
+            image=vision.Image(content=img),
+            features=[vision.Feature(type_=feature_type) for feature_type in feature_types]
+        )
+        return self.batcher.annotate(request)
 
     # Detects faces in an image, assuming a single face is present per image
-    # Leveraged API: face_detection from google.cloud.vision
-    def __detect_faces(self, img):
-        image = vision.Image(content=img)
-        response = self.client.face_detection(image=image)
+    # Leveraged feature: FACE_DETECTION
+    def __detect_faces(self, response):
         response_faces_n = len(response.face_annotations)
         return ['detected'] if response_faces_n else ['not-detected']
 
     # Labels objects detected in an image
-    # Leveraged API: label_detection from google.cloud.vision
-    def __detect_labels(self, img):
-        image = vision.Image(content=img)
-        response = self.client.label_detection(image=image)
+    # Leveraged feature: LABEL_DETECTION
+    def __detect_labels(self, response):
         response_labels = response.label_annotations
         label_names = [response_label.description for response_label in response_labels]
         return label_names
 
-    def __detect_nudity(self, img):
-        return self.__detect_unsafe_labels(img, unsafe_labels=NUDITY_LABELS)
+    def __detect_nudity(self, response):
+        return self.__detect_unsafe_labels(response, unsafe_labels=NUDITY_LABELS)
 
     # Detects text occurrences (only of the TEXT_DETECTION type) in an image
-    # Leveraged API: text_detection from google.cloud.vision
-    def __detect_text(self, img):
-        image = vision.Image(content=img)
-        response = self.client.text_detection(image=image)
+    # Leveraged feature: TEXT_DETECTION
+    def __detect_text(self, response):
         response_texts = response.text_annotations
         texts_content = [resp_text.description for resp_text in response_texts]
         return texts_content
 
     # Detects unsafe content, defined by the unsafe_label parameter, in an image
     # Supported unsafe labels: adult, medical, spoofed, violence, racy
-    # Leveraged API: safe_search_detection from google.cloud.vision
-    def __detect_unsafe_labels(self, img, unsafe_labels=None):
+    # Leveraged feature: SAFE_SEARCH_DETECTION
+    def __detect_unsafe_labels(self, response, unsafe_labels=None):
         # Unsafe labels and likelihood names
         UNSAFE_LABELS = ['adult', 'medical', 'spoofed', 'violence', 'racy']
         LIKELIHOOD_NAMES = ('UNKNOWN', 'VERY_UNLIKELY', 'UNLIKELY', 'POSSIBLE', 'LIKELY',
                             'VERY_LIKELY')
 
-        image = vision.Image(content=img)
-        response = self.client.safe_search_detection(image=image)
         response_labels = response.safe_search_annotation
 
         # Convert output to the "label-likelihood" format
@@ -62,12 +214,19 @@ class GoogleVision:
 
         return label_names
 
-    def __detect_violence(self, img):
-        return self.__detect_unsafe_labels(img, unsafe_labels=VIOLENCE_LABELS)
+    def __detect_violence(self, response):
+        return self.__detect_unsafe_labels(response, unsafe_labels=VIOLENCE_LABELS)
 
-    # Run an Google Cloud Vision AI service for a given image
-    def run_service(self, service, image):
-        # Map a service to a prediction function
+    # Counts the API calls made for an image by run_services: none, as its features are annotated
+    # at once in a batch call, which takes its rate token when it is sent (see AnnotateBatcher)
+    @staticmethod
+    def count_requests(services):
+        return 0
+
+    # Run Google Cloud Vision AI services for a given image (a path, the image bytes or a buffer),
+    # returning the predictions per service. The features of all services are requested at once
+    def run_services(self, services, image):
+        # Map a service to a prediction function (from the annotation response)
         service_map = {
             'FACE_DETECTION': self.__detect_faces,
             'LABEL_DETECTION': self.__detect_labels,
@@ -76,8 +235,16 @@ class GoogleVision:
             'TEXT_DETECTION': self.__detect_text
         }
 
-        # Apply the function to the given image
-        with open(image, 'rb') as img_file:
-            img_payload = img_file.read()
-        output = service_map[service](img_payload)
-        return output
+        # Annotate the given image and apply the functions to the response
+        img_payload = as_payload_type(read_image_payload(image))
+        feature_types = list(dict.fromkeys(SERVICE_FEATURES[service] for service in services))
+        response = self.__annotate(img_payload, feature_types)
+        return {service: service_map[service](response) for service in services}
+
+    # Run an Google Cloud Vision AI service for a given image (a path, the image bytes or a buffer)
+    def run_service(self, service, image):
+        return self.run_services([service], image)[service]
+
+    # Stops the batcher of the annotation requests
+    def close(self):
+        self.batcher.close()
@@ -1,14 +1,22 @@
-import time
-import requests
+from concurrent.futures import Future
 
-from .utils import make_api_request
+from .polling import DEFAULT_POLL_DEADLINE, OperationPoller
+from .retry import parse_retry_after
+from .utils import DEFAULT_POOL_SIZE, REQUEST_TIMEOUT, as_payload_type, create_session
+from .utils import make_api_request, read_image_payload
 
 
 # Default Content-Type header
 CONTENT_TYPE_HEADER = 'application/octet-stream'
 
+# Visual features of the Analyze Image API per service, which are requested together
+ANALYZE_FEATURES = {'LABEL_DETECTION': 'Tags', 'NUDITY_DETECTION': 'Adult'}
+
 
 class MSFTVision:
+    # Client version (part of the prediction cache keys), i.e., the versions of the leveraged APIs
+    VERSION = 'vision-v3.2-face-v1.0'
+
     def __init__(self, msft_config):
         self.api_endpoint_vision = msft_config['endpoint_vision']
         self.api_endpoint_face = msft_config['endpoint_face']
@@ -21,52 +29,72 @@ class MSFTVision:
             'Content-Type': CONTENT_TYPE_HEADER
         }
 
+        # Keep-alive connections shared by all requests, and the poller of the Read operations
+        pool_size = msft_config.get('pool_size', DEFAULT_POOL_SIZE)
+        self.session = create_session(pool_size)
+        self.read_poller = OperationPoller(
+            self.__poll_read_result, workers=pool_size,
+            deadline=msft_config.get('read_deadline', DEFAULT_POLL_DEADLINE)
+        )
+
     def __detect_faces(self, img):
         api_url = self.api_endpoint_face + '/face/v1.0/detect'
-        response_data = make_api_request(api_url, self.api_headers_face, img)
+        response_data = make_api_request(api_url, self.api_headers_face, img, self.session)
         response_data = response_data.json()
         response_faces_n = len(response_data)
         return ['detected'] if response_faces_n else ['not-detected']
 
-    # Labels objects detected in an image
-    # Leveraged API: Analyze Image from Cognitive Services (visualFeatures=Tags)
-    def __detect_labels(self, img):
-        api_url = self.api_endpoint_vision + '/vision/v3.2/analyze?visualFeatures=Tags'
-        response_data = make_api_request(api_url, self.api_headers_vision, img)
+    # Analyzes an image with the visual features of the given services in a single request,
+    # returning the predictions per service
+    # Leveraged API: Analyze Image from Cognitive Services (visualFeatures=Tags,Adult)
+    def __analyze(self, img, services):
+        service_map = {
+            'LABEL_DETECTION': self.__detect_labels,
+            'NUDITY_DETECTION': self.__detect_adult_content
+        }
+
+        features = ','.join(ANALYZE_FEATURES[service] for service in services)
+        api_url = self.api_endpoint_vision + '/vision/v3.2/analyze?visualFeatures=' + features
+        response_data = make_api_request(api_url, self.api_headers_vision, img, self.session)
         response_data = response_data.json()
+        return {service: service_map[service](response_data) for service in services}
+
+    # Labels objects detected in an image (from its analysis with visualFeatures=Tags)
+    def __detect_labels(self, response_data):
         response_labels = response_data['tags']
         label_names = [response_label['name'] for response_label in response_labels]
         return label_names
 
+    # Detects text lines in an image, returning a future of the detected lines
+    # Leveraged API: Read from Cognitive Services. The analysis is submitted and its result is then
+    # polled by the shared poller, with an adaptive backoff and a deadline
     def __detect_text(self, img):
         api_url = self.api_endpoint_vision + '/vision/v3.2/read/analyze'
-        response_data = make_api_request(api_url, self.api_headers_vision, img)
+        response_data = make_api_request(api_url, self.api_headers_vision, img, self.session)
         operation_url = response_data.headers['Operation-Location']  # URL to retrieve detected text
+        return self.read_poller.submit(operation_url)
 
-        analysis = {}
-        poll = True
-        while (poll):
-            response_final = requests.get(operation_url, headers=self.api_headers_vision)
-            analysis = response_final.json()
-            time.sleep(1)
-            if ('analyzeResult' in analysis):
-                poll = False
-            if ('status' in analysis and analysis['status'] == 'failed'):
-                poll = False
-
-        if ('analyzeResult' in analysis):
+    # Polls the result of a Read operation, returning a (done, text lines, retry_after) tuple
+    def __poll_read_result(self, operation_url):
+        response = self.session.get(
+            operation_url, headers=self.api_headers_vision, timeout=REQUEST_TIMEOUT
+        )
+        if response.status_code == 429:  # Throttled polls are rescheduled
+            return False, None, parse_retry_after(response.headers.get('Retry-After'))
+        response.raise_for_status()
+        analysis = response.json()
+
+        if 'analyzeResult' in analysis:
             texts_content = [line['text']
                              for line in analysis['analyzeResult']['readResults'][0]['lines']]
-            return texts_content
+            return True, texts_content, None
+        if analysis.get('status') == 'failed':
+            return True, [], None
 
-        return []
+        return False, None, parse_retry_after(response.headers.get('Retry-After'))
 
-    # Detects adult and racy content in an image
-    # Leveraged API: Analyze Image from Cognitive Services (visualFeatures=Adult)
-    def __detect_adult_content(self, img):
-        api_url = self.api_endpoint_vision + '/vision/v3.2/analyze?visualFeatures=Adult'
-        response_data = make_api_request(api_url, self.api_headers_vision, img)
-        response_data = response_data.json()
+    # Detects adult and racy content in an image (from its analysis with visualFeatures=Adult)
+    def __detect_adult_content(self, response_data):
         response_labels = response_data['adult']
 
         # Conditionally add the adult or racy labels
@@ -77,17 +105,51 @@ class MSFTVision:
             label_names.append('racy')
         return label_names
 
+    # Counts the API calls made for an image by run_services: an Analyze Image call for the
+    # services in ANALYZE_FEATURES and a call per other service
+    @staticmethod
+    def count_requests(services):
+        n_analyze = int(any(service in ANALYZE_FEATURES for service in services))
+        return n_analyze + len([s for s in services if s not in ANALYZE_FEATURES])
+
+    # Submits Azure Vision services for a given image (a path, the image bytes or a buffer),
+    # returning a future of the predictions per service. The services of the Analyze Image API
+    # share a single request. The requests are sent before returning, but the Read operation of
+    # text detection is left to the poller, which completes the future once its result is retrieved
+    def submit_services(self, services, image):
+        # requests sends bytes and bytearray bodies as they are
+        img_payload = as_payload_type(read_image_payload(image), (bytes, bytearray))
+        analyze_services = [service for service in services if service in ANALYZE_FEATURES]
+        outputs = self.__analyze(img_payload, analyze_services) if analyze_services else {}
+        if 'FACE_DETECTION' in services:
+            outputs['FACE_DETECTION'] = self.__detect_faces(img_payload)
+
+        predictions = Future()
+        if 'TEXT_DETECTION' not in services:
+            predictions.set_result({service: outputs[service] for service in services})
+            return predictions
+
+        def complete(text_lines):
+            try:
+                outputs['TEXT_DETECTION'] = text_lines.result()
+            except BaseException as err:
+                predictions.set_exception(err)
+                return
+            predictions.set_result({service: outputs[service] for service in services})
+
+        self.__detect_text(img_payload).add_done_callback(complete)
+        return predictions
+
+    # Run Azure Vision services for a given image (a path, the image bytes or a buffer), returning
+    # the predictions per service
+    def run_services(self, services, image):
+        return self.submit_services(services, image).result()
+
+    # Run an Azure Vision service for a given image (a path, the image bytes or a buffer)
     def run_service(self, service, image):
-        # Map a service to a prediction function
-        service_map = {
-            'FACE_DETECTION': self.__detect_faces,
-            'LABEL_DETECTION': self.__detect_labels,
-            'NUDITY_DETECTION': self.__detect_adult_content,
-            'TEXT_DETECTION': self.__detect_text
-        }
+        return self.run_services([service], image)[service]
 
-        # Apply the function to the given image
-        with open(image, 'rb') as img_file:
-            img_payload = img_file.read()
-        output = service_map[service](img_payload)
-        return output
+    # Stops the poller of the Read operations and closes the connections
+    def close(self):
+        self.read_poller.close()
+        self.session.close()
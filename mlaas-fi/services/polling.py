@@ -0,0 +1,113 @@
+import heapq
+import itertools
+import threading
+import time
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+# Default polling settings of long-running operations: the first poll delay, the backoff factor and
+# maximum delay between polls, and the overall deadline of an operation, in seconds
+DEFAULT_POLL_DELAY = 0.5
+DEFAULT_POLL_BACKOFF = 1.5
+DEFAULT_MAX_POLL_DELAY = 5
+DEFAULT_POLL_DEADLINE = 120
+
+
+# Polls long-running operations (e.g., Azure Read results) concurrently. Each submitted operation
+# is scheduled in a heap by its next poll time, and a scheduler thread hands the due polls to a
+# pool of poll workers. The poll function returns a (done, result, retry_after) tuple: operations
+# that are not done are rescheduled with an exponential backoff (or after retry_after, when given)
+# until their deadline. Each operation is tracked by a future of its result, so that callers can
+# be notified of it (add_done_callback) instead of waiting for it. The poller is shut down by close
+class OperationPoller:
+    def __init__(self, poll, workers=1, poll_delay=DEFAULT_POLL_DELAY,
+                 poll_backoff=DEFAULT_POLL_BACKOFF, max_poll_delay=DEFAULT_MAX_POLL_DELAY,
+                 deadline=DEFAULT_POLL_DEADLINE):
+        self.poll = poll
+        self.poll_delay = poll_delay
+        self.poll_backoff = poll_backoff
+        self.max_poll_delay = max_poll_delay
+        self.deadline = deadline
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers))
+        self.schedule = []  # Heap of (poll_time, seq, operation, future, delay, deadline)
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.scheduler = None
+        self.closed = False
+
+    def __start(self):
+        if self.scheduler is None:
+            self.scheduler = threading.Thread(target=self.__run, daemon=True)
+            self.scheduler.start()
+
+    def __push(self, poll_time, operation, future, delay, deadline):
+        with self.cond:
+            if self.closed:
+                future.set_exception(RuntimeError('Poller closed'))
+                return
+            heapq.heappush(
+                self.schedule, (poll_time, next(self.counter), operation, future, delay, deadline)
+            )
+            self.__start()
+            self.cond.notify()
+
+    # Hands the due polls to the workers, sleeping until the next poll time or a new operation
+    def __run(self):
+        while True:
+            with self.cond:
+                while not self.closed and \
+                        (not self.schedule or self.schedule[0][0] > time.monotonic()):
+                    timeout = self.schedule[0][0] - time.monotonic() if self.schedule else None
+                    self.cond.wait(timeout)
+                if self.closed:
+                    return
+                _, _, operation, future, delay, deadline = heapq.heappop(self.schedule)
+            self.executor.submit(self.__poll, operation, future, delay, deadline)
+
+    def __poll(self, operation, future, delay, deadline):
+        try:
+            done, result, retry_after = self.poll(operation)
+        except BaseException as e:
+            future.set_exception(e)
+            return
+
+        if done:
+            future.set_result(result)
+            return
+
+        now = time.monotonic()
+        if now >= deadline:
+            future.set_exception(TimeoutError('Operation not done after %ss' % self.deadline))
+            return
+
+        next_delay = retry_after if retry_after is not None else delay
+        next_time = min(now + next_delay, deadline)
+        self.__push(next_time, operation, future,
+                    min(delay * self.poll_backoff, self.max_poll_delay), deadline)
+
+    # Submits an operation to be polled, returning a future of its result
+    def submit(self, operation):
+        future = Future()
+        now = time.monotonic()
+        self.__push(now + self.poll_delay, operation, future, self.poll_delay, now + self.deadline)
+        return future
+
+    # Polls an operation until it is done (or its deadline is reached) and returns its result
+    def wait(self, operation):
+        return self.submit(operation).result()
+
+    # Stops the scheduler thread and the poll workers. The operations still being polled fail with
+    # a RuntimeError
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        if self.scheduler is not None:
+            self.scheduler.join()
+        self.executor.shutdown(wait=True)
+
+        with self.cond:
+            for _, _, _, future, _, _ in self.schedule:
+                future.set_exception(RuntimeError('Poller closed'))
+            self.schedule = []
@@ -0,0 +1,166 @@
+import random
+import sys
+import threading
+import time
+
+from email.utils import parsedate_to_datetime
+
+
+# Error classes: throttling errors (e.g., HTTP 429) slow down the requests to a provider,
+# transient errors (e.g., connection errors, HTTP 5xx) are retried, and fatal errors are raised
+THROTTLING = 'throttling'
+TRANSIENT = 'transient'
+FATAL = 'fatal'
+
+# Error codes of throttled AWS requests, which are not always returned as HTTP 429
+AWS_THROTTLING_CODES = [
+    'ProvisionedThroughputExceededException', 'LimitExceededException', 'RequestLimitExceeded',
+    'SlowDown', 'Throttling', 'ThrottlingException', 'TooManyRequestsException'
+]
+
+# Exception modules of the provider libraries. An error can only come from a library that was
+# imported, so errors are classified without importing the libraries of the unused providers
+REQUESTS_EXCEPTIONS = 'requests.exceptions'
+BOTOCORE_EXCEPTIONS = 'botocore.exceptions'
+GOOGLE_EXCEPTIONS = 'google.api_core.exceptions'
+
+# HTTP statuses of transient errors (besides the 5xx ones)
+TRANSIENT_STATUSES = [408, 425]
+
+# Default retry settings: maximum attempts per request and the base and maximum backoff delays
+DEFAULT_MAX_ATTEMPTS = 8
+DEFAULT_BASE_DELAY = 1
+DEFAULT_MAX_DELAY = 60
+
+# Default circuit breaker settings: consecutive transient failures to open the circuit, and
+# seconds until a trial request is let through an open circuit
+DEFAULT_FAILURE_THRESHOLD = 10
+DEFAULT_RESET_TIMEOUT = 60
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+# Parses a Retry-After header value (delay in seconds or an HTTP date) into seconds
+def parse_retry_after(value):
+    if value is None:
+        return None
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0., parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# Retrieves the HTTP status, error code and Retry-After header of an error raised by requests,
+# boto3 or google-cloud-vision, when available
+def get_error_details(err):
+    requests_exceptions = sys.modules.get(REQUESTS_EXCEPTIONS)
+    botocore_exceptions = sys.modules.get(BOTOCORE_EXCEPTIONS)
+    google_exceptions = sys.modules.get(GOOGLE_EXCEPTIONS)
+
+    if requests_exceptions is not None and isinstance(err, requests_exceptions.HTTPError) and \
+            err.response is not None:
+        return err.response.status_code, None, err.response.headers.get('Retry-After')
+    if botocore_exceptions is not None and isinstance(err, botocore_exceptions.ClientError):
+        metadata = err.response.get('ResponseMetadata', {})
+        headers = metadata.get('HTTPHeaders', {})
+        return (metadata.get('HTTPStatusCode'), err.response.get('Error', {}).get('Code'),
+                headers.get('retry-after'))
+    if google_exceptions is not None and isinstance(err, google_exceptions.GoogleAPICallError):
+        headers = getattr(err.response, 'headers', None) or {}
+        return err.code, None, headers.get('Retry-After')
+    return None, None, None
+
+
+# Lists the exception classes of connection errors and timeouts, of Python and of the imported
+# provider libraries
+def get_connection_errors():
+    errors = [ConnectionError, TimeoutError]
+    requests_exceptions = sys.modules.get(REQUESTS_EXCEPTIONS)
+    if requests_exceptions is not None:
+        errors += [requests_exceptions.ConnectionError, requests_exceptions.Timeout]
+    botocore_exceptions = sys.modules.get(BOTOCORE_EXCEPTIONS)
+    if botocore_exceptions is not None:
+        errors += [botocore_exceptions.ConnectionError, botocore_exceptions.HTTPClientError]
+    return tuple(errors)
+
+
+# Classifies an error into THROTTLING, TRANSIENT or FATAL, returning an (error class, retry_after)
+# tuple, where retry_after is the delay (in seconds) requested by the provider, if any
+def classify_error(err):
+    status, code, retry_after = get_error_details(err)
+    retry_after = parse_retry_after(retry_after)
+
+    if status == 429 or code in AWS_THROTTLING_CODES:
+        return THROTTLING, retry_after
+    if status is not None and (status >= 500 or status in TRANSIENT_STATUSES):
+        return TRANSIENT, retry_after
+    if isinstance(err, get_connection_errors()):
+        return TRANSIENT, retry_after
+    return FATAL, retry_after
+
+
+# Retry policy with jittered exponential backoff: the n-th retry waits a random delay between half
+# and all of min(max_delay, base_delay * 2^(n - 1)), or the delay requested by the provider
+class RetryPolicy:
+    def __init__(self, max_attempts=DEFAULT_MAX_ATTEMPTS, base_delay=DEFAULT_BASE_DELAY,
+                 max_delay=DEFAULT_MAX_DELAY):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def get_delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return retry_after
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return random.uniform(delay / 2, delay)
+
+
+# Circuit breaker of a provider: after failure_threshold consecutive transient failures the circuit
+# opens and requests fail fast with CircuitOpenError. After reset_timeout seconds, a single trial
+# request is let through (half-open), which closes the circuit on success or reopens it on failure.
+# Requests that are neither (e.g., rejected as bad requests) leave the circuit as it is
+class CircuitBreaker:
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout=DEFAULT_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    # Raises CircuitOpenError if the circuit is open, otherwise lets the request through
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if self.trial or time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(
+                    'Circuit open after %d consecutive failures' % self.failures
+                )
+            self.trial = True
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial = False
+
+    # Records a request that neither succeeded nor failed transiently, ending a trial request
+    # without closing the circuit (the next request past the reset timeout is a new trial)
+    def record_ignored(self):
+        with self.lock:
+            self.trial = False
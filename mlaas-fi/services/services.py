@@ -1,27 +1,233 @@
-from .aws_rekognition import AWSRekognition
-from .google_vision import GoogleVision
-from .msft_vision import MSFTVision
+import contextlib
+import os
+import threading
+import time
+
+from concurrent.futures import Future
+from importlib import import_module
+
+from .cache import PredictionCache
+from .dispatcher import DEFAULT_CONCURRENCY, DEFAULT_REQUESTS_PER_SECOND, PredictionDispatcher
+from .dispatcher import create_limiter
+from .retry import DEFAULT_BASE_DELAY, DEFAULT_FAILURE_THRESHOLD, DEFAULT_MAX_ATTEMPTS
+from .retry import DEFAULT_MAX_DELAY, DEFAULT_RESET_TIMEOUT, CircuitBreaker, RetryPolicy
 from .utils import is_azure_vision_service, is_google_vision_service, is_rekognition_service
+from .utils import read_image_payload
+
+
+# Default name of the persistent prediction cache file
+CACHE_FILE = 'predictions.sqlite'
+
+# Registry of the provider clients: the module and class of each provider's client, imported on
+# first use (so that a run only imports the SDKs of its providers, e.g., boto3 for AWS), and the
+# check of the services it supports
+PROVIDER_CLIENTS = {
+    'AWS': ('.aws_rekognition', 'AWSRekognition', is_rekognition_service),
+    'GOOGLE_CLOUD': ('.google_vision', 'GoogleVision', is_google_vision_service),
+    'MSFT_AZURE': ('.msft_vision', 'MSFTVision', is_azure_vision_service)
+}
+
+# Circuit breakers and concurrency/rate limiters per provider, shared by all the experiments of a
+# run (so that concurrent experiments of a provider stay within its limits together)
+circuit_breakers = {}
+provider_limiters = {}
+provider_lock = threading.Lock()
+
+# Local stand-ins of the providers configured with a 'fake' entry, shared by all the experiments of
+# a run (so that their throttling limits apply to the experiments together)
+fake_providers = {}
+
+
+# Retrieves the services of an experiment, configured either as a single service or as a list of
+# services assessed together (e.g., ["LABEL_DETECTION", "NUDITY_DETECTION"]). Repeated services are
+# only kept once, in their configured order
+def get_services(exp_config):
+    services = exp_config['service']
+    return list(dict.fromkeys(services)) if isinstance(services, list) else [services]
+
+
+# Submits the services of a client for an image payload, returning a future of the predictions per
+# service. Clients with long-running operations (e.g., the Azure Read API) submit them without
+# waiting for their results (submit_services), while the other clients run the services right away
+def submit_services(client, services, payload):
+    if hasattr(client, 'submit_services'):
+        return client.submit_services(services, payload)
+    future = Future()
+    future.set_result(client.run_services(services, payload))
+    return future
+
+
+# Submits an image (a path, the image bytes or a buffer object) to the services of an experiment,
+# returning a future of the predictions per service. The services are invoked together (in a single
+# request wherever the provider allows it). When a cache is given, it is consulted before calling
+# the services, and only the requests actually sent are wrapped in limit (see
+# PredictionDispatcher), if given. The limit is released once the requests are sent, before their
+# long-running operations are done. The latency (until the predictions are done) and payload size
+# of these requests, failed or not, are reported to metrics (see metrics.ExperimentMetrics), if
+# given
+def submit_predictions(exp_config, client, image, cache=None, metrics=None, limit=None):
+    services = get_services(exp_config)
+    payload = read_image_payload(image)
+
+    def submit():
+        with limit() if limit is not None else contextlib.nullcontext():
+            start = time.perf_counter()
+
+            def record_request(_):
+                if metrics is not None:
+                    metrics.record_request(time.perf_counter() - start, len(payload))
+
+            try:
+                predictions = submit_services(client, services, payload)
+            except BaseException:
+                record_request(None)
+                raise
+        predictions.add_done_callback(record_request)
+        return predictions
+
+    if cache is None:
+        return submit()
+    key = cache.gen_key(payload, exp_config['provider'], '+'.join(services), client.VERSION)
+    return cache.get_or_submit(key, submit)
+
+
+# Retrieves the predictions from the services of an experiment for a given image, as a dict of
+# predictions per service (see submit_predictions)
+def get_predictions(exp_config, client, image, cache=None, metrics=None, limit=None):
+    return submit_predictions(exp_config, client, image, cache, metrics, limit).result()
+
+
+# Checks whether a provider supports a set of services (without importing its client)
+def is_supported(provider, services):
+    return provider in PROVIDER_CLIENTS and all(map(PROVIDER_CLIENTS[provider][2], services))
 
 
-# Retrieves the predictions from a service for a given image
-def get_predictions(exp_config, client, image):
-    service = exp_config['service']
-    predictions = client.run_service(service, image)
-    return predictions
+# Imports the client class of a provider (see PROVIDER_CLIENTS)
+def load_client_class(provider):
+    module_name, class_name, _ = PROVIDER_CLIENTS[provider]
+    return getattr(import_module(module_name, __package__), class_name)
 
 
-# Retrieves the client to invoke a machine learning cloud service
+# Retrieves the local stand-in of a provider, created from the 'fake' entry of its config on first
+# use
+def get_fake_provider(provider, provider_config):
+    from .fake import FakeProvider
+    with provider_lock:
+        if provider not in fake_providers:
+            fake_providers[provider] = FakeProvider(provider_config['fake'])
+        return fake_providers[provider]
+
+
+# Retrieves the client to invoke a machine learning cloud service (or a set of services), raising a
+# ValueError if no service is configured or the provider does not support them. When the provider
+# config has a 'fake' entry, the client targets a local stand-in of the provider instead (a fake
+# Azure server or in-process boto3/Google clients), so that runs need no credentials
 def get_client(exp_config, providers_config):
     provider = exp_config['provider']
-    service = exp_config['service']
-
-    if provider == 'AWS' and is_rekognition_service(service):
-        return AWSRekognition(providers_config['providers']['AWS'])
-    elif provider == 'GOOGLE_CLOUD' and is_google_vision_service(service):
-        return GoogleVision()
-    elif provider == 'MSFT_AZURE' and is_azure_vision_service(service):
-        return MSFTVision(providers_config['providers']['MSFT_AZURE'])
+    services = get_services(exp_config)
+    if not services:
+        raise ValueError('No service configured for provider {}'.format(provider))
+    if not is_supported(provider, services):
+        raise ValueError('Unsupported combination of provider ({}) and service ({})'.format(
+            provider, ', '.join(services)))
+
+    provider_config = providers_config['providers'].get(provider, {})
+    client_class = load_client_class(provider)
+    fake = get_fake_provider(provider, provider_config) if 'fake' in provider_config else None
+    if provider == 'AWS':
+        client = client_class(provider_config, fake and fake.create_rekognition_client())
+    elif provider == 'GOOGLE_CLOUD':
+        client = client_class(provider_config, fake and fake.create_annotator_client(),
+                              get_provider_limiter(provider, provider_config).bucket)
     else:
-        print('Unsupported combination of provider ({}) and service ({})'.format(provider, service))
-        return None
+        client = client_class(fake.get_azure_config(provider_config) if fake else provider_config)
+
+    # Fake predictions are cached apart from the provider's real ones
+    if fake is not None:
+        client.VERSION = 'fake-' + client.VERSION
+    return client
+
+
+# Retrieves the prediction cache of an experiment. A persistent cache is stored in cache_dir (or in
+# the configured path) when the experiment has a 'prediction_cache' entry, otherwise an in-memory
+# cache is used, which only collapses identical requests within the run
+def get_cache(exp_config, cache_dir):
+    if 'prediction_cache' not in exp_config:
+        return PredictionCache()
+
+    cache_config = exp_config['prediction_cache']
+    cache_path = cache_config.get('path', os.path.join(cache_dir, CACHE_FILE))
+    if os.path.dirname(cache_path):
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+
+    return PredictionCache(
+        cache_path, cache_config.get('max_size_mb'), cache_config.get('max_age_days')
+    )
+
+
+# Retrieves the retry policy of a provider, from the 'retry' entry of its config
+def get_retry_policy(provider_config):
+    retry_config = provider_config.get('retry', {})
+    return RetryPolicy(
+        retry_config.get('max_attempts', DEFAULT_MAX_ATTEMPTS),
+        retry_config.get('base_delay', DEFAULT_BASE_DELAY),
+        retry_config.get('max_delay', DEFAULT_MAX_DELAY)
+    )
+
+
+# Retrieves the circuit breaker of a provider, created from the 'circuit_breaker' entry of its
+# config on first use
+def get_circuit_breaker(provider, provider_config):
+    with provider_lock:
+        if provider not in circuit_breakers:
+            breaker_config = provider_config.get('circuit_breaker', {})
+            circuit_breakers[provider] = CircuitBreaker(
+                breaker_config.get('failure_threshold', DEFAULT_FAILURE_THRESHOLD),
+                breaker_config.get('reset_timeout', DEFAULT_RESET_TIMEOUT)
+            )
+        return circuit_breakers[provider]
+
+
+# Retrieves the concurrency/rate limiter of a provider, created from its 'concurrency' and
+# 'requests_per_second' config on first use
+def get_provider_limiter(provider, provider_config):
+    with provider_lock:
+        if provider not in provider_limiters:
+            provider_limiters[provider] = create_limiter(
+                provider_config.get('concurrency', DEFAULT_CONCURRENCY),
+                provider_config.get('requests_per_second', DEFAULT_REQUESTS_PER_SECOND)
+            )
+        return provider_limiters[provider]
+
+
+# Resets the circuit breakers and limiters of the providers, so that a new run starts from the
+# configured limits (e.g., after a run whose throttled requests shrank them), and closes the local
+# stand-ins of the providers (stopping the fake Azure server), so that a new run starts new ones
+def reset_providers():
+    with provider_lock:
+        circuit_breakers.clear()
+        provider_limiters.clear()
+        for fake in fake_providers.values():
+            fake.close()
+        fake_providers.clear()
+
+
+# Retrieves a dispatcher to perform concurrent, rate-limited predictions with a client. The
+# concurrency, requests per second, retry policy and circuit breaker settings are read from the
+# provider's entry in the providers config, and the limits are shared by the provider's dispatchers.
+# The requests are reported to metrics, if given
+def get_dispatcher(exp_config, providers_config, client, cache=None, metrics=None):
+    provider = exp_config['provider']
+    provider_config = providers_config['providers'].get(provider, {})
+    concurrency = provider_config.get('concurrency', DEFAULT_CONCURRENCY)
+    requests_per_second = provider_config.get('requests_per_second', DEFAULT_REQUESTS_PER_SECOND)
+
+    def predict(image, limit):
+        return submit_predictions(exp_config, client, image, cache, metrics, limit)
+
+    return PredictionDispatcher(
+        predict, concurrency, requests_per_second, get_retry_policy(provider_config),
+        get_circuit_breaker(provider, provider_config),
+        get_provider_limiter(provider, provider_config), metrics,
+        client.count_requests(get_services(exp_config))
+    )
@@ -1,5 +1,4 @@
-import time
-import requests
+import io
 
 
 # Common vision services across all supported providers
@@ -7,8 +6,9 @@ COMMON_VISION_SERVICES = [
     'FACE_DETECTION', 'LABEL_DETECTION', 'NUDITY_DETECTION', 'TEXT_DETECTION'
 ]
 
-# Default retry config
-RETRY_TIMES = 100
+# Default HTTP connection pool size (per host) and request timeout, in seconds
+DEFAULT_POOL_SIZE = 10
+REQUEST_TIMEOUT = 60
 
 
 # Checks if a service is a supported AWS Rekognition service
@@ -29,17 +29,45 @@ def is_azure_vision_service(service):
     return service in [*COMMON_VISION_SERVICES, *azure_vision_only]
 
 
-def core_api_request(api_url, headers, data):
-    response = requests.post(api_url, headers=headers, data=data)
-    response.raise_for_status()
-    return response
+# Reads the payload of an image, which may be given as a file path, as the encoded image bytes or
+# as a buffer object (bytearray, memoryview, io.BytesIO or any readable file-like object). Bytes
+# and buffers are passed through without copies
+def read_image_payload(image):
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return image
+    if isinstance(image, io.BytesIO):
+        return image.getbuffer()
+    if hasattr(image, 'read'):
+        return image.read()
+
+    with open(image, 'rb') as img_file:
+        return img_file.read()
+
+
+# Converts a payload to one of the given bytes-like types, copying it only when its type is not
+# accepted (e.g., a memoryview for an API that only takes bytes)
+def as_payload_type(payload, accepted_types=(bytes,)):
+    return payload if isinstance(payload, accepted_types) else bytes(payload)
 
 
-# Makes an API request, using requests, to a given url with the given headers and payload data
-def make_api_request(api_url, headers, data):
-    try:
-        return core_api_request(api_url, headers, data)
-    except BaseException as e:
-        print('Got %s error %s, retrying' % (type(e).__name__, e))
-        time.sleep(10)
-        return core_api_request(api_url, headers, data)
+# Creates a requests session whose keep-alive connections are pooled (up to pool_size per host),
+# so that consecutive API calls reuse the TCP and TLS connections. requests is imported on first
+# use, by the providers that call HTTP APIs directly
+def create_session(pool_size=DEFAULT_POOL_SIZE):
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+# Makes an API request, using requests (or the given session), to a given url with the given
+# headers and payload data. Failed requests are retried by the dispatcher (see services.retry)
+def make_api_request(api_url, headers, data, session=None):
+    import requests
+    sender = session if session is not None else requests
+    response = sender.post(api_url, headers=headers, data=data, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    return response
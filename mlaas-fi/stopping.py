@@ -0,0 +1,86 @@
+import math
+import threading
+
+from statistics import NormalDist
+
+
+# Default confidence level of the change rate intervals, and minimum number of images observed
+# before a fault variant may be stopped
+DEFAULT_CONFIDENCE = 0.95
+DEFAULT_MIN_IMAGES = 30
+
+
+# Computes the Wilson score interval of a proportion (changes out of n observations) at a given
+# confidence level, as a (low, high) tuple. Unlike the normal approximation, it stays meaningful
+# for rates close to 0 or 1, which are common for prediction changes
+def wilson_interval(changes, n, confidence=DEFAULT_CONFIDENCE):
+    if n == 0:
+        return 0.0, 1.0
+    z = NormalDist().inv_cdf(1 - (1 - confidence) / 2)
+    rate = changes / n
+    center = (rate + z * z / (2 * n)) / (1 + z * z / n)
+    margin = z * math.sqrt(rate * (1 - rate) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+    return max(0.0, center - margin), min(1.0, center + margin)
+
+
+# Sequential early stopping of the fault variants of an experiment. The prediction changes of the
+# images (faulty predictions differing from the base ones) are counted per fault key and service,
+# and a fault key is settled for a service once the confidence interval of its change rate is
+# narrower than ci_width (after at least min_images images). It is configured by the experiment's
+# 'early_stopping' config (e.g., {"ci_width": 0.1, "confidence": 0.95, "min_images": 30}), and is
+# shared by the pipeline threads
+class EarlyStopping:
+    def __init__(self, ci_width, confidence=DEFAULT_CONFIDENCE, min_images=DEFAULT_MIN_IMAGES):
+        self.ci_width = ci_width
+        self.confidence = confidence
+        self.min_images = min_images
+        self.counts = {}  # (fault_key, service) -> [changes, images]
+        self.lock = threading.Lock()
+
+    # Creates the early stopping of an experiment from its 'early_stopping' config (None if not set)
+    @classmethod
+    def from_config(cls, exp_config):
+        stopping_config = exp_config.get('early_stopping')
+        if stopping_config is None:
+            return None
+        return cls(
+            stopping_config['ci_width'],
+            stopping_config.get('confidence', DEFAULT_CONFIDENCE),
+            stopping_config.get('min_images', DEFAULT_MIN_IMAGES)
+        )
+
+    # Records whether the predictions of an image for a fault key changed for a service
+    def record(self, fault_key, service, changed):
+        with self.lock:
+            counts = self.counts.setdefault((fault_key, service), [0, 0])
+            counts[0] += int(changed)
+            counts[1] += 1
+
+    # Checks whether the change rate of a fault key for a service is settled
+    def is_settled(self, fault_key, service):
+        with self.lock:
+            changes, n = self.counts.get((fault_key, service), (0, 0))
+        if n < self.min_images:
+            return False
+        low, high = wilson_interval(changes, n, self.confidence)
+        return high - low < self.ci_width
+
+    # Summarizes the change rates of the fault keys of a service: the observed images and changes,
+    # the change rate and its confidence interval, and whether it is settled
+    def summary(self, service):
+        with self.lock:
+            counts = {
+                fault_key: tuple(fault_counts)
+                for (fault_key, fault_service), fault_counts in self.counts.items()
+                if fault_service == service
+            }
+        return {
+            fault_key: {
+                'images': n,
+                'changes': changes,
+                'change_rate': changes / n if n else None,
+                'interval': list(wilson_interval(changes, n, self.confidence)),
+                'settled': self.is_settled(fault_key, service)
+            }
+            for fault_key, (changes, n) in counts.items()
+        }
@@ -0,0 +1,71 @@
+# Sweep modes of the faults with several parameter values: every value is evaluated, values are
+# evaluated in increasing order until the predictions flip (monotone), or the lowest flipping
+# value is bisected, assuming that a flip at a value implies flips at all higher values
+EXHAUSTIVE_SWEEP = 'all'
+MONOTONE_SWEEP = 'monotone'
+BISECT_SWEEP = 'bisect'
+ADAPTIVE_SWEEPS = [MONOTONE_SWEEP, BISECT_SWEEP]
+
+
+# Search of the breaking value of a fault for an image, i.e., the lowest parameter value (in the
+# configured order, from the mildest to the most severe) at which its predictions flip. Values are
+# proposed one at a time by next_value, and the outcome of each one is given to record
+class SeveritySearch:
+    def __init__(self, values, mode=MONOTONE_SWEEP):
+        self.values = list(values)
+        self.mode = mode
+        self.outcomes = {}  # Value index -> whether the predictions flipped (None if failed)
+        self.low, self.high = 0, len(self.values) - 1  # Bisection bounds (indexes)
+        self.high_flips = False  # Whether the value at high is known to flip
+
+    # Proposes the next value to evaluate, or None when the search is over
+    def next_value(self):
+        idx = self.__next_idx()
+        return None if idx is None else self.values[idx]
+
+    def __next_idx(self):
+        if self.mode == MONOTONE_SWEEP:
+            if any(self.outcomes.values()):
+                return None
+            return len(self.outcomes) if len(self.outcomes) < len(self.values) else None
+
+        # Bisection: the most severe value first, then the midpoints below the lowest flip
+        if not self.outcomes:
+            return self.high
+        if not self.high_flips or self.low >= self.high:
+            return None
+        return (self.low + self.high) // 2
+
+    # Records whether the predictions flipped at a value (None if it could not be evaluated, which
+    # is handled as no flip)
+    def record(self, value, flipped):
+        idx = self.values.index(value)
+        self.outcomes[idx] = flipped
+        if self.mode != BISECT_SWEEP:
+            return
+        if flipped:
+            self.high, self.high_flips = idx, True
+        elif idx == self.high:
+            self.low = self.high  # The most severe value does not flip
+        else:
+            self.low = idx + 1
+
+    # Values whose predictions were evaluated, in evaluation order
+    @property
+    def evaluated(self):
+        return [self.values[idx] for idx, flipped in self.outcomes.items() if flipped is not None]
+
+    # Breaking value found by the search (None if the predictions never flipped)
+    @property
+    def breaking_value(self):
+        flipping = [idx for idx, flipped in self.outcomes.items() if flipped]
+        return self.values[min(flipping)] if flipping else None
+
+
+# Checks whether the faulty predictions of an image differ from its base ones (as label sets) for
+# each service, given both as dicts of predictions per service
+def get_flipped_services(base_predictions, faulty_predictions):
+    return [
+        service for service, predictions in faulty_predictions.items()
+        if set(predictions) != set(base_predictions.get(service, []))
+    ]
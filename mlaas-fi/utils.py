@@ -2,6 +2,8 @@ import json
 import os
 import shutil
 import tarfile
+import tempfile
+import zlib
 
 from PIL import Image
 
@@ -24,6 +26,12 @@ def recreate_dir(dir_path):
     os.makedirs(dir_path)
 
 
+# Creates a uniquely named workspace directory (e.g., 'tmp/exp_1-a8x2k1q0/') in a base directory
+def create_workspace(base_dir, name):
+    create_dir(base_dir)
+    return tempfile.mkdtemp(prefix=name + '-', dir=base_dir)
+
+
 # Extracts the content of a tar file
 def extract_tarfile(path, output_dir):
     tar_file = tarfile.open(path)
@@ -44,6 +52,25 @@ def dump_json(path, data):
         json.dump(data, outfile)
 
 
+# Dumps given data into a JSON file, streaming the items of a list entry (list_key) one at a time
+# instead of building the whole document in memory
+def dump_json_stream(path, data, list_key, items):
+    with open(path, 'w') as outfile:
+        header = json.dumps({**data, list_key: []})
+        outfile.write(header[:-3] + '[')
+        for idx, item in enumerate(items):
+            if idx:
+                outfile.write(', ')
+            json.dump(item, outfile)
+        outfile.write(']}')
+
+
+# Derives a deterministic 32-bit seed from a base seed and a number of parts (e.g., an image key
+# and a fault key), so that random faults are reproducible regardless of the processing order
+def gen_seed(seed, *parts):
+    return zlib.crc32('/'.join(map(str, [seed, *parts])).encode())
+
+
 # Checks wether a dict has a given key
 def has_key(dict, key):
     return key in dict